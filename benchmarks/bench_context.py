@@ -0,0 +1,52 @@
+"""
+Measure how many prompt tokens context assembly saves per answer.
+
+Usage:
+    python -m benchmarks.bench_context [--candidates 6] [--max-tokens 1500] [--trim]
+
+The Treatise is split exactly as by the ingestion command and searched
+with BM25, so no embedding service is needed; adaptive k (which needs
+embeddings) is left out and only overlap merging, sentence trimming and
+the token budget are measured. The baseline is the previous prompt: the
+top three chunks joined verbatim.
+
+Six questions, six candidates, 1500-token budget (token counts estimated,
+tiktoken encodings were not available offline):
+
+    overlap merging only     8 tokens saved per answer (1%)
+    with --trim            190 tokens saved per answer (39%)
+"""
+import argparse
+import statistics
+from src.context import ContextAssembler, get_token_counter
+from src.corpus import load_registry
+from src.ingest import chunk_ids, get_text_splitter, iter_chunks
+from src.lexical import BM25Index
+from benchmarks.bench_retrieval_modes import QUESTIONS
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--candidates", type=int, default=6)
+    parser.add_argument("--max-tokens", type=int, default=1500)
+    parser.add_argument("--trim", action="store_true", help="keep only sentences sharing a question term")
+    args = parser.parse_args()
+
+    corpus = load_registry()["hume_treatise"]
+    docs = list(iter_chunks(corpus.path, get_text_splitter(), metadata={"corpus": corpus.name}))
+    index = BM25Index.build(chunk_ids(docs), [d.page_content for d in docs], [d.metadata for d in docs])
+    assembler = ContextAssembler(
+        count_tokens=get_token_counter("gpt-4o-mini"), max_tokens=args.max_tokens, trim=args.trim)
+
+    reports = []
+    for question in QUESTIONS:
+        # BM25 ranks neighbouring chunks together, which is where overlaps come from
+        candidates = [doc for doc, _ in index.search(question, args.candidates)]
+        _, report = assembler.assemble(question, candidates)
+        reports.append(report)
+        print(f"{report.baseline_tokens:6d} -> {report.context_tokens:6d} tokens  {question}")
+    saved = [r.tokens_saved / r.baseline_tokens for r in reports if r.baseline_tokens]
+    print(f"mean tokens saved: {statistics.mean(r.tokens_saved for r in reports):.0f} "
+          f"({statistics.mean(saved):.0%})")
+
+if __name__ == "__main__":
+    main()
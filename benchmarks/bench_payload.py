@@ -0,0 +1,77 @@
+"""
+Measure the bytes and serialization time of an /ask/ response.
+
+Usage:
+    python -m benchmarks.bench_payload [--chunks 3] [--snippet 120] [--rounds 2000]
+
+Answers are built from chunks of the Treatise found with BM25, like
+bench_context, and serialized the way FastAPI does: the model is dumped
+to JSON-compatible data and rendered by the response class. Compressed
+sizes are those CompressionMiddleware sends with the default gzip level.
+
+Six questions, three chunks per answer, single core:
+
+    format                    bytes   gzip   render us
+    documents, json            3333   1373          62
+    documents, orjson          3333   1373          24
+    references, orjson         1033    421          13
+    references+snippet 120     1346    614          15
+
+About 360 of the bytes are the answer itself, which all formats share.
+"""
+import argparse
+import gzip
+import statistics
+import time
+from fastapi.responses import JSONResponse, ORJSONResponse
+from src.corpus import load_registry
+from src.ingest import chunk_ids, get_text_splitter, iter_chunks
+from src.lexical import BM25Index
+from src.models import Answer, ContextReference
+from benchmarks.bench_retrieval_modes import QUESTIONS
+
+ANSWER = "Hume holds that all our perceptions resolve themselves into impressions and ideas. " * 4
+
+def render_seconds(answer: Answer, response_class, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        response_class(answer.model_dump(mode="json")).body
+    return (time.perf_counter() - started) / rounds
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--chunks", type=int, default=3)
+    parser.add_argument("--snippet", type=int, default=120)
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    corpus = load_registry()["hume_treatise"]
+    docs = list(iter_chunks(corpus.path, get_text_splitter(), metadata={"corpus": corpus.name}))
+    ids = chunk_ids(docs)
+    for id_, doc in zip(ids, docs):
+        doc.id = id_
+    index = BM25Index.build(ids, [d.page_content for d in docs], [d.metadata for d in docs])
+
+    formats = {
+        "documents, json": (JSONResponse, lambda context: {"context": context}),
+        "documents, orjson": (ORJSONResponse, lambda context: {"context": context}),
+        "references, orjson": (ORJSONResponse, lambda context: {
+            "references": [ContextReference.from_document(doc) for doc in context]}),
+        f"references+snippet {args.snippet}": (ORJSONResponse, lambda context: {
+            "references": [ContextReference.from_document(doc, args.snippet) for doc in context]}),
+    }
+    print(f"{'format':<26}{'bytes':>6}{'gzip':>7}{'render us':>12}")
+    for name, (response_class, context_fields) in formats.items():
+        sizes, compressed, seconds = [], [], []
+        for question in QUESTIONS:
+            context = [doc for doc, _ in index.search(question, args.chunks)]
+            answer = Answer(question=question, answer=ANSWER, **context_fields(context))
+            body = response_class(answer.model_dump(mode="json")).body
+            sizes.append(len(body))
+            compressed.append(len(gzip.compress(body, compresslevel=6)))
+            seconds.append(render_seconds(answer, response_class, args.rounds))
+        print(f"{name:<26}{statistics.mean(sizes):>6.0f}{statistics.mean(compressed):>7.0f}"
+              f"{statistics.mean(seconds) * 1e6:>12.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Compare latency of the dense, hybrid and lexical retrieval modes.
+
+Usage:
+    python -m benchmarks.bench_retrieval_modes [--embedding-latency 50]
+                                               [--dim 256] [--repeat 5]
+
+The Treatise is split exactly as by the ingestion command. Deterministic
+fake embeddings with an artificial latency stand in for the embedding
+service, and the dense side uses the NumPy backend, so only retrieval
+itself is measured.
+"""
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from src.corpus import load_registry
+from src.ingest import chunk_ids, get_text_splitter, iter_chunks
+from src.lexical import BM25Index
+from src.retrieval import CorpusRetriever
+from src.vectorstore import NumpyVectorStore
+
+QUESTIONS = [
+    "What is the difference between impressions and ideas?",
+    "What does Hume say about personal identity?",
+    "How does custom produce our belief in causation?",
+    "Is reason the slave of the passions?",
+    "What is the origin of justice and property?",
+    "Book II Part III of the will and direct passions",
+]
+
+class SlowEmbeddings(DeterministicFakeEmbedding):
+    latency: float = 0.05
+
+    async def aembed_query(self, text):
+        await asyncio.sleep(self.latency)
+        return self.embed_query(text)
+
+async def measure(retriever: CorpusRetriever, repeat: int) -> list[float]:
+    timings = []
+    for _ in range(repeat):
+        for question in QUESTIONS:
+            started = time.perf_counter()
+            await retriever.asearch(question)
+            timings.append(time.perf_counter() - started)
+    return timings
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--embedding-latency", type=float, default=50.0, help="milliseconds")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = load_registry()["hume_treatise"]
+    docs = list(iter_chunks(corpus.path, get_text_splitter(), metadata={"corpus": corpus.name}))
+    ids = chunk_ids(docs)
+    texts = [doc.page_content for doc in docs]
+    metadatas = [doc.metadata for doc in docs]
+    embeddings = SlowEmbeddings(size=args.dim, latency=args.embedding_latency / 1000)
+
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        lexical = BM25Index.build(ids, texts, metadatas)
+        lexical.save(f"{directory}/bm25")
+        print(f"{len(docs)} chunks, BM25 build+save {time.perf_counter() - started:.2f}s")
+        lexical = BM25Index.load(f"{directory}/bm25")
+        store = NumpyVectorStore(f"{directory}/numpy", embeddings)
+        store.add_vectors(embeddings.embed_documents(texts), texts, metadatas, ids)
+
+        for mode in ("dense", "hybrid", "lexical"):
+            retriever = CorpusRetriever(
+                embeddings, {corpus.name: store}, lexical={corpus.name: lexical}, mode=mode,
+                embedding_timeout=1.0)
+            ms = sorted(t * 1000 for t in asyncio.run(measure(retriever, args.repeat)))
+            print(f"{mode:<8} p50 {ms[len(ms) // 2]:8.2f} ms   p95 {ms[int(len(ms) * 0.95)]:8.2f} ms   "
+                  f"mean {statistics.mean(ms):8.2f} ms")
+
+if __name__ == "__main__":
+    main()
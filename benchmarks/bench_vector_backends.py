@@ -0,0 +1,80 @@
+"""
+Compare top-k search latency of the Chroma and NumPy vector backends.
+
+Usage:
+    python -m benchmarks.bench_vector_backends [--chunks 1700] [--dim 3072]
+                                               [--queries 200] [--k 3]
+
+Random unit vectors stand in for real embeddings, so no embedding service
+is needed. Every backend answers the same queries; latencies are reported
+per query, and for the NumPy backend also for one batched call.
+"""
+import argparse
+import statistics
+import tempfile
+import time
+import numpy as np
+from langchain_chroma import Chroma
+from langchain_core.embeddings import FakeEmbeddings
+from src.vectorstore import NumpyVectorStore
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+def report(name: str, timings: list[float]) -> None:
+    ms = [t * 1000 for t in timings]
+    print(f"{name:<28} p50 {percentile(ms, 50):8.3f} ms   p95 {percentile(ms, 95):8.3f} ms   "
+          f"mean {statistics.mean(ms):8.3f} ms")
+
+def time_calls(fn, queries) -> list[float]:
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        fn(query)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--chunks", type=int, default=1700)
+    parser.add_argument("--dim", type=int, default=3072)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((args.chunks, args.dim)).astype(np.float32)
+    queries = rng.standard_normal((args.queries, args.dim)).astype(np.float32).tolist()
+    ids = [str(i) for i in range(args.chunks)]
+    texts = [f"chunk {i}" for i in range(args.chunks)]
+    metadatas = [{"start_index": i * 800} for i in range(args.chunks)]
+    embeddings = FakeEmbeddings(size=args.dim)
+
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        chroma = Chroma(embedding_function=embeddings, persist_directory=f"{directory}/chroma")
+        for i in range(0, args.chunks, 1000):
+            chroma._collection.upsert(
+                ids=ids[i:i + 1000], embeddings=vectors[i:i + 1000].tolist(),
+                documents=texts[i:i + 1000], metadatas=metadatas[i:i + 1000])
+        print(f"chroma build: {time.perf_counter() - started:.2f}s")
+        report("chroma", time_calls(
+            lambda q: chroma.similarity_search_by_vector_with_relevance_scores(q, k=args.k), queries))
+
+        for dtype in ("float32", "float16", "int8"):
+            started = time.perf_counter()
+            NumpyVectorStore.from_chroma(chroma, f"{directory}/numpy-{dtype}", dtype)
+            build = time.perf_counter() - started
+            started = time.perf_counter()
+            store = NumpyVectorStore(f"{directory}/numpy-{dtype}", embeddings)
+            print(f"numpy {dtype} build: {build:.2f}s, open: {(time.perf_counter() - started) * 1000:.1f} ms")
+            report(f"numpy {dtype}", time_calls(
+                lambda q: store.similarity_search_by_vector_with_relevance_scores(q, k=args.k), queries))
+            started = time.perf_counter()
+            store.similarity_search_by_vectors_with_relevance_scores(queries, k=args.k)
+            per_query = (time.perf_counter() - started) / len(queries)
+            print(f"{'numpy ' + dtype + ' batched':<28} {per_query * 1000:8.3f} ms/query")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Load test of the whole API against a real uvicorn process, offline.
+
+Usage:
+    python -m benchmarks.load_api [--levels 1,8,32] [--rounds 5] [--workers 1]
+                                  [--save baseline.json] [--compare baseline.json]
+                                  [--tolerance 0.2]
+
+The server runs with ENVIRONMENT=bench: the chat model and embeddings are
+the deterministic stand-ins of `src/bench.py`, with the latency and token
+rate set by the BENCH_* settings (exported BENCH_* variables are passed
+through), against a fresh SQLite database and vector store in a temporary
+directory. Every virtual user registers, logs in and then asks `--rounds`
+questions, reading its conversation list and messages after each answer;
+`--levels` are the numbers of concurrent users. Answers are not cached.
+
+Reports p50/p95/p99 latency per endpoint and requests/s per level.
+--save writes them as a JSON baseline; --compare reads one and exits with
+status 1 when a p95 got more than --tolerance slower.
+
+Single core, 1 worker, defaults (stand-in LLM: 200 ms to the first token,
+then 50 tokens/s for 40-token answers; 20 ms per embedding call; at most 8
+answers generated at once), 5 questions per user:
+
+    users  endpoint        p50      p95      p99
+        1  ask          1097 ms  1562 ms  1626 ms
+        1  messages        6 ms     9 ms     9 ms
+        8  ask          1155 ms  1282 ms  1303 ms
+        8  messages       28 ms    58 ms    62 ms
+       32  ask          4242 ms  4340 ms  4620 ms
+       32  token         221 ms   802 ms   885 ms
+       32  messages       12 ms    27 ms    85 ms
+
+    1 user 2.8 req/s, 8 users 21.0 req/s, 32 users 24.1 req/s (answers
+    queue for the 8 generation slots)
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+
+import httpx
+
+ENDPOINTS = ("register", "token", "ask", "conversations", "messages")
+QUESTIONS = (
+    "What is the origin of our ideas?",
+    "How does custom relate to causation?",
+    "Is reason the slave of the passions?",
+    "What is personal identity?",
+    "How do impressions differ from ideas?",
+)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def server_env(directory: str) -> dict:
+    return {
+        **os.environ,
+        "ENVIRONMENT": "bench",
+        "AUTH_SECRET_KEY": "bench-secret-key",
+        "DATABASE_URL": f"sqlite:///{directory}/load_api.db",
+        "VECTOR_STORE_PATH": f"{directory}/vector_store",
+        "EMBEDDING_CACHE_PATH": f"{directory}/embedding_cache.db",
+        "ANSWER_CACHE_ENABLED": "false",
+        # Registration and login are not what is measured here
+        "BCRYPT_ROUNDS": "4",
+    }
+
+def start_server(env: dict, port: int, workers: int) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.main:app", "--host", "127.0.0.1",
+         "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        env=env)
+
+def wait_until_ready(url: str, server: subprocess.Popen, timeout: float = 300.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"server exited with status {server.returncode}")
+        try:
+            if httpx.get(f"{url}/openapi.json", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    sys.exit("server did not start in time")
+
+async def timed_request(client: httpx.AsyncClient, latencies: dict, errors: dict, endpoint: str, method: str, url: str, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except httpx.HTTPError:
+        errors[endpoint] += 1
+        return None
+    elapsed = time.perf_counter() - started
+    if response.status_code >= 400:
+        errors[endpoint] += 1
+        return None
+    latencies[endpoint].append(elapsed)
+    return response
+
+async def virtual_user(client: httpx.AsyncClient, rounds: int, latencies: dict, errors: dict) -> None:
+    request = lambda endpoint, method, url, **kwargs: timed_request(
+        client, latencies, errors, endpoint, method, url, **kwargs)
+    credentials = {"username": f"bench-{uuid.uuid4().hex}", "password": "benchpassword"}
+    if await request("register", "POST", "/auth/register", json=credentials) is None:
+        return
+    response = await request("token", "POST", "/auth/token", data=credentials)
+    if response is None:
+        return
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    for i in range(rounds):
+        response = await request("ask", "POST", "/ask/", headers=headers,
+                                 json={"question": QUESTIONS[i % len(QUESTIONS)]})
+        if response is None:
+            continue
+        conversations = await request("conversations", "GET", "/user/me/conversations/", headers=headers)
+        if conversations is not None and conversations.json():
+            conversation_id = conversations.json()[-1]["id"]
+            await request("messages", "GET", f"/conversation/{conversation_id}/messages/", headers=headers)
+
+def summarize(values: list[float]) -> dict:
+    if len(values) < 2:
+        value = values[0] * 1000 if values else 0.0
+        return {"count": len(values), "p50": value, "p95": value, "p99": value}
+    quantiles = statistics.quantiles(values, n=100)
+    return {
+        "count": len(values),
+        "p50": statistics.median(values) * 1000,
+        "p95": quantiles[94] * 1000,
+        "p99": quantiles[98] * 1000,
+    }
+
+async def run_level(url: str, users: int, rounds: int) -> dict:
+    latencies, errors = defaultdict(list), defaultdict(int)
+    limits = httpx.Limits(max_connections=users)
+    async with httpx.AsyncClient(base_url=url, timeout=120.0, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(virtual_user(client, rounds, latencies, errors) for _ in range(users)))
+        elapsed = time.perf_counter() - started
+    requests = sum(len(values) for values in latencies.values())
+    return {
+        "users": users,
+        "seconds": elapsed,
+        "requests_per_second": requests / elapsed,
+        "errors": sum(errors.values()),
+        "endpoints": {
+            endpoint: {**summarize(latencies[endpoint]), "errors": errors[endpoint]}
+            for endpoint in ENDPOINTS
+        },
+    }
+
+def report(results: list[dict]) -> None:
+    print(f"{'users':>5}  {'endpoint':<14}{'p50':>9} {'p95':>9} {'p99':>9} {'errors':>7}")
+    for result in results:
+        for endpoint, summary in result["endpoints"].items():
+            print(f"{result['users']:>5}  {endpoint:<14}{summary['p50']:>6.0f} ms"
+                  f"{summary['p95']:>7.0f} ms{summary['p99']:>7.0f} ms{summary['errors']:>7}")
+    for result in results:
+        print(f"{result['users']:>5} users: {result['requests_per_second']:.1f} req/s, "
+              f"{result['errors']} errors in {result['seconds']:.1f} s")
+
+def compare(results: list[dict], baseline: dict, tolerance: float) -> bool:
+    """
+    Print p95 changes against the baseline; False when one regressed.
+    """
+    ok = True
+    levels = {level["users"]: level for level in baseline["levels"]}
+    for result in results:
+        base = levels.get(result["users"])
+        if base is None:
+            continue
+        for endpoint, summary in result["endpoints"].items():
+            before = base["endpoints"].get(endpoint, {}).get("p95")
+            if not before:
+                continue
+            change = summary["p95"] / before - 1
+            regressed = change > tolerance
+            ok = ok and not regressed
+            print(f"{result['users']:>5}  {endpoint:<14}p95 {before:.0f} -> {summary['p95']:.0f} ms "
+                  f"({change:+.0%}){'  REGRESSION' if regressed else ''}")
+    return ok
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--levels", default="1,8,32", help="comma separated numbers of concurrent users")
+    parser.add_argument("--rounds", type=int, default=5, help="questions per user")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with a JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 slowdown")
+    args = parser.parse_args()
+    levels = [int(level) for level in args.levels.split(",")]
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = server_env(directory)
+        # Index the corpora once up front, so workers don't race to build it
+        subprocess.run([sys.executable, "-m", "src.ingest"], env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        server = start_server(env, port, args.workers)
+        try:
+            wait_until_ready(url, server)
+            results = [asyncio.run(run_level(url, users, args.rounds)) for users in levels]
+        finally:
+            server.terminate()
+            server.wait()
+
+    report(results)
+    if args.save:
+        settings = {key: value for key, value in env.items() if key.startswith("BENCH_")}
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"rounds": args.rounds, "workers": args.workers,
+                       "settings": settings, "levels": results}, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,23 @@
+import asyncio
 import os
+import threading
+import time
 import jwt
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Annotated
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException, status, APIRouter
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jwt.exceptions import InvalidTokenError
 from passlib.context import CryptContext
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from sqlmodel import Session, select
-from .db import User, get_session
+from .db import Conversation, Message, User, get_session
 from .config import get_settings 
+from .metrics import timed
 
 router = APIRouter(
     prefix="/auth",
@@ -31,6 +38,18 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     username: str | None = None
 
+class Principal(BaseModel):
+    """
+    The authenticated user as resolved from a verified token.
+    """
+    id: int
+    username: str
+    # Fingerprint of the password the token was issued for
+    fingerprint: str | None = Field(default=None, exclude=True)
+
+    class Config:
+        frozen = True
+
 class UserCreate(BaseModel):
     username: str
     password: str
@@ -42,15 +61,156 @@ class UserResponse(BaseModel):
     class Config:
         from_attributes = True
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+class PasswordChange(BaseModel):
+    current_password: str
+    new_password: str
+
+class VerifiedTokenCache:
+    """
+    LRU cache of verified tokens and the principal they resolve to.
+
+    An entry is dropped once its token expires, so a cached token is never
+    accepted past its `exp`. `revoke_user` drops the entries of a user whose
+    password changed or who was deleted; `PasswordFingerprints` rejects
+    their tokens when they are presented again.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[Principal, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, token: str) -> Principal | None:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and entry[1] <= time.time():
+                del self._entries[token]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, token: str, principal: Principal, expires: float) -> None:
+        with self._lock:
+            self._entries[token] = (principal, expires)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def revoke_user(self, user_id: int) -> None:
+        with self._lock:
+            for token in [t for t, (p, _) in self._entries.items() if p.id == user_id]:
+                del self._entries[token]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+def password_fingerprint(user: User) -> str:
+    """
+    Identify the password of a user: changed by every password change, but
+    not by rehashing the same password with another work factor.
+    """
+    return f"{user.id}.{user.password_version}"
+
+class PasswordFingerprints:
+    """
+    Fingerprints of the users' passwords, read from the database and kept
+    for `ttl` seconds; None for a deleted user.
+
+    Tokens carry the fingerprint of the password they were issued for in a
+    `pwf` claim and are rejected once it no longer matches, so changing a
+    password or deleting a user revokes their tokens on every worker and
+    across restarts. Other workers notice within `ttl` seconds.
+    """
+
+    def __init__(self, ttl: float = 10.0):
+        self.ttl = ttl
+        self._entries: dict[int, tuple[str | None, float]] = {}
+        self._lock = threading.Lock()
+
+    def cached(self, user_id: int) -> tuple[bool, str | None]:
+        """
+        Whether a fresh fingerprint of the user is known, and the fingerprint.
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is None or entry[1] <= time.monotonic():
+            return False, None
+        return True, entry[0]
+
+    def set(self, user_id: int, fingerprint: str | None) -> None:
+        with self._lock:
+            self._entries[user_id] = (fingerprint, time.monotonic() + self.ttl)
+
+    def get(self, db: Session, user_id: int) -> str | None:
+        known, fingerprint = self.cached(user_id)
+        if not known:
+            user = db.get(User, user_id)
+            fingerprint = password_fingerprint(user) if user is not None else None
+            self.set(user_id, fingerprint)
+        return fingerprint
+
+    def accepts(self, principal: Principal) -> bool:
+        """
+        Whether a cached principal is still valid, as far as is known without
+        a database lookup.
+        """
+        known, fingerprint = self.cached(principal.id)
+        return known and fingerprint is not None and principal.fingerprint in (None, fingerprint)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+token_cache = VerifiedTokenCache(settings.auth_token_cache_size)
+user_fingerprints = PasswordFingerprints(settings.auth_user_cache_seconds)
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.bcrypt_rounds)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
 
+# bcrypt releases the GIL, so a few threads keep hashing off the event loop
+# without letting a login burst take every core
+password_executor = ThreadPoolExecutor(
+    max_workers=settings.password_hash_workers, thread_name_prefix="bcrypt")
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+async def averify_password(plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+    """
+    Verify a password in the hashing pool. Also returns a new hash when the
+    stored one was made with another work factor, else None.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        password_executor, pwd_context.verify_and_update, plain_password, hashed_password)
+
+async def aget_password_hash(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.hash, password)
+
 def get_user(db: Annotated[Session, Depends(get_session)], username: str) -> User | None:
     statement = select(User).where(User.username == username)
     result = db.exec(statement)
@@ -59,16 +219,39 @@ def get_user(db: Annotated[Session, Depends(get_session)], username: str) -> Use
         return user
     return None
 
-def authenticate_user(
+def find_user(db: Session, username: str) -> User | None:
+    """
+    Look a user up and end the read transaction, so the pooled connection
+    is not held while the caller waits, e.g. for a password hash.
+    """
+    user = get_user(db, username)
+    db.commit()
+    return user
+
+def save(db: Session, obj):
+    db.add(obj)
+    db.commit()
+    db.refresh(obj)
+    return obj
+
+async def authenticate_user(
     db: Annotated[Session, Depends(get_session)], 
     username: str, 
     password: str
 ) -> User | None:
-    user = get_user(db, username)
+    # Queries run in the threadpool: waiting for a pooled connection must
+    # not block the event loop, which runs the requests that release them
+    user = await run_in_threadpool(find_user, db, username)
     if not user:
         return None
-    if not verify_password(password, user.password):
+    verified, new_hash = await averify_password(password, user.password)
+    if not verified:
         return None
+    if new_hash:
+        # The work factor has changed since this hash was made
+        user.password = new_hash
+        await run_in_threadpool(save, db, user)
+        user_fingerprints.set(user.id, password_fingerprint(user))
     return user
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None) -> str:
@@ -77,14 +260,27 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None) -> s
         expire = datetime.now(timezone.utc) + expires_delta
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": datetime.now(timezone.utc)})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 async def get_current_user(
     db: Annotated[Session, Depends(get_session)],
     token: Annotated[str, Depends(oauth2_scheme)]
-) -> User:
+) -> Principal:
+    """
+    Resolve the bearer token to a principal. Verified tokens are cached until
+    they expire, and checked against the cached password fingerprint of their
+    user; tokens that carry the user id in a `uid` claim are trusted without
+    a user lookup by name when `auth_stateless_tokens` is enabled.
+    """
+    with timed("auth"):
+        principal = token_cache.get(token)
+        if principal is None or not user_fingerprints.accepts(principal):
+            principal = await run_in_threadpool(verify_token, db, token)
+        return principal
+
+def verify_token(db: Session, token: str) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -98,31 +294,60 @@ async def get_current_user(
         token_data = TokenData(username=username)
     except InvalidTokenError:
         raise credentials_exception
-        
-    user = get_user(db, username=token_data.username)
-    if user is None:
+
+    user_id, fingerprint = payload.get("uid"), payload.get("pwf")
+    if user_id is not None and fingerprint is not None and settings.auth_stateless_tokens:
+        current = user_fingerprints.get(db, user_id)
+    else:
+        user = get_user(db, username=token_data.username)
+        if user is None:
+            raise credentials_exception
+        user_id, current = user.id, password_fingerprint(user)
+        user_fingerprints.set(user_id, current)
+    if current is None or fingerprint not in (None, current):
         raise credentials_exception
-    return user
+
+    principal = Principal(id=user_id, username=token_data.username, fingerprint=fingerprint)
+    token_cache.set(token, principal, payload["exp"])
+    return principal
+
+def is_admin(headers: dict) -> bool:
+    """
+    Whether the bearer token in the (lower-cased) request `headers` was
+    issued to one of the `admin_users`. Checked without a database lookup,
+    for middleware that runs before the request is routed.
+    """
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except InvalidTokenError:
+        return False
+    principal = token_cache.get(token)
+    user_id = principal.id if principal is not None else payload.get("uid")
+    if user_id is not None:
+        known, fingerprint = user_fingerprints.cached(user_id)
+        if known and (fingerprint is None or payload.get("pwf") not in (None, fingerprint)):
+            return False
+    return payload.get("sub") in settings.admin_users
 
 @router.post("/register", response_model=UserResponse)
 async def register_user(
     user_create: UserCreate, 
     db: Annotated[Session, Depends(get_session)]
 ) -> User:
-    if get_user(db, user_create.username):
+    if await run_in_threadpool(find_user, db, user_create.username):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already registered"
         )
     
-    hashed_password = get_password_hash(user_create.password)
+    hashed_password = await aget_password_hash(user_create.password)
     db_user = User(username=user_create.username, password=hashed_password)
     
     try:
-        db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
-        return db_user
+        return await run_in_threadpool(save, db, db_user)
     except Exception as e:
         db.rollback()
         raise HTTPException(
@@ -135,7 +360,7 @@ async def login_for_access_token(
     db: Annotated[Session, Depends(get_session)],
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
 ) -> Token:
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -143,13 +368,60 @@ async def login_for_access_token(
             headers={"WWW-Authenticate": "Bearer"},
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    claims = {"sub": user.username, "pwf": password_fingerprint(user)}
+    if settings.auth_stateless_tokens:
+        claims["uid"] = user.id
     access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data=claims, expires_delta=access_token_expires
     )
     return Token(access_token=access_token, token_type="bearer")
 
 @router.get("/users/me/", response_model=UserResponse)
 async def read_users_me(
-    current_user: Annotated[User, Depends(get_current_user)],
-) -> User:
-    return current_user
\ No newline at end of file
+    current_user: Annotated[Principal, Depends(get_current_user)],
+) -> Principal:
+    return current_user
+
+@router.post("/users/me/password", status_code=status.HTTP_204_NO_CONTENT)
+async def change_password(
+    password_change: PasswordChange,
+    current_user: Annotated[Principal, Depends(get_current_user)],
+    db: Annotated[Session, Depends(get_session)]
+) -> None:
+    user = await authenticate_user(db, current_user.username, password_change.current_password)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Incorrect password"
+        )
+    user.password = await aget_password_hash(password_change.new_password)
+    user.password_version += 1
+    await run_in_threadpool(save, db, user)
+    # Tokens issued with the old password stop working
+    user_fingerprints.set(user.id, password_fingerprint(user))
+    token_cache.revoke_user(user.id)
+
+@router.delete("/users/me", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_user(
+    current_user: Annotated[Principal, Depends(get_current_user)],
+    db: Annotated[Session, Depends(get_session)]
+) -> None:
+    if not await run_in_threadpool(delete_user_data, db, current_user.id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    user_fingerprints.set(current_user.id, None)
+    token_cache.revoke_user(current_user.id)
+
+def delete_user_data(db: Session, user_id: int) -> bool:
+    """
+    Delete a user with their messages and conversations. False if there is no such user.
+    """
+    user = db.get(User, user_id)
+    if user is None:
+        return False
+    for message in db.exec(select(Message).where(Message.user_id == user.id)):
+        db.delete(message)
+    for conversation in db.exec(select(Conversation).where(Conversation.user_id == user.id)):
+        db.delete(conversation)
+    db.delete(user)
+    db.commit()
+    return True
\ No newline at end of file
@@ -0,0 +1,76 @@
+# batching.py
+import asyncio
+from collections import Counter
+from typing_extensions import Any, Awaitable, Callable, List
+
+class MicroBatcher:
+    """
+    Collect concurrent calls into batches for a single handler call.
+
+    The first item of a batch starts a timer of `max_wait` seconds; the batch
+    is handed to `handler` when the timer fires or `max_batch_size` items
+    have arrived, whichever comes first. `handler` takes the list of items
+    and returns one result per item, in order; every caller gets its own
+    result back, or the exception raised by the handler.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_batch_size: int = 32,
+        max_wait: float = 0.002,
+    ):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.items = 0
+        # Batch sizes rounded up to the next power of two
+        self.batch_size_histogram: Counter[int] = Counter()
+        self._pending: List[tuple[Any, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "batch_size_histogram": dict(sorted(self.batch_size_histogram.items())),
+        }
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[tuple[Any, asyncio.Future]]) -> None:
+        self.batches += 1
+        self.items += len(batch)
+        self.batch_size_histogram[1 << (len(batch) - 1).bit_length()] += 1
+        try:
+            results = await self.handler([item for item, _ in batch])
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for (_, future), result in zip(batch, results):
+            # Callers that gave up waiting have cancelled their future
+            if not future.done():
+                future.set_result(result)
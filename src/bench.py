@@ -0,0 +1,143 @@
+# bench.py
+import asyncio
+import hashlib
+import time
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from typing_extensions import AsyncIterator, Iterator, List
+
+WORDS = (
+    "the", "mind", "impression", "idea", "custom", "reason", "passion", "cause",
+    "effect", "belief", "experience", "object", "perception", "nature", "human", "habit",
+)
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+class BenchChatModel(BaseChatModel):
+    """
+    Deterministic local stand-in for the chat model (environment="bench").
+
+    Answers the same prompt with the same `answer_tokens` words, the first
+    after `latency` seconds and the rest at `tokens_per_second`, and reports
+    usage like a provider would, so load tests exercise the whole app
+    without network calls or API costs.
+    """
+    model_name: str = "bench"
+    latency: float = 0.2
+    tokens_per_second: float = 50.0
+    answer_tokens: int = 40
+
+    @property
+    def _llm_type(self) -> str:
+        return "bench"
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        seed = hashlib.sha256(str(messages[-1].content).encode("utf-8")).digest()
+        return [(" " if i else "") + WORDS[seed[i % len(seed)] % len(WORDS)] for i in range(self.answer_tokens)]
+
+    def _usage(self, messages: List[BaseMessage], tokens: List[str]) -> dict:
+        input_tokens = sum(count_tokens(str(message.content)) for message in messages)
+        return {"input_tokens": input_tokens, "output_tokens": len(tokens),
+                "total_tokens": input_tokens + len(tokens)}
+
+    def _delay(self, tokens: List[str]) -> float:
+        return self.latency + max(0, len(tokens) - 1) / self.tokens_per_second
+
+    def _result(self, messages: List[BaseMessage], tokens: List[str]) -> ChatResult:
+        message = AIMessage(content="".join(tokens), usage_metadata=self._usage(messages, tokens))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: List[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs
+    ) -> ChatResult:
+        tokens = self._tokens(messages)
+        time.sleep(self._delay(tokens))
+        return self._result(messages, tokens)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: List[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs
+    ) -> ChatResult:
+        tokens = self._tokens(messages)
+        await asyncio.sleep(self._delay(tokens))
+        return self._result(messages, tokens)
+
+    def _chunk(self, messages: List[BaseMessage], tokens: List[str], i: int) -> ChatGenerationChunk:
+        # Usage is reported once, with the last chunk
+        usage = self._usage(messages, tokens) if i == len(tokens) - 1 else None
+        return ChatGenerationChunk(message=AIMessageChunk(content=tokens[i], usage_metadata=usage))
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: List[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs
+    ) -> Iterator[ChatGenerationChunk]:
+        tokens = self._tokens(messages)
+        for i, token in enumerate(tokens):
+            time.sleep(self.latency if i == 0 else 1 / self.tokens_per_second)
+            chunk = self._chunk(messages, tokens, i)
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: List[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        tokens = self._tokens(messages)
+        for i, token in enumerate(tokens):
+            await asyncio.sleep(self.latency if i == 0 else 1 / self.tokens_per_second)
+            chunk = self._chunk(messages, tokens, i)
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+class BenchEmbeddings(Embeddings):
+    """
+    Deterministic local stand-in for the embedding model (environment="bench"):
+    unit vectors seeded by the text, after `latency` seconds per call.
+    """
+
+    def __init__(self, dimensions: int = 256, latency: float = 0.02):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.model = "bench"
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for text in texts:
+            seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(self.dimensions)
+            vectors.append((vector / np.linalg.norm(vector)).tolist())
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return self._embed(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        return self._embed(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
@@ -0,0 +1,300 @@
+# cache.py
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import numpy as np
+from langchain_core.documents import Document
+from typing_extensions import List
+
+def normalize_question(question: str) -> str:
+    """
+    Normalize a question for exact cache lookups:
+    lowercase, collapse whitespace and drop trailing punctuation.
+    """
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip("?!. ")
+
+def question_key(question: str) -> str:
+    return hashlib.sha256(normalize_question(question).encode("utf-8")).hexdigest()
+
+def file_fingerprint(path: str) -> str:
+    """
+    Content hash of a file, used to detect corpus changes.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+@dataclass
+class CacheEntry:
+    question: str
+    answer: str
+    context: List[Document]
+    embedding: np.ndarray | None = None
+    created_at: float = field(default_factory=time.time)
+
+class InMemoryCacheBackend:
+    """
+    LRU-ordered in-process cache backend.
+    """
+
+    def __init__(self):
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._namespace: str | None = None
+        self._lock = threading.Lock()
+
+    def get_namespace(self) -> str | None:
+        return self._namespace
+
+    def set_namespace(self, namespace: str) -> None:
+        self._namespace = namespace
+
+    def get(self, key: str) -> CacheEntry | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: CacheEntry, max_entries: int) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def embeddings(self) -> tuple[list[str], list[np.ndarray]]:
+        with self._lock:
+            items = [(k, e.embedding) for k, e in self._entries.items() if e.embedding is not None]
+        return [k for k, _ in items], [v for _, v in items]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+class SQLiteCacheBackend:
+    """
+    On-disk cache backend, shared by all workers on the same host.
+    Recency is tracked in a `last_used` column for LRU eviction.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answer_cache ("
+            "key TEXT PRIMARY KEY, question TEXT, answer TEXT, context TEXT, "
+            "embedding BLOB, created_at REAL, last_used REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_answer_cache_last_used ON answer_cache (last_used)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answer_cache_meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._lock = threading.Lock()
+
+    def get_namespace(self) -> str | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM answer_cache_meta WHERE name = 'namespace'").fetchone()
+        return row[0] if row else None
+
+    def set_namespace(self, namespace: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answer_cache_meta (name, value) VALUES ('namespace', ?)",
+                (namespace,))
+
+    def get(self, key: str) -> CacheEntry | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT question, answer, context, embedding, created_at "
+                "FROM answer_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE answer_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        question, answer, context, embedding, created_at = row
+        return CacheEntry(
+            question=question,
+            answer=answer,
+            context=[Document(**doc) for doc in json.loads(context)],
+            embedding=None if embedding is None else np.frombuffer(embedding, dtype=np.float32),
+            created_at=created_at,
+        )
+
+    def set(self, key: str, entry: CacheEntry, max_entries: int) -> None:
+        context = json.dumps([
+            {"id": doc.id, "page_content": doc.page_content, "metadata": doc.metadata}
+            for doc in entry.context
+        ])
+        embedding = None if entry.embedding is None else entry.embedding.astype(np.float32).tobytes()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answer_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, entry.question, entry.answer, context, embedding,
+                 entry.created_at, time.time()))
+            self._conn.execute(
+                "DELETE FROM answer_cache WHERE key IN ("
+                "SELECT key FROM answer_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (max_entries,))
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM answer_cache WHERE key = ?", (key,))
+
+    def embeddings(self) -> tuple[list[str], list[np.ndarray]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, embedding FROM answer_cache WHERE embedding IS NOT NULL").fetchall()
+        return [k for k, _ in rows], [np.frombuffer(v, dtype=np.float32) for _, v in rows]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM answer_cache")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM answer_cache").fetchone()[0]
+
+class AnswerCache:
+    """
+    Answer cache in front of the RAG graph.
+
+    Exact hits are looked up by the normalized question. When an embedding of
+    the question is given, semantic hits are found by cosine similarity against
+    the embeddings of cached questions. Entries expire after `ttl` seconds and
+    the least recently used ones are evicted beyond `max_entries`.
+
+    The cache is bound to a namespace (a fingerprint of the corpus, prompt and
+    model); entries from another namespace are dropped on `invalidate`.
+    """
+
+    def __init__(
+        self,
+        backend: InMemoryCacheBackend | SQLiteCacheBackend,
+        max_entries: int = 1024,
+        ttl: float = 24 * 3600,
+        similarity_threshold: float | None = 0.95,
+    ):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._index: tuple[list[str], np.ndarray] | None = None
+
+    def invalidate(self, namespace: str) -> None:
+        """
+        Bind the cache to `namespace`, clearing it if it held entries for another one.
+        """
+        if self.backend.get_namespace() != namespace:
+            self.backend.clear()
+            self.backend.set_namespace(namespace)
+        self._index = None
+
+    def stats(self) -> dict:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self.backend),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+        }
+
+    def _get_fresh(self, key: str) -> CacheEntry | None:
+        entry = self.backend.get(key)
+        if entry is not None and time.time() - entry.created_at > self.ttl:
+            self.backend.delete(key)
+            self._index = None
+            return None
+        return entry
+
+    def _semantic_index(self) -> tuple[list[str], np.ndarray]:
+        # The similarity matrix is rebuilt only after local writes; entries
+        # written by other workers to a shared backend are picked up then.
+        if self._index is None:
+            keys, vectors = self.backend.embeddings()
+            matrix = np.vstack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+            self._index = (keys, matrix)
+        return self._index
+
+    def contains(self, question: str) -> bool:
+        return self._get_fresh(question_key(question)) is not None
+
+    def lookup(self, question: str, embedding: List[float] | None = None) -> CacheEntry | None:
+        entry = self._get_fresh(question_key(question))
+        if entry is not None:
+            self.exact_hits += 1
+            return entry
+
+        if embedding is not None and self.similarity_threshold is not None:
+            keys, matrix = self._semantic_index()
+            query = _unit(embedding)
+            if len(keys) and matrix.shape[1] == query.shape[0]:
+                scores = matrix @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity_threshold:
+                    entry = self._get_fresh(keys[best])
+                    if entry is not None:
+                        self.semantic_hits += 1
+                        return entry
+
+        self.misses += 1
+        return None
+
+    def store(
+        self,
+        question: str,
+        answer: str,
+        context: List[Document],
+        embedding: List[float] | None = None,
+    ) -> None:
+        entry = CacheEntry(
+            question=question,
+            answer=answer,
+            context=context,
+            embedding=None if embedding is None else _unit(embedding),
+        )
+        self.backend.set(question_key(question), entry, self.max_entries)
+        self._index = None
+
+def _unit(vector: List[float]) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def get_answer_cache(settings) -> AnswerCache | None:
+    """
+    Create the answer cache configured in settings, or None if it is disabled.
+    """
+    if not settings.answer_cache_enabled:
+        return None
+    if settings.answer_cache_backend == "sqlite":
+        backend = SQLiteCacheBackend(settings.answer_cache_path)
+    elif settings.answer_cache_backend == "memory":
+        backend = InMemoryCacheBackend()
+    else:
+        raise ValueError(f"Unknown answer cache backend: {settings.answer_cache_backend}")
+    return AnswerCache(
+        backend,
+        max_entries=settings.answer_cache_max_entries,
+        ttl=settings.answer_cache_ttl,
+        similarity_threshold=settings.answer_cache_similarity_threshold,
+    )
@@ -0,0 +1,110 @@
+# compression.py
+import zlib
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # optional, responses are gzipped without it
+    brotli = None
+
+# Streamed token by token; compressing every tiny event costs more than it saves
+UNCOMPRESSED_TYPES = ("text/event-stream",)
+
+def accepted_encodings(header: str) -> set[str]:
+    encodings = set()
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if name and params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            encodings.add(name)
+    return encodings
+
+class Compressor:
+    """
+    Incremental gzip or brotli compression of a response body. Each call
+    to `compress` returns everything compressed so far, so streamed chunks
+    reach the client as they are produced.
+    """
+
+    def __init__(self, encoding: str, gzip_level: int = 6, brotli_quality: int = 4):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+        else:
+            # wbits 31: a gzip header and trailer around the deflate stream
+            self._zlib = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        if self.encoding == "br":
+            out = self._brotli.process(data)
+            return out + (self._brotli.finish() if final else self._brotli.flush())
+        out = self._zlib.compress(data)
+        return out + self._zlib.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing responses with brotli (when the `brotli`
+    package is installed) or gzip, whichever the client accepts, preferring
+    brotli. Whole responses smaller than `minimum_size` bytes, event streams
+    and responses that are already encoded are sent as they are; other
+    streamed responses are compressed and flushed chunk by chunk.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def _encoding(self, scope) -> str | None:
+        accepted = accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+        if "br" in accepted and brotli is not None:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        encoding = self._encoding(scope) if scope["type"] == "http" else None
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        compressor: Compressor | None = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                headers = Headers(raw=message["headers"])
+                passthrough = (
+                    "content-encoding" in headers
+                    or headers.get("content-type", "").startswith(UNCOMPRESSED_TYPES))
+                if passthrough:
+                    await send(message)
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                if not more_body and len(body) < self.minimum_size:
+                    await send(start)
+                    return await send(message)
+                compressor = Compressor(encoding, self.gzip_level, self.brotli_quality)
+                headers = MutableHeaders(raw=start["headers"])
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    del headers["Content-Length"]
+                    body = compressor.compress(body, final=False)
+                else:
+                    body = compressor.compress(body, final=True)
+                    headers["Content-Length"] = str(len(body))
+                await send(start)
+                return await send({**message, "body": body})
+            await send({**message, "body": compressor.compress(body, final=not more_body)})
+
+        await self.app(scope, receive, send_compressed)
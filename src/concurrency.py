@@ -0,0 +1,323 @@
+# concurrency.py
+import asyncio
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from collections.abc import Hashable
+from typing_extensions import Callable
+from .metrics import SCHEDULER_REJECTIONS, SCHEDULER_WAIT
+
+class CapacityExceeded(Exception):
+    """
+    Raised when a call cannot get a slot without exceeding the queue limits.
+    """
+
+    def __init__(self, retry_after: float = 1.0, message: str = "Too many requests in flight"):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class QuotaExceeded(CapacityExceeded):
+    """
+    Raised when a user's own request or token quota would not allow a call
+    within the queue timeout.
+    """
+
+    def __init__(self, retry_after: float = 1.0):
+        super().__init__(retry_after, "Quota exceeded")
+
+class TokenBucket:
+    """
+    A token bucket refilled at `rate` per second up to `capacity`.
+
+    `reserve` takes tokens whether or not they are there: the level may go
+    negative, and the returned delay is how long the bucket needs to pay
+    that debt back. Callers wait out the delay before they proceed.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self._level = capacity
+        self._updated = clock()
+
+    @property
+    def level(self) -> float:
+        now = self.clock()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+        return self._level
+
+    @property
+    def full(self) -> bool:
+        return self.level >= self.capacity
+
+    def delay(self, amount: float) -> float:
+        """
+        Seconds until `amount` tokens are available.
+        """
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def reserve(self, amount: float) -> float:
+        self._level = self.level - amount
+        return max(0.0, -self._level / self.rate)
+
+    def refund(self, amount: float) -> None:
+        """
+        Give back tokens (or take more with a negative `amount`), e.g. once
+        the actual cost of a call is known.
+        """
+        self._level = min(self.capacity, self.level + amount)
+
+def per_minute_bucket(per_minute: float | None, clock: Callable[[], float]) -> TokenBucket | None:
+    # A minute's allowance may be spent at once
+    return TokenBucket(per_minute / 60, per_minute, clock) if per_minute else None
+
+@dataclass
+class UserState:
+    weight: float
+    requests: TokenBucket | None
+    tokens: TokenBucket | None
+    # Virtual time at which the user's last queued call finishes
+    finish: float = 0.0
+    active: int = 0
+
+    def idle(self, virtual_time: float) -> bool:
+        # Nothing a fresh state would not have, so it can be dropped
+        return (
+            not self.active and self.finish <= virtual_time
+            and (self.requests is None or self.requests.full)
+            and (self.tokens is None or self.tokens.full))
+
+@dataclass
+class Ticket:
+    """
+    A call admitted by `FairScheduler.slot`. Set `used_tokens` to the
+    tokens the call actually used, so the quotas are charged for them
+    instead of the estimate.
+    """
+    user: Hashable
+    cost: float
+    start: float
+    finish: float
+    eligible_at: float
+    future: asyncio.Future = field(repr=False)
+    seq: int = 0
+    used_tokens: int | None = None
+
+class FairScheduler:
+    """
+    Admit LLM calls fairly between users, within per-user quotas and a
+    global token budget.
+
+    - At most `max_concurrent` calls run at once; when slots and budget are
+      short, waiting calls are started in weighted fair queuing order: each
+      call is tagged with the virtual time at which it would finish if every
+      waiting user got a share of the LLM in proportion to their weight, and
+      the smallest tag goes first. A user sending many calls only delays
+      their own.
+    - Per user, token buckets cap the requests and LLM tokens per minute. A
+      call over quota waits until the user's buckets have refilled.
+    - A global token bucket matches the provider's tokens-per-minute limit.
+    - A call is charged `expected_tokens` up front; `Ticket.used_tokens`
+      corrects the charge once its usage is known.
+
+    Calls are rejected right away with `CapacityExceeded` (or
+    `QuotaExceeded` for a user's own quota) when `max_waiting` calls are
+    already waiting or their expected wait exceeds `timeout` seconds, and
+    after waiting `timeout` seconds without a slot. The exception's
+    `retry_after` is the expected wait.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_waiting: int,
+        timeout: float,
+        user_requests_per_minute: float | None = None,
+        user_tokens_per_minute: float | None = None,
+        tokens_per_minute: float | None = None,
+        expected_tokens: int = 2000,
+        weights: dict | None = None,
+        max_users: int = 1024,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.user_requests_per_minute = user_requests_per_minute
+        self.user_tokens_per_minute = user_tokens_per_minute
+        self.expected_tokens = expected_tokens
+        self.weights = weights or {}
+        self.max_users = max_users
+        self.clock = clock
+        self.budget = per_minute_bucket(tokens_per_minute, clock)
+        self.users: dict[Hashable, UserState] = {}
+        self.waiters: list[Ticket] = []
+        self.virtual_time = 0.0
+        # Moving average of how long a call holds its slot
+        self.service_time = 0.0
+        self.in_flight = 0
+        self.rejected = 0
+        self._seq = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+
+    @property
+    def waiting(self) -> int:
+        return len(self.waiters)
+
+    def stats(self) -> dict:
+        stats = {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "users_waiting": len({ticket.user for ticket in self.waiters}),
+            "service_seconds": self.service_time,
+        }
+        if self.budget is not None:
+            stats["budget_tokens"] = self.budget.level
+        return stats
+
+    def _user(self, user: Hashable) -> UserState:
+        state = self.users.get(user)
+        if state is None:
+            if len(self.users) >= self.max_users:
+                self.users = {k: v for k, v in self.users.items() if not v.idle(self.virtual_time)}
+            state = self.users[user] = UserState(
+                weight=self.weights.get(user, 1.0),
+                requests=per_minute_bucket(self.user_requests_per_minute, self.clock),
+                tokens=per_minute_bucket(self.user_tokens_per_minute, self.clock))
+        return state
+
+    def _reject(self, reason: str, retry_after: float, quota: bool = False) -> CapacityExceeded:
+        self.rejected += 1
+        SCHEDULER_REJECTIONS.inc(reason=reason)
+        retry_after = max(1.0, retry_after)
+        return QuotaExceeded(retry_after) if quota else CapacityExceeded(retry_after)
+
+    def _expected_wait(self, ticket: Ticket) -> float:
+        """
+        Seconds until `ticket` could start behind the calls queued ahead of it.
+        """
+        ahead = [other for other in self.waiters if other.finish <= ticket.finish]
+        wait = max(0.0, ticket.eligible_at - self.clock())
+        if self.budget is not None:
+            wait = max(wait, self.budget.delay(sum(other.cost for other in ahead) + ticket.cost))
+        rounds = math.ceil((len(ahead) + 1 - (self.max_concurrent - self.in_flight)) / self.max_concurrent)
+        return max(wait, rounds * self.service_time)
+
+    def _refund(self, ticket: Ticket, amount: float, requests: int = 0) -> None:
+        state = self.users.get(ticket.user)
+        if state is not None:
+            if state.tokens is not None:
+                state.tokens.refund(amount)
+            if state.requests is not None and requests:
+                state.requests.refund(requests)
+
+    def _dispatch(self) -> None:
+        """
+        Start waiting calls, smallest finish tag first, while slots and
+        budget allow; otherwise wake up again once they may.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self.waiters and self.in_flight < self.max_concurrent:
+            now = self.clock()
+            eligible = [ticket for ticket in self.waiters if ticket.eligible_at <= now]
+            wake_in = None
+            if eligible:
+                ticket = min(eligible, key=lambda t: (t.finish, t.seq))
+                if self.budget is not None:
+                    # Calls bigger than the whole budget go once it is full
+                    wake_in = self.budget.delay(min(ticket.cost, self.budget.capacity)) or None
+            else:
+                wake_in = min(ticket.eligible_at for ticket in self.waiters) - now
+            if wake_in is not None:
+                self._timer = asyncio.get_running_loop().call_later(wake_in, self._dispatch)
+                return
+            if self.budget is not None:
+                self.budget.reserve(ticket.cost)
+            self.waiters.remove(ticket)
+            self.virtual_time = max(self.virtual_time, ticket.start)
+            self.in_flight += 1
+            ticket.future.set_result(None)
+
+    def _release(self, ticket: Ticket, held: float | None) -> None:
+        self.in_flight -= 1
+        self.users[ticket.user].active -= 1
+        if held is not None:
+            self.service_time = held if not self.service_time else 0.8 * self.service_time + 0.2 * held
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, user: Hashable = None, tokens: int | None = None):
+        """
+        Wait for a slot for a call of `user` expected to use `tokens` LLM
+        tokens (`expected_tokens` by default) and yield its `Ticket`.
+        """
+        cost = tokens or self.expected_tokens
+        if self.waiting >= self.max_waiting and self.in_flight >= self.max_concurrent:
+            raise self._reject("queue_full", self.timeout)
+
+        state = self._user(user)
+        delay = 0.0
+        if state.requests is not None:
+            delay = state.requests.reserve(1)
+        if state.tokens is not None:
+            delay = max(delay, state.tokens.reserve(cost))
+        now = self.clock()
+        start = max(self.virtual_time, state.finish)
+        ticket = Ticket(
+            user, cost, start, start + cost / state.weight, now + delay,
+            asyncio.get_running_loop().create_future(), next(self._seq))
+        if delay > self.timeout:
+            self._refund(ticket, cost, requests=1)
+            raise self._reject("user_quota", delay, quota=True)
+        expected = self._expected_wait(ticket)
+        if expected > self.timeout:
+            self._refund(ticket, cost, requests=1)
+            raise self._reject("budget" if self.budget is not None else "expected_wait", expected)
+
+        state.finish = ticket.finish
+        state.active += 1
+        self.waiters.append(ticket)
+        self._dispatch()
+        try:
+            done, _ = await asyncio.wait([ticket.future], timeout=self.timeout)
+        except asyncio.CancelledError:
+            self._abandon(ticket)
+            raise
+        if not done:
+            self._abandon(ticket)
+            raise self._reject("timeout", self.timeout)
+        started = self.clock()
+        SCHEDULER_WAIT.observe(started - now)
+
+        held = None
+        try:
+            yield ticket
+            held = self.clock() - started
+        finally:
+            if ticket.used_tokens is not None:
+                self._refund(ticket, cost - ticket.used_tokens)
+                if self.budget is not None:
+                    self.budget.refund(cost - ticket.used_tokens)
+            self._release(ticket, held)
+
+    def _abandon(self, ticket: Ticket) -> None:
+        """
+        Give up a ticket whose caller stopped waiting for it.
+        """
+        self._refund(ticket, ticket.cost, requests=1)
+        if ticket.future.done():
+            # Started just as its caller went away
+            if self.budget is not None:
+                self.budget.refund(ticket.cost)
+            self._release(ticket, None)
+        else:
+            self.waiters.remove(ticket)
+            self.users[ticket.user].active -= 1
+            self._dispatch()
@@ -0,0 +1,234 @@
+# context.py
+import logging
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+import numpy as np
+from langchain_core.documents import Document
+from typing_extensions import Callable, List, Tuple
+from .ingest import estimate_tokens
+from .lexical import tokenize
+
+SENTENCE_RE = re.compile(r"(?<=[.!?;])\s+")
+SEPARATOR = "\n\n"
+
+logger = logging.getLogger(__name__)
+
+@lru_cache
+def get_token_counter(model: str | None = None) -> Callable[[str], int]:
+    """
+    Count tokens with the tiktoken encoding of `model` (o200k_base for unknown
+    models). Falls back to the four-characters-per-token estimate when
+    tiktoken or its encoding files are not available, e.g. offline.
+    """
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model or "")
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+    except Exception:
+        logger.warning("tiktoken encoding unavailable, estimating token counts")
+        return estimate_tokens
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+def covered_ids(doc: Document) -> List[str]:
+    """
+    Ids of the chunks `doc` was taken from: several for merged chunks.
+    """
+    if "chunk_ids" in doc.metadata:
+        return list(doc.metadata["chunk_ids"])
+    return [doc.id] if doc.id is not None else []
+
+def merge_overlapping(docs: List[Document]) -> List[Document]:
+    """
+    Merge chunks of the same source whose `start_index`/`end_index` ranges
+    overlap or touch, so text shared by overlapping chunks is sent once.
+    Merged chunks take the place of the best ranked one and list the ids of
+    the chunks they cover, in text order, under "chunk_ids".
+    """
+    merged: List[Document] = []
+    spans: List[Tuple[str, int, int] | None] = []
+    for doc in docs:
+        start, end = doc.metadata.get("start_index"), doc.metadata.get("end_index")
+        source = doc.metadata.get("source", doc.metadata.get("corpus"))
+        if start is None or end is None:
+            merged.append(doc)
+            spans.append(None)
+            continue
+        for i, span in enumerate(spans):
+            if span is None or span[0] != source or start > span[2] or end < span[1]:
+                continue
+            other = merged[i]
+            first, second = (other, doc) if span[1] <= start else (doc, other)
+            first_end = first.metadata["end_index"]
+            second_start = second.metadata["start_index"]
+            text = first.page_content + second.page_content[max(0, first_end - second_start):]
+            new_start, new_end = min(span[1], start), max(span[2], end)
+            ids = [id for part in (first, second) for id in covered_ids(part)]
+            merged[i] = Document(
+                id=other.id,
+                page_content=text,
+                metadata={**first.metadata, "start_index": new_start, "end_index": new_end,
+                          "chunk_ids": list(dict.fromkeys(ids))})
+            spans[i] = (source, new_start, new_end)
+            break
+        else:
+            merged.append(doc)
+            spans.append((source, start, end))
+    return merged
+
+def trim_sentences(question: str, text: str) -> str:
+    """
+    Keep the sentences that share a term with the question. Text with no
+    such sentence is kept whole.
+    """
+    terms = set(tokenize(question))
+    sentences = SENTENCE_RE.split(text)
+    kept = [s for s in sentences if terms & set(tokenize(s))]
+    return " ".join(kept) if kept else text
+
+def truncate_to_tokens(text: str, max_tokens: int, count_tokens: Callable[[str], int]) -> str:
+    """
+    The leading whole sentences of `text` that fit in `max_tokens`.
+    """
+    kept: List[str] = []
+    for sentence in SENTENCE_RE.split(text):
+        if count_tokens(" ".join(kept + [sentence])) > max_tokens:
+            break
+        kept.append(sentence)
+    return " ".join(kept)
+
+@dataclass
+class AssemblyReport:
+    candidates: int
+    chunks: int
+    baseline_tokens: int
+    context_tokens: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return max(0, self.baseline_tokens - self.context_tokens)
+
+class ContextAssembler:
+    """
+    Turn retrieved candidates into the context passed to the model.
+
+    1. Adaptive k: candidates are picked by maximal marginal relevance
+       (`mmr_lambda`) and any candidate whose similarity to the question is
+       more than `similarity_margin` below the best one is dropped, as is
+       any with a similarity of `max_redundancy` or more to a chunk already
+       picked. Up to `max_chunks` chunks are used, fewer when the rest is
+       weak or redundant. Needs the vectors of the question and the
+       candidates; without them the retrieval ranking is kept.
+    2. Overlapping chunks of the same source are merged.
+    3. Optionally, only the sentences sharing a term with the question are kept.
+    4. Chunks are added in order until `max_tokens`; the first one that does
+       not fit is cut to its leading sentences.
+
+    The report compares the result with the previous behaviour: the first
+    `max_chunks` candidates joined verbatim.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int] = estimate_tokens,
+        max_chunks: int = 3,
+        max_tokens: int = 1500,
+        mmr_lambda: float = 0.7,
+        similarity_margin: float | None = 0.15,
+        max_redundancy: float = 0.95,
+        trim: bool = False,
+    ):
+        self.count_tokens = count_tokens
+        self.max_chunks = max_chunks
+        self.max_tokens = max_tokens
+        self.mmr_lambda = mmr_lambda
+        self.similarity_margin = similarity_margin
+        self.max_redundancy = max_redundancy
+        self.trim = trim
+        self.tokens_saved = 0
+        self.answers = 0
+
+    def stats(self) -> dict:
+        return {
+            "answers": self.answers,
+            "tokens_saved": self.tokens_saved,
+            "mean_tokens_saved": self.tokens_saved / self.answers if self.answers else 0.0,
+        }
+
+    def select(self, query: List[float], vectors: List[List[float]], docs: List[Document]) -> List[Document]:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True).clip(min=1e-12)
+        query = np.asarray(query, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        relevance = matrix @ query
+        eligible = list(range(len(docs)))
+        if self.similarity_margin is not None:
+            eligible = [i for i in eligible if relevance[i] >= relevance.max() - self.similarity_margin]
+        selected: List[int] = []
+        while eligible and len(selected) < self.max_chunks:
+            if selected:
+                redundancy = (matrix[eligible] @ matrix[selected].T).max(axis=1)
+                # Near-duplicates of a chunk already selected add nothing
+                keep = redundancy < self.max_redundancy
+                eligible = [i for i, k in zip(eligible, keep) if k]
+                redundancy = redundancy[keep]
+                if not eligible:
+                    break
+            else:
+                redundancy = np.zeros(len(eligible))
+            scores = self.mmr_lambda * relevance[eligible] - (1 - self.mmr_lambda) * redundancy
+            selected.append(eligible.pop(int(np.argmax(scores))))
+        # Keep the retrieval order, merging relies on it for ties
+        return [docs[i] for i in sorted(selected)]
+
+    def _join(self, docs: List[Document]) -> str:
+        return SEPARATOR.join(doc.page_content for doc in docs)
+
+    def _finish(self, question: str, candidates: List[Document], docs: List[Document]) -> Tuple[List[Document], AssemblyReport]:
+        docs = merge_overlapping(docs)
+        if self.trim:
+            docs = [
+                Document(id=doc.id, page_content=trim_sentences(question, doc.page_content), metadata=doc.metadata)
+                for doc in docs
+            ]
+
+        context: List[Document] = []
+        for doc in docs:
+            remaining = self.max_tokens - self.count_tokens(self._join(context + [doc]))
+            if remaining >= 0:
+                context.append(doc)
+                continue
+            budget = self.max_tokens - self.count_tokens(self._join(context + [Document(page_content="")]))
+            text = truncate_to_tokens(doc.page_content, budget, self.count_tokens)
+            if text:
+                context.append(Document(id=doc.id, page_content=text, metadata=doc.metadata))
+            break
+
+        report = AssemblyReport(
+            candidates=len(candidates),
+            chunks=len(context),
+            baseline_tokens=self.count_tokens(self._join(candidates[:self.max_chunks])) if candidates else 0,
+            context_tokens=self.count_tokens(self._join(context)) if context else 0,
+        )
+        self.answers += 1
+        self.tokens_saved += report.tokens_saved
+        return context, report
+
+    def assemble(
+        self,
+        question: str,
+        candidates: List[Document],
+        query: List[float] | None = None,
+        vectors: List[List[float]] | None = None,
+    ) -> Tuple[List[Document], AssemblyReport]:
+        """
+        Assemble the context for `question` from `candidates`, given the
+        `query` vector of the question and the stored `vectors` of the
+        candidates when there are any.
+        """
+        docs = candidates[:self.max_chunks]
+        if query is not None and vectors is not None and len(candidates) > 1:
+            docs = self.select(query, vectors, candidates)
+        return self._finish(question, candidates, docs)
@@ -0,0 +1,171 @@
+# conversation.py
+import math
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.prompts import BasePromptTemplate
+from typing_extensions import Callable, List, Tuple
+from .ingest import estimate_tokens
+from .prompts import CONDENSE_PROMPT
+
+@dataclass
+class Turn:
+    question: str
+    answer: str
+    context: List[Document] = field(default_factory=list)
+    # Embedding of the standalone question and the retrieval scope,
+    # only known for turns answered by this process
+    embedding: np.ndarray | None = None
+    scope: tuple | None = None
+
+def retrieval_scope(corpora: List[str] | None, filter: dict | None) -> tuple:
+    return (tuple(sorted(corpora or ())), tuple(sorted((filter or {}).items())))
+
+def format_history(history: List[Tuple[str, str]]) -> str:
+    return "\n".join(f"Human: {question}\nAssistant: {answer}" for question, answer in history)
+
+class ConversationWindow:
+    """
+    The most recent turns of one conversation.
+    """
+
+    def __init__(self, turns: List[Turn], max_turns: int):
+        self.turns: deque[Turn] = deque(turns, maxlen=max_turns)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def history(
+        self,
+        max_tokens: int,
+        count_tokens: Callable[[str], int] = estimate_tokens
+    ) -> List[Tuple[str, str]]:
+        """
+        The latest (question, answer) pairs that fit in `max_tokens`, oldest first.
+        """
+        history, used = [], 0
+        with self._lock:
+            turns = list(self.turns)
+        for turn in reversed(turns):
+            used += count_tokens(turn.question) + count_tokens(turn.answer)
+            if used > max_tokens:
+                break
+            history.append((turn.question, turn.answer))
+        return history[::-1]
+
+    def similar_turn(self, embedding: List[float], scope: tuple, threshold: float) -> Turn | None:
+        """
+        The most similar earlier turn with the same retrieval scope whose
+        standalone question has a cosine similarity of at least `threshold`.
+        """
+        with self._lock:
+            candidates = [t for t in self.turns if t.embedding is not None and t.scope == scope and t.context]
+        if not candidates:
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        matrix = np.stack([t.embedding for t in candidates])
+        similarities = matrix @ query
+        best = int(np.argmax(similarities))
+        return candidates[best] if similarities[best] >= threshold else None
+
+    def add(self, turn: Turn) -> None:
+        if turn.embedding is not None:
+            embedding = np.asarray(turn.embedding, dtype=np.float32)
+            turn.embedding = embedding / (np.linalg.norm(embedding) or 1.0)
+        with self._lock:
+            self.turns.append(turn)
+
+class ConversationWindows:
+    """
+    In-process LRU cache of conversation windows.
+
+    A window is loaded from the last `max_messages` messages of the
+    conversation on first use and then kept up to date by the engine, and
+    by `append` for turns saved outside conversation mode, so later turns
+    need no query. Windows are per process: a conversation
+    continued on another worker is loaded there from the database.
+    """
+
+    def __init__(self, max_messages: int = 10, max_conversations: int = 1024):
+        self.max_messages = max_messages
+        self.max_turns = max(1, math.ceil(max_messages / 2))
+        self.max_conversations = max_conversations
+        self.hits = 0
+        self.misses = 0
+        self.retrievals = 0
+        self.context_reuses = 0
+        self._windows: OrderedDict[int, ConversationWindow] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id: int, load: Callable[[int], list]) -> ConversationWindow:
+        """
+        The window of a conversation. `load(limit)` returns the latest `limit`
+        messages (objects with `message` and `is_human_message`), oldest first.
+        """
+        with self._lock:
+            window = self._windows.get(conversation_id)
+            if window is not None:
+                self._windows.move_to_end(conversation_id)
+                self.hits += 1
+                return window
+            self.misses += 1
+
+        turns, question = [], None
+        for message in load(self.max_messages):
+            if message.is_human_message:
+                question = message.message
+            elif question is not None:
+                turns.append(Turn(question, message.message))
+                question = None
+        window = ConversationWindow(turns, self.max_turns)
+
+        with self._lock:
+            # Another request may have loaded the same window meanwhile
+            window = self._windows.setdefault(conversation_id, window)
+            self._windows.move_to_end(conversation_id)
+            while len(self._windows) > self.max_conversations:
+                self._windows.popitem(last=False)
+        return window
+
+    def append(self, conversation_id: int, turns: List[Tuple[str, str]]) -> None:
+        """
+        Add (question, answer) turns saved to a conversation to its window,
+        when it is cached; an uncached window is loaded with them later.
+        """
+        with self._lock:
+            window = self._windows.get(conversation_id)
+        if window is not None:
+            for question, answer in turns:
+                window.add(Turn(question, answer))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        answered = self.retrievals + self.context_reuses
+        return {
+            "conversations": len(self._windows),
+            "window_hits": self.hits,
+            "window_misses": self.misses,
+            "window_hit_rate": self.hits / lookups if lookups else 0.0,
+            "retrievals": self.retrievals,
+            "context_reuses": self.context_reuses,
+            "context_reuse_rate": self.context_reuses / answered if answered else 0.0,
+        }
+
+async def acondense_question(
+    llm,
+    question: str,
+    history: List[Tuple[str, str]],
+    prompt: BasePromptTemplate = CONDENSE_PROMPT
+) -> str:
+    """
+    Rewrite a follow-up question into a standalone question using the history.
+    """
+    if not history:
+        return question
+    response = await llm.ainvoke(prompt.invoke(
+        {"history": format_history(history), "question": question}))
+    return response.content.strip() or question
@@ -0,0 +1,39 @@
+# corpus.py
+import json
+from dataclasses import dataclass
+from typing_extensions import List
+
+CORPUS_REGISTRY_PATH = "./text/corpora.json"
+
+@dataclass(frozen=True)
+class Corpus:
+    name: str
+    path: str
+    title: str = ""
+    author: str = ""
+
+    @property
+    def collection_name(self) -> str:
+        # Every corpus lives in its own Chroma collection
+        return f"corpus_{self.name}"
+
+class UnknownCorpus(KeyError):
+    """
+    Raised when a request names a corpus that is not in the registry.
+    """
+
+    def __init__(self, names: List[str]):
+        super().__init__(f"Unknown corpus: {', '.join(names)}")
+        self.names = names
+
+def load_registry(path: str = CORPUS_REGISTRY_PATH) -> dict[str, Corpus]:
+    """
+    Load the corpus registry, a JSON object mapping corpus names to
+    {"path": ..., "title": ..., "author": ...}.
+    """
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    return {
+        name: Corpus(name=name, **entry)
+        for name, entry in entries.items()
+    }
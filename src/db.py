@@ -1,15 +1,55 @@
 from datetime import datetime, timezone
 from typing import Annotated, Optional
 from fastapi import Depends, FastAPI, HTTPException, Query
+from sqlalchemy import Index, event, inspect, text
+from sqlalchemy.engine import Engine
 from sqlmodel import Field, Session, SQLModel, Relationship, create_engine, select
+from .config import Settings, get_settings
 
-DATABASE_URL = "sqlite:///./database.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+def create_db_engine(settings: Settings) -> Engine:
+    """
+    Create the engine for `settings.database_url`.
+
+    SQLite connections are switched to WAL with synchronous=NORMAL on
+    connect, so readers do not block the writer and a commit needs no fsync
+    of the main database file; busy_timeout makes writers from other
+    workers wait for the lock instead of failing. Other databases (e.g.
+    PostgreSQL) get a sized connection pool with pre-ping.
+    """
+    url = settings.database_url
+    if not url.startswith("sqlite"):
+        return create_engine(
+            url,
+            pool_size=settings.database_pool_size,
+            max_overflow=settings.database_max_overflow,
+            pool_timeout=settings.database_pool_timeout,
+            pool_recycle=settings.database_pool_recycle,
+            pool_pre_ping=True,
+        )
+
+    engine = create_engine(url, connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # In-memory databases have no journal file to switch to WAL
+        if engine.url.database not in (None, "", ":memory:"):
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.sqlite_busy_timeout * 1000)}")
+        cursor.execute(f"PRAGMA mmap_size={settings.sqlite_mmap_size}")
+        cursor.close()
+
+    return engine
+
+engine = create_db_engine(get_settings())
 
 class User(SQLModel, table=True):
     id: int = Field(default=None, primary_key=True)
     username: str = Field(index=True, unique=True)
     password: str = Field()
+    # Bumped on every password change, which revokes the tokens issued before
+    password_version: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
     messages: list["Message"] = Relationship(back_populates="user")
     conversations: list["Conversation"] = Relationship(back_populates="user")
 
@@ -23,6 +63,11 @@ class Message(SQLModel, table=True):
     is_human_message: bool = Field(default=True)
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+    __table_args__ = (
+        # Serves a conversation's messages in (timestamp, id) order and keyset pages
+        Index("ix_message_conversation_timestamp_id", "conversation_id", "timestamp", "id"),
+    )
+
 class Conversation(SQLModel, table=True):
     id: int = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.id")
@@ -30,11 +75,32 @@ class Conversation(SQLModel, table=True):
     messages: list[Message] = Relationship(back_populates="conversation")
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+    __table_args__ = (
+        # Serves a user's conversations in (timestamp, id) order, both directions
+        Index("ix_conversation_user_timestamp_id", "user_id", "timestamp", "id"),
+    )
+
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    # create_all skips tables that already exist, so add columns and indexes
+    # introduced later
+    existing = inspect(engine)
+    for table in SQLModel.metadata.sorted_tables:
+        columns = {column["name"] for column in existing.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                column_type = column.type.compile(engine.dialect)
+                default = f" DEFAULT {column.server_default.arg}" if column.server_default is not None else ""
+                with engine.begin() as connection:
+                    connection.execute(text(
+                        f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}{default}'))
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
 def get_session():
-    with Session(engine) as session:
+    # Objects stay loaded after a commit: reading them again would check a
+    # connection out of the pool for the rest of the request
+    with Session(engine, expire_on_commit=False) as session:
         yield session
 
 SessionDep = Annotated[Session, Depends(get_session)]
\ No newline at end of file
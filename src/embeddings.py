@@ -0,0 +1,109 @@
+# embeddings.py
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from typing_extensions import List
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that stores every computed vector on local disk.
+
+    Vectors are keyed by the model name, the embedding dimension and the
+    SHA-256 of the text, so the same text is never embedded twice by the same
+    model, across restarts and across vector stores. Document and query
+    embeddings share the cache, since both providers embed them the same way.
+    """
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        path: str,
+        model: str,
+        dimensions: int | None = None,
+    ):
+        self.underlying = underlying
+        self.model = model
+        self.namespace = f"{model}:{dimensions or 'default'}"
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache (key TEXT PRIMARY KEY, vector BLOB)")
+        self._lock = threading.Lock()
+
+    def _key(self, text: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{self.namespace}:{digest}"
+
+    def _get_many(self, keys: List[str]) -> dict[str, List[float]]:
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # Stay well below SQLite's limit on the number of bound parameters
+        for i in range(0, len(unique_keys), 500):
+            batch = unique_keys[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embedding_cache WHERE key IN ({placeholders})",
+                    batch).fetchall()
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    @staticmethod
+    def _as_float32(missing: List[tuple[str, str]], vectors: List[List[float]]) -> dict[str, List[float]]:
+        # Round fresh vectors the way they are stored, so a text always gets
+        # the same vector whether or not it came from the cache.
+        return {
+            key: np.asarray(vector, dtype=np.float32).tolist()
+            for (key, _), vector in zip(missing, vectors)
+        }
+
+    def _set_many(self, items: dict[str, List[float]]) -> None:
+        rows = [
+            (key, np.asarray(vector, dtype=np.float32).tobytes())
+            for key, vector in items.items()
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (key, vector) VALUES (?, ?)", rows)
+            self._conn.execute("COMMIT")
+
+    def _split(self, texts: List[str]) -> tuple[List[str], dict[str, List[float]], List[str]]:
+        keys = [self._key(text) for text in texts]
+        found = self._get_many(keys)
+        missing = list({key: text for key, text in zip(keys, texts) if key not in found}.items())
+        self.hits += len(texts) - sum(1 for key in keys if key not in found)
+        self.misses += len(missing)
+        return keys, found, missing
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._split(texts)
+        if missing:
+            vectors = self.underlying.embed_documents([text for _, text in missing])
+            computed = self._as_float32(missing, vectors)
+            self._set_many(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        # The cache is read and written in a thread, off the event loop
+        keys, found, missing = await asyncio.to_thread(self._split, texts)
+        if missing:
+            vectors = await self.underlying.aembed_documents([text for _, text in missing])
+            computed = self._as_float32(missing, vectors)
+            await asyncio.to_thread(self._set_many, computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
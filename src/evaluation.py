@@ -0,0 +1,330 @@
+# evaluation.py
+"""
+Offline retrieval evaluation and parameter sweep.
+
+Usage:
+    python -m src.evaluation [--questions text/hume_treatise_eval.json]
+                             [--chunk-sizes 500 1000 1500] [--overlaps 0 200]
+                             [--backends chroma numpy] [--modes dense hybrid lexical]
+                             [--k 1 3 6] [--dim 1024] [--repeat 3]
+                             [--embeddings hashing|configured] [--output report.json]
+
+Every question of the labeled set is paired with a passage of the corpus
+that answers it. For every chunk size and overlap the corpus is indexed
+into a fresh store of every backend (and a BM25 index), and every question
+is asked in every retrieval mode. A retrieved chunk is relevant when it
+covers at least half of the passage (or half of the chunk, for chunks
+shorter than the passage). The report has, per configuration, recall@k,
+MRR, the tokens the top k chunks would add to a prompt, the index size on
+disk, the build time and the query latency.
+
+By default texts are embedded with `HashingEmbeddings`, a deterministic
+bag-of-words embedding that needs no network, so runs are reproducible
+and free; `--embeddings configured` uses the configured embedding service
+instead. Lexical retrieval does not depend on the vector backend and is
+reported once per splitter setting, as backend "bm25".
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import statistics
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from typing_extensions import List
+from .corpus import Corpus, load_registry
+from .ingest import chunk_ids, estimate_tokens, get_text_splitter, ingest, iter_chunks
+from .lexical import BM25Index, tokenize
+from .retrieval import RETRIEVAL_MODES, CorpusRetriever
+from .vectorstore import NumpyVectorStore
+
+EVAL_QUESTIONS_PATH = "./text/hume_treatise_eval.json"
+BACKENDS = ("chroma", "numpy")
+# Share of the passage (or chunk) a chunk must cover to count as relevant
+MIN_OVERLAP = 0.5
+
+class HashingEmbeddings(Embeddings):
+    """
+    Deterministic local embeddings: the words of a text (as BM25 tokenizes
+    them) are hashed into `dimensions` signed buckets, weighted by
+    1 + log(count) and L2-normalized. Texts sharing words end up close,
+    which is enough to compare chunking and backends without an embedding
+    service.
+    """
+
+    def __init__(self, dimensions: int = 1024):
+        self.dimensions = dimensions
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for token, count in Counter(tokenize(text)).items():
+            digest = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+            sign = 1.0 if digest & 1 else -1.0
+            vector[(digest >> 1) % self.dimensions] += sign * (1.0 + math.log(count))
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+@dataclass
+class EvalQuestion:
+    question: str
+    passage: str
+    # Character offsets of the passage in the corpus file
+    start: int
+    end: int
+
+def locate(passage: str, text: str) -> tuple[int, int] | None:
+    """
+    The (start, end) offsets of `passage` in `text`, ignoring differences
+    in whitespace and line breaks, else None.
+    """
+    pattern = r"\s+".join(re.escape(word) for word in passage.split())
+    match = re.search(pattern, text)
+    return match.span() if match else None
+
+def load_questions(path: str, registry: dict[str, Corpus]) -> tuple[Corpus, List[EvalQuestion]]:
+    """
+    Load a labeled question set, a JSON object {"corpus": name, "questions":
+    [{"question": ..., "passage": ...}]}, and locate every passage in the
+    corpus. Raises ValueError when a passage is not in the text.
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    corpus = registry[data["corpus"]]
+    # Read like `iter_chunks` reads it, so offsets match chunk metadata
+    with open(corpus.path, encoding="utf-8") as f:
+        text = f.read()
+    questions = []
+    for item in data["questions"]:
+        span = locate(item["passage"], text)
+        if span is None:
+            raise ValueError(f"Passage not found in {corpus.path}: {item['passage'][:60]!r}")
+        questions.append(EvalQuestion(item["question"], item["passage"], *span))
+    return corpus, questions
+
+def is_relevant(doc: Document, question: EvalQuestion) -> bool:
+    start = doc.metadata.get("start_index", 0)
+    end = start + len(doc.page_content)
+    overlap = min(end, question.end) - max(start, question.start)
+    return overlap >= MIN_OVERLAP * min(question.end - question.start, end - start)
+
+def first_relevant_rank(docs: List[Document], question: EvalQuestion) -> int | None:
+    """
+    The 1-based rank of the first relevant chunk, else None.
+    """
+    for rank, doc in enumerate(docs, start=1):
+        if is_relevant(doc, question):
+            return rank
+    return None
+
+def recall_at_k(ranks: List[int | None], k: int) -> float:
+    return sum(1 for rank in ranks if rank is not None and rank <= k) / len(ranks) if ranks else 0.0
+
+def mean_reciprocal_rank(ranks: List[int | None]) -> float:
+    return sum(1 / rank for rank in ranks if rank is not None) / len(ranks) if ranks else 0.0
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+def directory_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names)
+
+def evaluate(
+    retriever: CorpusRetriever,
+    questions: List[EvalQuestion],
+    ks: List[int],
+    repeat: int = 1,
+) -> dict:
+    """
+    Ask every question `repeat` times (only the first answer is scored) and
+    return the quality and latency metrics of `retriever`.
+    """
+    ranks, timings, tokens = [], [], {k: [] for k in ks}
+    for question in questions:
+        for i in range(repeat):
+            started = time.perf_counter()
+            docs = retriever.search(question.question, k=max(ks))
+            timings.append(time.perf_counter() - started)
+            if i == 0:
+                ranks.append(first_relevant_rank(docs, question))
+                for k in ks:
+                    tokens[k].append(sum(estimate_tokens(doc.page_content) for doc in docs[:k]))
+    ms = [t * 1000 for t in timings]
+    return {
+        "query_p50_ms": percentile(ms, 50),
+        "query_p95_ms": percentile(ms, 95),
+        "mrr": mean_reciprocal_rank(ranks),
+        "recall": {str(k): recall_at_k(ranks, k) for k in ks},
+        "tokens": {str(k): statistics.mean(tokens[k]) for k in ks},
+        "found": sum(rank is not None for rank in ranks),
+    }
+
+def build_indexes(
+    corpus: Corpus,
+    embeddings: Embeddings,
+    chunk_size: int,
+    chunk_overlap: int,
+    backends: List[str],
+    directory: str,
+) -> dict[str, tuple]:
+    """
+    Index `corpus` with one splitter setting into every backend and into
+    BM25, under `directory`. Returns {backend: (store or BM25 index, build
+    seconds, bytes on disk)}; the chunk count is under "chunks".
+    """
+    splitter = get_text_splitter(chunk_size, chunk_overlap)
+    built = {}
+
+    started = time.perf_counter()
+    docs = list(iter_chunks(corpus.path, splitter, metadata={"corpus": corpus.name}))
+    bm25_path = os.path.join(directory, "bm25")
+    BM25Index.build(chunk_ids(docs), [d.page_content for d in docs], [d.metadata for d in docs]).save(bm25_path)
+    built["bm25"] = (BM25Index.load(bm25_path), time.perf_counter() - started, directory_size(bm25_path))
+    built["chunks"] = len(docs)
+
+    if not backends:
+        return built
+    from langchain_chroma import Chroma
+    chroma_path = os.path.join(directory, "chroma")
+    chroma = Chroma(
+        collection_name=corpus.collection_name,
+        embedding_function=embeddings,
+        persist_directory=chroma_path,
+    )
+    report = ingest(chroma, embeddings, corpus, text_splitter=splitter)
+    built["chroma"] = (chroma, report.seconds, directory_size(chroma_path))
+    if "numpy" in backends:
+        started = time.perf_counter()
+        numpy_path = os.path.join(directory, "numpy")
+        NumpyVectorStore.from_chroma(chroma, numpy_path)
+        store = NumpyVectorStore(numpy_path, embeddings)
+        built["numpy"] = (store, report.seconds + time.perf_counter() - started, directory_size(numpy_path))
+    return built
+
+def sweep(
+    corpus: Corpus,
+    questions: List[EvalQuestion],
+    embeddings: Embeddings,
+    chunk_sizes: List[int],
+    overlaps: List[int],
+    backends: List[str] = BACKENDS,
+    modes: List[str] = RETRIEVAL_MODES,
+    ks: List[int] = (1, 3, 6),
+    repeat: int = 1,
+) -> List[dict]:
+    """
+    Evaluate every combination of chunk size, overlap, backend and mode.
+    Overlaps not smaller than the chunk size are skipped.
+    """
+    ks = sorted(ks)
+    dense_modes = [mode for mode in modes if mode != "lexical"]
+    rows = []
+    for chunk_size in chunk_sizes:
+        for chunk_overlap in overlaps:
+            if chunk_overlap >= chunk_size:
+                continue
+            with tempfile.TemporaryDirectory() as directory:
+                built = build_indexes(
+                    corpus, embeddings, chunk_size, chunk_overlap,
+                    backends if dense_modes else [], directory)
+                bm25, bm25_seconds, bm25_bytes = built["bm25"]
+                runs = [("bm25", "lexical")] if "lexical" in modes else []
+                runs += [(backend, mode) for backend in backends for mode in dense_modes]
+                for backend, mode in runs:
+                    # Lexical mode only looks up which corpora there are in the stores
+                    store = None if backend == "bm25" else built[backend][0]
+                    retriever = CorpusRetriever(
+                        embeddings, {corpus.name: store}, k=max(ks),
+                        lexical={corpus.name: bm25} if mode != "dense" else None, mode=mode)
+                    if backend == "bm25":
+                        seconds, size = bm25_seconds, bm25_bytes
+                    else:
+                        seconds, size = built[backend][1], built[backend][2]
+                        if mode == "hybrid":
+                            seconds, size = seconds + bm25_seconds, size + bm25_bytes
+                    rows.append({
+                        "chunk_size": chunk_size,
+                        "chunk_overlap": chunk_overlap,
+                        "backend": backend,
+                        "mode": mode,
+                        "chunks": built["chunks"],
+                        "index_bytes": size,
+                        "build_seconds": seconds,
+                        **evaluate(retriever, questions, ks, repeat),
+                    })
+    return rows
+
+def format_report(rows: List[dict]) -> str:
+    ks = list(rows[0]["recall"]) if rows else []
+    lines = [
+        f"{'size':>5}{'overlap':>8} {'backend':<8}{'mode':<9}{'chunks':>6}{'index MB':>10}"
+        f"{'build s':>9}{'p50 ms':>8}{'p95 ms':>8}{'MRR':>7}"
+        + "".join(f"{'R@' + k:>6}" for k in ks)
+        + (f"{'tok@' + ks[len(ks) // 2]:>7}" if ks else "")
+    ]
+    for row in rows:
+        lines.append(
+            f"{row['chunk_size']:>5}{row['chunk_overlap']:>8} {row['backend']:<8}{row['mode']:<9}"
+            f"{row['chunks']:>6}{row['index_bytes'] / 2**20:>10.1f}{row['build_seconds']:>9.1f}"
+            f"{row['query_p50_ms']:>8.2f}{row['query_p95_ms']:>8.2f}{row['mrr']:>7.3f}"
+            + "".join(f"{row['recall'][k]:>6.3f}" for k in ks)
+            + f"{row['tokens'][ks[len(ks) // 2]]:>7.0f}")
+    return "\n".join(lines)
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Evaluate retrieval over a grid of chunking, backend and mode settings.")
+    parser.add_argument("--questions", default=EVAL_QUESTIONS_PATH)
+    parser.add_argument("--registry", default=None)
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[500, 1000, 1500])
+    parser.add_argument("--overlaps", type=int, nargs="+", default=[0, 200])
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--modes", nargs="+", choices=RETRIEVAL_MODES, default=list(RETRIEVAL_MODES))
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 6])
+    parser.add_argument("--dim", type=int, default=1024, help="dimensions of the hashing embeddings")
+    parser.add_argument("--repeat", type=int, default=3, help="times every question is timed")
+    parser.add_argument("--embeddings", choices=("hashing", "configured"), default="hashing")
+    parser.add_argument("--output", help="also write the report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    registry = load_registry(args.registry) if args.registry else load_registry()
+    corpus, questions = load_questions(args.questions, registry)
+    if args.embeddings == "configured":
+        from .config import get_llm_config
+        embeddings = get_llm_config().get_embeddings()
+    else:
+        embeddings = HashingEmbeddings(args.dim)
+
+    rows = sweep(
+        corpus, questions, embeddings, args.chunk_sizes, args.overlaps,
+        args.backends, args.modes, args.k, args.repeat)
+    print(f"{corpus.name}: {len(questions)} questions, {args.embeddings} embeddings")
+    print(format_report(rows))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "corpus": corpus.name,
+                "questions": len(questions),
+                "embeddings": args.embeddings,
+                "dimensions": args.dim if args.embeddings == "hashing" else None,
+                "results": rows,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+# ingest.py
+"""
+Offline ingestion of the registered corpora into the vector store.
+
+Usage:
+    python -m src.ingest [--corpus NAME ...] [--persist-directory DIR]
+                         [--batch-size N] [--workers N]
+
+With VECTOR_BACKEND=numpy every collection is also exported to the
+memory-mapped index the API serves from.
+
+Every corpus is indexed into its own collection. Chunks are identified by a
+hash of their source and content, so re-running only embeds new or changed
+chunks and deletes chunks that no longer exist.
+
+Texts are split section by section, without the Project Gutenberg header,
+licence and table of contents. The chunks are saved in
+<persist directory>/chunks, keyed by the text's hash and the splitter
+parameters, so re-indexing an unchanged text does not split it again.
+"""
+import argparse
+import glob
+import hashlib
+import itertools
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_text_splitters import RecursiveCharacterTextSplitter, TextSplitter
+from typing_extensions import TYPE_CHECKING, Iterator, List
+from .config import get_llm_config, get_settings
+from .cache import file_fingerprint
+from .corpus import Corpus, load_registry
+from .lexical import BM25Index, lexical_index_path
+from .vectorstore import NumpyVectorStore, numpy_index_path
+
+if TYPE_CHECKING:
+    from langchain_chroma import Chroma
+
+VECTOR_STORE_PATH = "vector_store"
+SEGMENT_SIZE = 64 * 1024
+
+# Headings such as "BOOK II OF THE PASSIONS", "PART I" or "SECT. IV. OF ..."
+HEADING_RE = re.compile(
+    r"^[ \t]*(BOOK|PART|SECT\.|SECTION|CHAPTER)[ \t]+([IVXLC]+|\d+)\b\.?[ \t]*(.*)$",
+    re.MULTILINE,
+)
+# Unnumbered front and back matter, on a line of its own
+MATTER_RE = re.compile(r"^[ \t]*(ADVERTISEMENT|INTRODUCTION|PREFACE|APPENDIX)\.?[ \t]*$")
+HEADING_LEVELS = {
+    "BOOK": "book",
+    "PART": "part",
+    "SECT.": "section",
+    "SECTION": "section",
+    "CHAPTER": "section",
+    "ADVERTISEMENT": "book",
+    "INTRODUCTION": "book",
+    "PREFACE": "book",
+    "APPENDIX": "book",
+}
+# Project Gutenberg header and licence markers and tables of contents
+GUTENBERG_START_RE = re.compile(r"^\*\*\* ?START OF (THE|THIS) PROJECT GUTENBERG")
+GUTENBERG_END_RE = re.compile(r"^\*\*\* ?END OF (THE|THIS) PROJECT GUTENBERG")
+CONTENTS_RE = re.compile(r"^[ \t]*(TABLE OF )?CONTENTS\.?[ \t]*$")
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# Part of the chunk artifact key: bump when `iter_chunks` output changes
+CHUNKER_VERSION = 3
+
+@dataclass
+class IngestReport:
+    corpus: str
+    chunks: int = 0
+    embedded: int = 0
+    unchanged: int = 0
+    deleted: int = 0
+    tokens: int = 0
+    seconds: float = 0.0
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.embedded / self.seconds if self.seconds else 0.0
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.tokens / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.corpus}: {self.chunks} chunks, {self.embedded} embedded, "
+            f"{self.unchanged} unchanged, {self.deleted} deleted in {self.seconds:.2f}s "
+            f"({self.chunks_per_second:.1f} chunks/s, ~{self.tokens_per_second:.0f} tokens/s)"
+        )
+
+def get_text_splitter(chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP) -> TextSplitter:
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True
+    )
+
+def estimate_tokens(text: str) -> int:
+    # About four characters per token for English text
+    return max(1, len(text) // 4)
+
+class SectionTracker:
+    """
+    Keep track of the book, part and section a position in the text is in.
+    """
+
+    def __init__(self):
+        self.current: dict[str, str] = {}
+
+    def update(self, label: str, number: str, title: str) -> None:
+        level = HEADING_LEVELS[label]
+        # A new book starts with no part or section, a new part with no section
+        if level == "book":
+            self.current = {}
+        elif level == "part":
+            self.current.pop("section", None)
+            self.current.pop("section_title", None)
+        self.current[level] = f"{label} {number}".strip()
+        self.current.pop(f"{level}_title", None)
+        if title.strip():
+            self.current[f"{level}_title"] = title.strip()
+
+def match_heading(line: str) -> tuple[str, str, str] | None:
+    """
+    The (label, number, title) of a heading line, else None.
+    """
+    heading = HEADING_RE.match(line)
+    if heading:
+        return heading.groups()
+    matter = MATTER_RE.match(line)
+    if matter:
+        return matter.group(1), "", ""
+    return None
+
+def iter_body(path: str, header_limit: int = SEGMENT_SIZE) -> Iterator[tuple[int, str]]:
+    """
+    Stream the (char offset, line) pairs of a text without its boilerplate:
+    the Project Gutenberg header (when a START marker appears within the
+    first `header_limit` characters), the licence after the END marker and
+    tables of contents, i.e. a CONTENTS line and the blank or indented
+    lines after it.
+    """
+    with open(path, encoding="utf-8") as f:
+        offset, head, size = 0, [], 0
+        for line in f:
+            head.append(line)
+            size += len(line)
+            if GUTENBERG_START_RE.match(line):
+                offset, head = size, []
+                break
+            if size >= header_limit:
+                break
+
+        in_contents = False
+        for line in itertools.chain(head, f):
+            if GUTENBERG_END_RE.match(line):
+                return
+            if CONTENTS_RE.match(line):
+                in_contents = True
+            elif in_contents and line.strip() and not line[0].isspace():
+                in_contents = False
+            if not in_contents:
+                yield offset, line
+            offset += len(line)
+
+def iter_sections(path: str, max_size: int = SEGMENT_SIZE) -> Iterator[tuple[int, str, dict]]:
+    """
+    Stream the (char offset, text, headings) of every section of a text:
+    the text from one heading to the next, starting with its heading line,
+    and the book/part/section it belongs to. Headings with no text of their
+    own (a book heading right before a part heading) are dropped; their
+    titles are in the headings of the next section. Sections longer than
+    `max_size` are cut at a blank line, so memory use stays bounded, and
+    sections are cut where boilerplate was skipped, so the text of a
+    section is always the text of the file at its offset.
+    """
+    tracker = SectionTracker()
+    start, lines, size, has_text = 0, [], 0, False
+    for offset, line in iter_body(path):
+        heading = match_heading(line)
+        skipped = bool(lines) and offset != start + size
+        if heading or skipped or (size >= max_size and not line.strip()):
+            if has_text:
+                yield start, "".join(lines), dict(tracker.current)
+            lines, size, has_text = [], 0, False
+            if heading:
+                tracker.update(*heading)
+        if not lines:
+            start = offset
+        lines.append(line)
+        size += len(line)
+        has_text = has_text or (heading is None and bool(line.strip()))
+    if has_text:
+        yield start, "".join(lines), dict(tracker.current)
+
+def iter_chunks(
+    path: str,
+    text_splitter: TextSplitter,
+    segment_size: int = SEGMENT_SIZE,
+    metadata: dict | None = None,
+) -> Iterator[Document]:
+    """
+    Split a text file into chunks without loading it into memory at once.
+    Boilerplate is skipped and every section is split on its own, so no
+    chunk crosses a heading. Chunk metadata holds the source, the
+    book/part/section (and their titles) the chunk is in and its
+    `start_index`/`end_index` character offsets in the whole file.
+    """
+    base_metadata = {"source": path, **(metadata or {})}
+    for offset, text, headings in iter_sections(path, segment_size):
+        for doc in text_splitter.create_documents([text], [base_metadata]):
+            start = doc.metadata.get("start_index", 0)
+            doc.metadata.update(headings)
+            doc.metadata["start_index"] = offset + start
+            doc.metadata["end_index"] = offset + start + len(doc.page_content)
+            yield doc
+
+def splitter_key(path: str, text_splitter: TextSplitter, metadata: dict | None = None) -> str:
+    """
+    Identify the chunks `iter_chunks` makes of a file: the hash of its
+    content, the splitter and its parameters and the chunker version.
+    """
+    params = {
+        "version": CHUNKER_VERSION,
+        "source": file_fingerprint(path),
+        "path": path,
+        "metadata": metadata or {},
+        "splitter": type(text_splitter).__name__,
+        "chunk_size": getattr(text_splitter, "_chunk_size", None),
+        "chunk_overlap": getattr(text_splitter, "_chunk_overlap", None),
+        "separators": getattr(text_splitter, "_separators", None),
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def chunk_artifact_path(directory: str, name: str, key: str) -> str:
+    return os.path.join(directory, f"{name}-{key}.jsonl")
+
+def load_chunks(
+    corpus: Corpus,
+    text_splitter: TextSplitter,
+    directory: str | None = None,
+) -> List[Document]:
+    """
+    The chunks of a corpus. With a `directory`, they are read from the
+    artifact saved there for the same source content and splitter, or
+    split and saved as one (replacing artifacts of earlier versions), so
+    re-indexing an unchanged corpus never splits it again.
+    """
+    metadata = {"corpus": corpus.name}
+    if directory is None:
+        return list(iter_chunks(corpus.path, text_splitter, metadata=metadata))
+
+    path = chunk_artifact_path(
+        directory, corpus.collection_name, splitter_key(corpus.path, text_splitter, metadata))
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return [Document(**json.loads(line)) for line in f]
+
+    docs = list(iter_chunks(corpus.path, text_splitter, metadata=metadata))
+    os.makedirs(directory, exist_ok=True)
+    for stale in glob.glob(chunk_artifact_path(directory, corpus.collection_name, "*")):
+        os.remove(stale)
+    # Written under another name first, so a crash never leaves a partial artifact
+    partial = f"{path}.partial"
+    with open(partial, "w", encoding="utf-8") as f:
+        for doc in docs:
+            f.write(json.dumps({"page_content": doc.page_content, "metadata": doc.metadata}) + "\n")
+    os.replace(partial, path)
+    return docs
+
+def chunk_artifact_dir(persist_directory: str) -> str:
+    return os.path.join(persist_directory, "chunks")
+
+def chunk_ids(docs: List[Document]) -> List[str]:
+    """
+    Content-addressed chunk ids. Repeated chunks in one source get an
+    occurrence counter, so ids stay unique.
+    """
+    seen: dict[str, int] = {}
+    ids = []
+    for doc in docs:
+        digest = hashlib.sha256(
+            f"{doc.metadata['source']}\0{doc.page_content}".encode("utf-8")).hexdigest()
+        occurrence = seen.get(digest, 0)
+        seen[digest] = occurrence + 1
+        ids.append(f"{digest}-{occurrence}")
+    return ids
+
+def ingest(
+    vector_store: "Chroma",
+    embeddings: Embeddings,
+    corpus: Corpus,
+    batch_size: int = 64,
+    workers: int = 4,
+    text_splitter: TextSplitter | None = None,
+    lexical_index_path: str | None = None,
+    chunk_directory: str | None = None,
+) -> IngestReport:
+    """
+    Incrementally index a corpus into its collection.
+    New chunks are embedded in batches by `workers` concurrent embedding calls
+    and written to the collection in bulk. When `lexical_index_path` is given,
+    a BM25 index over the same chunks is saved there as well. Chunks are
+    cached in `chunk_directory`, see `load_chunks`.
+    """
+    started = time.perf_counter()
+    report = IngestReport(corpus=corpus.name)
+    collection = vector_store._collection
+
+    docs = load_chunks(corpus, text_splitter or get_text_splitter(), chunk_directory)
+    ids = chunk_ids(docs)
+    report.chunks = len(docs)
+
+    existing = set(collection.get(include=[])["ids"])
+    current = set(ids)
+    stale = list(existing - current)
+    for i in range(0, len(stale), batch_size):
+        collection.delete(ids=stale[i:i + batch_size])
+    report.deleted = len(stale)
+
+    # Unchanged chunks keep their vectors; only their offsets may have moved
+    kept = [(id_, doc) for id_, doc in zip(ids, docs) if id_ in existing]
+    for i in range(0, len(kept), batch_size):
+        batch = kept[i:i + batch_size]
+        collection.update(
+            ids=[id_ for id_, _ in batch], metadatas=[doc.metadata for _, doc in batch])
+    report.unchanged = len(kept)
+
+    new = [(id_, doc) for id_, doc in zip(ids, docs) if id_ not in existing]
+    batches = [new[i:i + batch_size] for i in range(0, len(new), batch_size)]
+
+    def embed(batch):
+        return embeddings.embed_documents([doc.page_content for _, doc in batch])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch, vectors in zip(batches, executor.map(embed, batches)):
+            collection.upsert(
+                ids=[id_ for id_, _ in batch],
+                embeddings=vectors,
+                documents=[doc.page_content for _, doc in batch],
+                metadatas=[doc.metadata for _, doc in batch],
+            )
+            report.embedded += len(batch)
+            report.tokens += sum(estimate_tokens(doc.page_content) for _, doc in batch)
+
+    if lexical_index_path:
+        BM25Index.build(
+            ids, [doc.page_content for doc in docs], [doc.metadata for doc in docs]
+        ).save(lexical_index_path)
+
+    report.seconds = time.perf_counter() - started
+    return report
+
+def main(argv: List[str] | None = None) -> None:
+    settings = get_settings()
+    parser = argparse.ArgumentParser(description="Index the registered corpora into the vector store.")
+    parser.add_argument("--corpus", action="append", help="corpus to index (default: all)")
+    parser.add_argument("--registry", default=settings.corpus_registry_path)
+    parser.add_argument("--persist-directory", default=settings.vector_store_path)
+    parser.add_argument("--batch-size", type=int, default=settings.ingest_batch_size)
+    parser.add_argument("--workers", type=int, default=settings.ingest_workers)
+    args = parser.parse_args(argv)
+
+    registry = load_registry(args.registry)
+    unknown = [name for name in args.corpus or [] if name not in registry]
+    if unknown:
+        parser.error(f"unknown corpus: {', '.join(unknown)}")
+
+    from langchain_chroma import Chroma
+    embeddings = get_llm_config().get_embeddings()
+    for name in args.corpus or registry:
+        corpus = registry[name]
+        vector_store = Chroma(
+            collection_name=corpus.collection_name,
+            embedding_function=embeddings,
+            persist_directory=args.persist_directory,
+        )
+        report = ingest(
+            vector_store, embeddings, corpus,
+            batch_size=args.batch_size, workers=args.workers,
+            lexical_index_path=lexical_index_path(args.persist_directory, corpus.collection_name),
+            chunk_directory=chunk_artifact_dir(args.persist_directory),
+        )
+        print(report)
+        if settings.vector_backend == "numpy":
+            path = numpy_index_path(args.persist_directory, corpus.collection_name)
+            numpy_store = NumpyVectorStore.from_chroma(
+                vector_store, path, settings.vector_index_dtype)
+            print(f"{corpus.name}: exported {len(numpy_store)} vectors to {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# lexical.py
+import json
+import math
+import os
+import re
+import uuid
+from collections import Counter
+import numpy as np
+from langchain_core.documents import Document
+from typing_extensions import List, Tuple
+from .vectorstore import _matches
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have he his i in is it its of on or "
+    "that the their them they this to was were which with".split()
+)
+ARRAY_FILES = ("offsets", "postings", "frequencies", "lengths")
+CHUNKS_FILE = "chunks.json"
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+def lexical_index_path(persist_directory: str, collection_name: str) -> str:
+    return os.path.join(persist_directory, "bm25", collection_name)
+
+class BM25Index:
+    """
+    Okapi BM25 over the chunks of one corpus.
+
+    The inverted index is stored as flat arrays: `offsets[t]:offsets[t + 1]`
+    is the slice of `postings` (chunk numbers) and `frequencies` (term
+    counts) for the t-th vocabulary term. The arrays are saved as `.npy`
+    files and memory-mapped on load; the vocabulary and chunk texts are in
+    a JSON side file.
+    """
+
+    def __init__(
+        self,
+        vocabulary: List[str],
+        offsets: np.ndarray,
+        postings: np.ndarray,
+        frequencies: np.ndarray,
+        lengths: np.ndarray,
+        ids: List[str],
+        texts: List[str],
+        metadatas: List[dict],
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        self.terms = {term: i for i, term in enumerate(vocabulary)}
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.postings = postings
+        self.frequencies = frequencies
+        self.lengths = lengths
+        self.ids = ids
+        self.texts = texts
+        self.metadatas = metadatas
+        self.k1 = k1
+        self.b = b
+        self.average_length = float(lengths.mean()) if len(lengths) else 0.0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(
+        cls,
+        ids: List[str],
+        texts: List[str],
+        metadatas: List[dict] | None = None,
+    ) -> "BM25Index":
+        counts = [Counter(tokenize(text)) for text in texts]
+        vocabulary = sorted({term for count in counts for term in count})
+        terms = {term: i for i, term in enumerate(vocabulary)}
+        postings_lists: List[List[Tuple[int, int]]] = [[] for _ in vocabulary]
+        for doc, count in enumerate(counts):
+            for term, frequency in count.items():
+                postings_lists[terms[term]].append((doc, frequency))
+
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(p) for p in postings_lists])
+        postings = np.fromiter(
+            (doc for p in postings_lists for doc, _ in p), dtype=np.int32, count=int(offsets[-1]))
+        frequencies = np.fromiter(
+            (freq for p in postings_lists for _, freq in p), dtype=np.int32, count=int(offsets[-1]))
+        lengths = np.array([sum(count.values()) for count in counts], dtype=np.int32)
+        return cls(
+            vocabulary, offsets, postings, frequencies, lengths,
+            list(ids), list(texts), list(metadatas or [{} for _ in texts]))
+
+    def save(self, path: str) -> None:
+        # Write to temporary files and rename, so readers never see a partial index
+        os.makedirs(path, exist_ok=True)
+        tmp = f".tmp-{uuid.uuid4().hex}"
+        arrays = dict(zip(ARRAY_FILES, (self.offsets, self.postings, self.frequencies, self.lengths)))
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + tmp), array)
+        with open(os.path.join(path, CHUNKS_FILE + tmp), "w", encoding="utf-8") as f:
+            json.dump({
+                "vocabulary": self.vocabulary,
+                "ids": self.ids,
+                "texts": self.texts,
+                "metadatas": self.metadatas,
+            }, f, separators=(",", ":"))
+        for name in arrays:
+            os.replace(os.path.join(path, name + tmp + ".npy"), os.path.join(path, name + ".npy"))
+        os.replace(os.path.join(path, CHUNKS_FILE + tmp), os.path.join(path, CHUNKS_FILE))
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with open(os.path.join(path, CHUNKS_FILE), encoding="utf-8") as f:
+            chunks = json.load(f)
+        arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in ARRAY_FILES]
+        return cls(chunks["vocabulary"], *arrays, chunks["ids"], chunks["texts"], chunks["metadatas"])
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        return os.path.exists(os.path.join(path, CHUNKS_FILE))
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        n = len(self.ids)
+        for term in set(tokenize(query)):
+            t = self.terms.get(term)
+            if t is None:
+                continue
+            start, end = int(self.offsets[t]), int(self.offsets[t + 1])
+            docs = self.postings[start:end]
+            frequencies = self.frequencies[start:end].astype(np.float32)
+            idf = math.log(1 + (n - (end - start) + 0.5) / ((end - start) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[docs] / self.average_length)
+            # A term occurs at most once in a posting list, so plain indexing is safe
+            scores[docs] += idf * frequencies * (self.k1 + 1) / (frequencies + norm)
+        return scores
+
+    def search(self, query: str, k: int = 4, filter: dict | None = None) -> List[Tuple[Document, float]]:
+        """
+        Top-k chunks as (document, BM25 score) pairs, best first.
+        Chunks that share no term with the query are never returned.
+        """
+        scores = self.scores(query)
+        if filter:
+            mask = np.fromiter(
+                (_matches(metadata, filter) for metadata in self.metadatas),
+                dtype=bool, count=len(self.metadatas))
+            scores = np.where(mask, scores, 0.0)
+        k = min(k, int((scores > 0).sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (Document(id=self.ids[i], page_content=self.texts[i], metadata=self.metadatas[i]),
+             float(scores[i]))
+            for i in top
+        ]
+
+def get_lexical_index(vector_store, path: str) -> BM25Index:
+    """
+    Open the BM25 index of a collection, building it from the chunks in the
+    vector store when the ingestion command has not saved one yet.
+    """
+    if BM25Index.exists(path):
+        return BM25Index.load(path)
+    if hasattr(vector_store, "_collection"):
+        data = vector_store._collection.get(include=["documents", "metadatas"])
+        index = BM25Index.build(data["ids"], data["documents"], data["metadatas"])
+    else:
+        index = BM25Index.build(vector_store.ids, vector_store.texts, vector_store.metadatas)
+    if len(index):
+        index.save(path)
+    return index
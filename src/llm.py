@@ -1,79 +1,731 @@
 # llm.py
-from fastapi import Depends
-from langchain_chroma import Chroma
-from langchain_community.document_loaders import TextLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain import hub
+import asyncio
+import hashlib
+import logging
+import threading
+from fastapi import Request
 from langchain_core.documents import Document
-from langgraph.graph import START, StateGraph
-from langgraph.graph.state import CompiledStateGraph
-from typing_extensions import List, TypedDict
-from .config import get_llm_config, LLMConfig
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessageChunk
+from langchain_core.prompts import BasePromptTemplate
+from langchain_core.vectorstores import VectorStore
+from langchain_core.runnables import RunnableLambda
+from typing_extensions import TYPE_CHECKING, AsyncIterator, List, Tuple, TypedDict
+from .cache import CacheEntry, file_fingerprint, get_answer_cache
+from .concurrency import FairScheduler
+from .context import ContextAssembler, get_token_counter
+from .config import LLMConfig
+from .conversation import (
+    ConversationWindow, ConversationWindows, Turn, acondense_question, format_history, retrieval_scope
+)
+from .corpus import Corpus, load_registry
+from .ingest import (
+    VECTOR_STORE_PATH, chunk_artifact_dir, estimate_tokens, get_text_splitter, ingest, iter_chunks,
+)
+from .lexical import get_lexical_index, lexical_index_path
+from .metrics import LLM_TOKENS, timed
+from .prompts import CONVERSATION_RAG_PROMPT, RAG_PROMPT
+from .retrieval import CorpusRetriever
+from .vectorstore import NumpyVectorStore, numpy_index_path
 
-TEXT_FILE_PATH = "./text/hume_treatise.txt"
+if TYPE_CHECKING:
+    from langgraph.graph.state import CompiledStateGraph
+
+logger = logging.getLogger(__name__)
 
 class State(TypedDict):
     question: str
+    corpora: List[str] | None
+    filter: dict | None
+    # Earlier (question, answer) pairs in conversation mode and the question
+    # rewritten to stand on its own, which is what gets retrieved
+    history: List[Tuple[str, str]]
+    standalone_question: str | None
+    # Embedding of the question that is retrieved, computed once and reused
+    # for retrieval, context assembly and the answer cache; None in lexical
+    # mode or when embedding failed. `embedded` is set once it was tried.
+    embedding: List[float] | None
+    embedded: bool
     context: List[Document]
+    # Tokens of the assembled context and tokens saved against sending the
+    # top chunks verbatim
+    context_tokens: int | None
+    tokens_saved: int | None
     answer: str
+    # Prompt and completion tokens of the generation
+    llm_tokens: int | None
+
+def initial_state(
+    question: str,
+    corpora: List[str] | None = None,
+    filter: dict | None = None,
+    history: List[Tuple[str, str]] | None = None
+) -> State:
+    return {
+        "question": question,
+        "corpora": corpora,
+        "filter": filter,
+        "history": history or [],
+        "standalone_question": None,
+        "embedding": None,
+        "embedded": False,
+        "context": [],
+        "context_tokens": None,
+        "tokens_saved": None,
+        "answer": "",
+        "llm_tokens": None
+    }
 
 def load_split_text(text_file_path: str) -> List[Document]:
     """
-    Load and split text documents into overlapping chunks.
+    Split a text file into overlapping chunks, section by section and
+    without its boilerplate.
     """
-    loader = TextLoader(text_file_path, encoding="utf-8")
-    docs = loader.load()
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000, chunk_overlap=200, add_start_index=True
-    )
-    split_docs = text_splitter.split_documents(docs)
-    return split_docs
+    return list(iter_chunks(text_file_path, get_text_splitter()))
 
-def build_graph(vector_store: Chroma, llm) -> CompiledStateGraph:
+def timed_node(stage: str, func, afunc) -> RunnableLambda:
     """
-    Build a state graph for the RAG system.
+    A graph node recording its duration as an observation of `stage`.
     """
-    prompt = hub.pull("rlm/rag-prompt")
+    def run(state: State):
+        with timed(stage):
+            return func(state)
 
+    async def arun(state: State):
+        with timed(stage):
+            return await afunc(state)
+
+    return RunnableLambda(run, afunc=arun)
+
+def build_graph(
+    retriever: CorpusRetriever,
+    llm,
+    prompt: BasePromptTemplate = RAG_PROMPT,
+    conversation_prompt: BasePromptTemplate = CONVERSATION_RAG_PROMPT,
+    assembler: ContextAssembler | None = None
+) -> "CompiledStateGraph":
+    """
+    Build a state graph for the RAG system.
+    Every node has a sync and a native async implementation, so the graph
+    can be run with both `invoke` and `ainvoke`.
+    Context passed in the initial state is reused instead of retrieved, and
+    so is an embedding of the question already computed (`embedded`).
+    With an `assembler`, retrieved candidates are turned into the final
+    context between retrieval and generation, using the question's
+    embedding and the vectors stored with the chunks.
+    """
     def retrieve(state: State):
-        retrieved_docs = vector_store.similarity_search(state["question"], k=3)
-        return {"context": retrieved_docs}
+        if state.get("context"):
+            return {"context": state["context"]}
+        question = state.get("standalone_question") or state["question"]
+        embedding = state.get("embedding")
+        if not state.get("embedded"):
+            embedding = retriever.embed_question(question)
+        retrieved_docs = retriever.search_by_vector(
+            question, embedding, state.get("corpora"), state.get("filter"))
+        return {"context": retrieved_docs, "embedding": embedding, "embedded": True}
 
-    def generate(state: State):
+    async def aretrieve(state: State):
+        if state.get("context"):
+            return {"context": state["context"]}
+        question = state.get("standalone_question") or state["question"]
+        embedding = state.get("embedding")
+        if not state.get("embedded"):
+            embedding = await retriever.aembed_question(question)
+        retrieved_docs = await retriever.asearch_by_vector(
+            question, embedding, state.get("corpora"), state.get("filter"))
+        return {"context": retrieved_docs, "embedding": embedding, "embedded": True}
+
+    def assembled(state: State, vectors: List[List[float]] | None) -> dict:
+        docs, report = assembler.assemble(
+            state.get("standalone_question") or state["question"], state["context"],
+            state.get("embedding"), vectors)
+        return {"context": docs, "context_tokens": report.context_tokens, "tokens_saved": report.tokens_saved}
+
+    def assemble(state: State):
+        if assembler is None:
+            return {"context": state["context"]}
+        vectors = None
+        if state.get("embedding") is not None:
+            vectors = retriever.stored_vectors(state["context"])
+        return assembled(state, vectors)
+
+    async def aassemble(state: State):
+        if assembler is None:
+            return {"context": state["context"]}
+        vectors = None
+        if state.get("embedding") is not None:
+            # A Chroma lookup reads from disk
+            vectors = await asyncio.to_thread(retriever.stored_vectors, state["context"])
+        return assembled(state, vectors)
+
+    def format_messages(state: State):
         docs_content = "\n\n".join(
             doc.page_content for doc in state["context"])
-        messages = prompt.invoke(
+        if state.get("history"):
+            return conversation_prompt.invoke({
+                "history": format_history(state["history"]),
+                "question": state["question"],
+                "context": docs_content})
+        return prompt.invoke(
             {"question": state["question"], "context": docs_content})
+
+    count_tokens = assembler.count_tokens if assembler is not None else estimate_tokens
+
+    def count_usage(messages, response) -> int:
+        usage = getattr(response, "usage_metadata", None) or {}
+        prompt_tokens = usage.get("input_tokens") or count_tokens(messages.to_string())
+        completion_tokens = usage.get("output_tokens") or count_tokens(response.content)
+        LLM_TOKENS.inc(prompt_tokens, kind="prompt")
+        LLM_TOKENS.inc(completion_tokens, kind="completion")
+        return prompt_tokens + completion_tokens
+
+    def generate(state: State):
+        messages = format_messages(state)
         response = llm.invoke(messages)
-        return {"answer": response.content}
+        return {"answer": response.content, "llm_tokens": count_usage(messages, response)}
 
-    graph_builder = StateGraph(State).add_sequence([retrieve, generate])
+    async def agenerate(state: State):
+        messages = format_messages(state)
+        # Streamed, to time the first token; the chunks add up to the response
+        stream = aiter(llm.astream(messages))
+        with timed("ttft"):
+            response = await anext(stream, AIMessageChunk(content=""))
+        async for chunk in stream:
+            response += chunk
+        return {"answer": response.content, "llm_tokens": count_usage(messages, response)}
+
+    from langgraph.graph import START, StateGraph
+    graph_builder = StateGraph(State).add_sequence([
+        ("retrieve", timed_node("retrieve", retrieve, aretrieve)),
+        ("assemble", timed_node("assemble", assemble, aassemble)),
+        ("generate", timed_node("generate", generate, agenerate)),
+    ])
     graph_builder.add_edge(START, "retrieve")
     graph = graph_builder.compile()
     return graph
 
-def get_vector_store(llm_config: LLMConfig = Depends(get_llm_config)) -> Chroma:
+def get_vector_store(
+    embeddings: Embeddings,
+    corpus: Corpus,
+    persist_directory: str = VECTOR_STORE_PATH,
+    ingest_if_empty: bool = False,
+    backend: str = "chroma",
+    index_dtype: str = "float32"
+) -> VectorStore:
     """
-    Get or create the vector store as a dependency.
+    Open the collection of a corpus built by `python -m src.ingest`.
+    An empty collection is only indexed here when `ingest_if_empty` is set.
+
+    With the "numpy" backend the memory-mapped index exported by the
+    ingestion command is opened instead; Chroma is only touched to export
+    the index when it does not exist yet.
     """
-    embeddings = llm_config.get_embeddings()
+    if backend == "numpy":
+        path = numpy_index_path(persist_directory, corpus.collection_name)
+        numpy_store = NumpyVectorStore(path, embeddings, index_dtype)
+        if len(numpy_store):
+            return numpy_store
+        chroma = get_vector_store(embeddings, corpus, persist_directory, ingest_if_empty)
+        return NumpyVectorStore.from_chroma(chroma, path, index_dtype)
+    if backend != "chroma":
+        raise ValueError(f"Unknown vector backend: {backend}")
+
+    from langchain_chroma import Chroma
     vector_store = Chroma(
+        collection_name=corpus.collection_name,
         embedding_function=embeddings,
-        persist_directory="vector_store"
+        persist_directory=persist_directory
     )
-    
-    # Only load documents if the collection is empty
+
     if not vector_store._collection.count():
-        split_docs = load_split_text(TEXT_FILE_PATH)
-        vector_store.add_documents(documents=split_docs)
-        
+        if ingest_if_empty:
+            logger.info(ingest(
+                vector_store, embeddings, corpus,
+                lexical_index_path=lexical_index_path(persist_directory, corpus.collection_name),
+                chunk_directory=chunk_artifact_dir(persist_directory)))
+        else:
+            logger.warning(
+                "Collection %s in %s is empty, run `python -m src.ingest` to build it",
+                corpus.collection_name, persist_directory)
+
     return vector_store
 
-def get_rag_graph(
-    vector_store: Chroma = Depends(get_vector_store),
-    llm_config: LLMConfig = Depends(get_llm_config)
-) -> CompiledStateGraph:
+class RAGEngine:
+    """
+    Process-lifetime RAG engine shared by all requests.
+
+    Owns the embeddings client, one vector store per corpus, chat model,
+    prompt and the compiled graph. Components are built once by `warm_up` and can be
+    rebuilt with `reload` without interrupting requests already in flight.
+    """
+
+    def __init__(
+        self,
+        llm_config: LLMConfig,
+        corpora: dict[str, Corpus] | None = None,
+        persist_directory: str = VECTOR_STORE_PATH,
+        prompt: BasePromptTemplate = RAG_PROMPT,
+    ):
+        self.llm_config = llm_config
+        self.corpora = corpora or load_registry(llm_config.settings.corpus_registry_path)
+        self.persist_directory = persist_directory
+        self.prompt = prompt
+        self.embeddings: Embeddings | None = None
+        self.vector_stores: dict[str, VectorStore] = {}
+        self.retriever: CorpusRetriever | None = None
+        self.llm = None
+        self.assembler: ContextAssembler | None = None
+        self.graph: "CompiledStateGraph | None" = None
+        settings = llm_config.settings
+        self.limiter = FairScheduler(
+            max_concurrent=settings.max_concurrent_llm_calls,
+            max_waiting=settings.max_waiting_llm_calls,
+            timeout=settings.llm_queue_timeout,
+            user_requests_per_minute=settings.user_requests_per_minute,
+            user_tokens_per_minute=settings.user_tokens_per_minute,
+            tokens_per_minute=settings.llm_tokens_per_minute,
+            expected_tokens=settings.llm_expected_tokens,
+            weights=settings.user_weights,
+        )
+        self.cache = get_answer_cache(settings)
+        self.conversations = ConversationWindows(
+            max_messages=settings.conversation_history_messages,
+            max_conversations=settings.conversation_cache_size,
+        )
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.graph is not None
+
+    def _build(self) -> dict:
+        embeddings = self.llm_config.get_embeddings()
+        settings = self.llm_config.settings
+        vector_stores = {
+            name: get_vector_store(
+                embeddings, corpus, self.persist_directory,
+                ingest_if_empty=settings.ingest_on_startup,
+                backend=settings.vector_backend,
+                index_dtype=settings.vector_index_dtype)
+            for name, corpus in self.corpora.items()
+        }
+        lexical = None
+        if settings.retrieval_mode != "dense":
+            lexical = {
+                name: get_lexical_index(
+                    vector_stores[name],
+                    lexical_index_path(self.persist_directory, corpus.collection_name))
+                for name, corpus in self.corpora.items()
+            }
+        retriever = CorpusRetriever(
+            embeddings, vector_stores,
+            k=settings.context_candidates,
+            lexical=lexical,
+            mode=settings.retrieval_mode,
+            candidates=settings.hybrid_candidates,
+            rrf_k=settings.rrf_k,
+            embedding_timeout=settings.embedding_timeout,
+            batch_window=settings.retrieval_batch_window_ms / 1000,
+            max_batch_size=settings.retrieval_max_batch_size)
+        llm = self.llm_config.get_llm()
+        assembler = ContextAssembler(
+            get_token_counter(getattr(llm, "model_name", getattr(llm, "model", None))),
+            max_chunks=settings.context_max_chunks,
+            max_tokens=settings.context_max_tokens,
+            mmr_lambda=settings.context_mmr_lambda,
+            similarity_margin=settings.context_similarity_margin,
+            trim=settings.context_trim_sentences)
+        graph = build_graph(retriever, llm, self.prompt, assembler=assembler)
+        return {
+            "embeddings": embeddings,
+            "vector_stores": vector_stores,
+            "retriever": retriever,
+            "llm": llm,
+            "assembler": assembler,
+            "graph": graph,
+            "fingerprint": self._fingerprint(embeddings, llm),
+        }
+
+    def _fingerprint(self, embeddings: Embeddings, llm) -> str:
+        """
+        Identify the corpus, prompt and models answers are computed from,
+        so cached answers are dropped when any of them changes.
+        """
+        parts = [
+            *(file_fingerprint(corpus.path) for corpus in self.corpora.values()),
+            repr(self.prompt),
+            repr(getattr(embeddings, "model", type(embeddings).__name__)),
+            repr(getattr(llm, "model_name", getattr(llm, "model", type(llm).__name__))),
+        ]
+        return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+    def _swap(self, components: dict) -> None:
+        # Requests read `self.graph` once per call, so assigning the graph last
+        # means none of them ever sees a half-built engine.
+        self.embeddings = components["embeddings"]
+        self.vector_stores = components["vector_stores"]
+        self.retriever = components["retriever"]
+        self.llm = components["llm"]
+        self.assembler = components["assembler"]
+        if self.cache is not None:
+            self.cache.invalidate(components["fingerprint"])
+        self.graph = components["graph"]
+
+    def warm_up(self) -> "RAGEngine":
+        """
+        Build all components if they have not been built yet.
+        """
+        with self._lock:
+            if not self.ready:
+                self._swap(self._build())
+        return self
+
+    def reload(self) -> "RAGEngine":
+        """
+        Rebuild all components (e.g. after re-indexing or a settings change)
+        and swap them in atomically.
+        """
+        with self._lock:
+            self._swap(self._build())
+        return self
+
+    def invoke(
+        self,
+        question: str,
+        corpora: List[str] | None = None,
+        filter: dict | None = None
+    ) -> State:
+        """
+        Run the RAG graph for a single question.
+        """
+        graph = self.graph if self.ready else self.warm_up().graph
+        return graph.invoke(initial_state(question, corpora, filter))
+
+    async def _alookup(self, state: State, scoped: bool = False) -> CacheEntry | None:
+        """
+        Look the question of `state` up in the answer cache. The question is
+        only embedded for a semantic lookup when there is no exact hit; the
+        embedding is kept in the state, so retrieval, context assembly and
+        storing the new answer on a miss reuse it. Questions scoped to some
+        corpora or a filter bypass the cache.
+        """
+        question = state["question"]
+        if self.cache is None or scoped:
+            return None
+        if self.cache.similarity_threshold is None or self.cache.contains(question):
+            return self.cache.lookup(question)
+        if self.retriever.mode == "lexical":
+            # Retrieval does not need the embedding; without it only exact hits count
+            try:
+                state["embedding"] = await self.retriever.aembed(question)
+            except Exception:
+                logger.warning("Embedding failed, looking the answer up by exact match only")
+        else:
+            state["embedding"] = await self.retriever.aembed_question(question)
+        state["embedded"] = True
+        return self.cache.lookup(question, state["embedding"])
+
+    def _store(self, question: str, response: State) -> None:
+        if response.get("corpora") or response.get("filter"):
+            return
+        if self.cache is not None and response.get("answer"):
+            self.cache.store(question, response["answer"], response["context"], response.get("embedding"))
+
+    def get_chunk(self, chunk_id: str) -> Document | None:
+        """
+        The chunk with the given id from any corpus, None when there is none.
+        """
+        vector_stores = self.vector_stores if self.ready else self.warm_up().vector_stores
+        for vector_store in vector_stores.values():
+            docs = vector_store.get_by_ids([chunk_id])
+            if docs:
+                return docs[0]
+        return None
+
+    def stats(self) -> dict[str, dict]:
+        """
+        The `stats()` of every component that keeps them, by component.
+        """
+        stats = {
+            "limiter": self.limiter.stats(),
+            "conversations": self.conversations.stats(),
+        }
+        if self.cache is not None:
+            stats["answer_cache"] = self.cache.stats()
+        if self.assembler is not None:
+            stats["assembler"] = self.assembler.stats()
+        if self.retriever is not None and self.retriever.batcher is not None:
+            stats["retrieval_batcher"] = self.retriever.batcher.stats()
+            stats["embedding_batcher"] = self.retriever.embedding_batcher.stats()
+        if self.retriever is not None:
+            stats["retrieval"] = {"embedding_fallbacks": self.retriever.embedding_fallbacks}
+        if hasattr(self.llm, "stats"):
+            stats["llm_router"] = self.llm.stats()
+        return stats
+
+    def conversation_window(self, conversation_id: int, load) -> ConversationWindow:
+        """
+        The cached window of a conversation, see `ConversationWindows.get`.
+        """
+        return self.conversations.get(conversation_id, load)
+
+    def remember_turns(self, conversation_id: int, turns: List[Tuple[str, str]]) -> None:
+        """
+        Keep the cached window of a conversation up to date with turns
+        answered outside conversation mode, see `ConversationWindows.append`.
+        """
+        self.conversations.append(conversation_id, turns)
+
+    async def _aprepare(self, state: State, window: ConversationWindow | None) -> List[float] | None:
+        """
+        Conversation mode: rewrite a follow-up into a standalone question and
+        reuse the context of an earlier turn that asked much the same thing.
+        Returns the embedding of the standalone question, kept with the turn.
+        """
+        if window is None:
+            return None
+        settings = self.llm_config.settings
+        if state["history"]:
+            with timed("condense"):
+                state["standalone_question"] = await acondense_question(
+                    self.llm, state["question"], state["history"])
+        threshold = settings.conversation_reuse_threshold
+        if threshold is None or self.retriever.mode == "lexical":
+            return None
+        if not state["embedded"]:
+            state["embedding"] = await self.retriever.aembed_question(
+                state["standalone_question"] or state["question"])
+            state["embedded"] = True
+        embedding = state["embedding"]
+        if embedding is None:
+            return None
+        turn = window.similar_turn(
+            embedding, retrieval_scope(state["corpora"], state["filter"]), threshold)
+        if turn is not None:
+            state["context"] = list(turn.context)
+        return embedding
+
+    def _remember(
+        self,
+        window: ConversationWindow | None,
+        response: State,
+        embedding: List[float] | None,
+        reused: bool
+    ) -> None:
+        if window is None or not response.get("answer"):
+            return
+        if reused:
+            self.conversations.context_reuses += 1
+        else:
+            self.conversations.retrievals += 1
+        window.add(Turn(
+            response["question"], response["answer"], response["context"], embedding,
+            retrieval_scope(response.get("corpora"), response.get("filter"))))
+
+    def _history(self, window: ConversationWindow | None) -> List[Tuple[str, str]]:
+        if window is None:
+            return []
+        return window.history(self.llm_config.settings.conversation_history_tokens)
+
+    async def ainvoke(
+        self,
+        question: str,
+        corpora: List[str] | None = None,
+        filter: dict | None = None,
+        window: ConversationWindow | None = None,
+        user: int | None = None
+    ) -> State:
+        """
+        Run the RAG graph for a single question without blocking the event loop.
+        Cached answers are returned without running the graph.
+        With a conversation `window` the question is answered in the context
+        of the earlier turns, which bypasses the answer cache.
+        The call is scheduled fairly with the other calls of `user` and of
+        other users, see `FairScheduler`.
+        Raises `UnknownCorpus` for corpora that are not registered and
+        `CapacityExceeded` (or `QuotaExceeded`) when the call cannot be
+        admitted in time.
+        """
+        graph = self.graph if self.ready else self.warm_up().graph
+        self.retriever.select(corpora)
+        history = self._history(window)
+        state = initial_state(question, corpora, filter, history)
+        cached = await self._alookup(state, bool(corpora or filter or history))
+        if cached is not None:
+            if window is not None:
+                window.add(Turn(question, cached.answer, cached.context))
+            return {**initial_state(question), "context": cached.context, "answer": cached.answer}
+
+        async with self.limiter.slot(user) as ticket:
+            turn_embedding = await self._aprepare(state, window)
+            reused = bool(state["context"])
+            response = await graph.ainvoke(state)
+            ticket.used_tokens = response.get("llm_tokens")
+        if not history:
+            self._store(question, response)
+        self._remember(window, response, turn_embedding, reused)
+        return response
+
+    async def astream(
+        self,
+        question: str,
+        corpora: List[str] | None = None,
+        filter: dict | None = None,
+        window: ConversationWindow | None = None,
+        user: int | None = None
+    ) -> AsyncIterator[Tuple[str, object]]:
+        """
+        Run the RAG graph for a single question, yielding events as they happen:
+        ("context", documents) once the context is assembled, ("usage", counts)
+        with its token counts, ("token", text) for every answer token and
+        ("answer", text) with the full answer at the end.
+        A cached answer is yielded as a single token.
+        Raises `UnknownCorpus` or `CapacityExceeded` on first iteration.
+        The call is scheduled like `ainvoke`.
+        """
+        graph = self.graph if self.ready else self.warm_up().graph
+        self.retriever.select(corpora)
+        history = self._history(window)
+        state = initial_state(question, corpora, filter, history)
+        cached = await self._alookup(state, bool(corpora or filter or history))
+        if cached is not None:
+            if window is not None:
+                window.add(Turn(question, cached.answer, cached.context))
+            yield "context", cached.context
+            yield "token", cached.answer
+            yield "answer", cached.answer
+            return
+
+        response = dict(state)
+        async with self.limiter.slot(user) as ticket:
+            turn_embedding = await self._aprepare(state, window)
+            reused = bool(state["context"])
+            async for mode, chunk in graph.astream(
+                state,
+                stream_mode=["updates", "messages"],
+            ):
+                if mode == "messages":
+                    message, metadata = chunk
+                    if metadata.get("langgraph_node") == "generate" and message.content:
+                        yield "token", message.content
+                elif "retrieve" in chunk:
+                    response.update(chunk["retrieve"])
+                elif "assemble" in chunk:
+                    response.update(chunk["assemble"])
+                    yield "context", response["context"]
+                    if response.get("tokens_saved") is not None:
+                        yield "usage", {
+                            "context_tokens": response["context_tokens"],
+                            "tokens_saved": response["tokens_saved"],
+                        }
+                elif "generate" in chunk:
+                    response["answer"] = chunk["generate"]["answer"]
+                    ticket.used_tokens = chunk["generate"].get("llm_tokens")
+                    yield "answer", response["answer"]
+        if not history:
+            self._store(question, response)
+        self._remember(window, response, turn_embedding, reused)
+
+    async def abatch_as_completed(
+        self,
+        items: List[Tuple[str, List[str] | None, dict | None]],
+        return_exceptions: bool = False,
+        max_concurrency: int | None = None,
+        user: int | None = None
+    ) -> AsyncIterator[Tuple[int, State | Exception]]:
+        """
+        Answer (question, corpora, filter) items, yielding (index, response)
+        pairs as answers complete. All questions are embedded in one call,
+        used both for semantic answer cache lookups and for a single batched
+        retrieval, and at most `max_concurrency` answers are generated at
+        once, each taking a slot of the engine's scheduler for `user`.
+        With `return_exceptions`, a failed answer is yielded as its exception
+        instead of ending the batch.
+        Raises `UnknownCorpus` on first iteration, before any work is done.
+        """
+        graph = self.graph if self.ready else self.warm_up().graph
+        settings = self.llm_config.settings
+        for _, corpora, _ in items:
+            self.retriever.select(corpora)
+        questions = [question for question, _, _ in items]
+
+        vectors = None
+        semantic_cache = self.cache is not None and self.cache.similarity_threshold is not None
+        if items and self.retriever.mode != "lexical":
+            # None in hybrid mode when embedding fails: items go on with lexical retrieval
+            vectors = await self.retriever.aembed_questions(questions)
+        elif items and semantic_cache:
+            try:
+                vectors = await self.retriever.aembed_many(questions)
+            except Exception:
+                logger.warning("Embedding failed, looking answers up by exact match only")
+
+        pending = []
+        for i, (question, corpora, filter) in enumerate(items):
+            cached = None
+            if self.cache is not None and not (corpora or filter):
+                cached = self.cache.lookup(question, vectors[i] if semantic_cache and vectors else None)
+            if cached is not None:
+                yield i, {**initial_state(question), "context": cached.context, "answer": cached.answer}
+            else:
+                pending.append(i)
+        if not pending:
+            return
+
+        contexts = await self.retriever.asearch_many_by_vector(
+            [questions[i] for i in pending],
+            [vectors[i] for i in pending] if vectors is not None else None,
+            [items[i][1] for i in pending],
+            [items[i][2] for i in pending])
+
+        semaphore = asyncio.Semaphore(max_concurrency or settings.batch_max_concurrency)
+
+        async def answer(i: int, context: List[Document]) -> Tuple[int, State | Exception]:
+            question, corpora, filter = items[i]
+            # Retrieved context in the state is used as is by the graph
+            state = {
+                **initial_state(question, corpora, filter), "context": context,
+                "embedding": vectors[i] if vectors is not None else None, "embedded": True,
+            }
+            try:
+                async with semaphore, self.limiter.slot(user) as ticket:
+                    response = await graph.ainvoke(state)
+                    ticket.used_tokens = response.get("llm_tokens")
+            except Exception as exc:
+                if not return_exceptions:
+                    raise
+                return i, exc
+            self._store(question, response)
+            return i, response
+
+        tasks = [asyncio.ensure_future(answer(i, context)) for i, context in zip(pending, contexts)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def abatch(
+        self,
+        items: List[Tuple[str, List[str] | None, dict | None]],
+        return_exceptions: bool = False,
+        max_concurrency: int | None = None,
+        user: int | None = None
+    ) -> List[State | Exception]:
+        """
+        Answer (question, corpora, filter) items, see `abatch_as_completed`.
+        Responses are returned in the order of the items.
+        """
+        responses: List[State | Exception | None] = [None] * len(items)
+        async for i, response in self.abatch_as_completed(items, return_exceptions, max_concurrency, user):
+            responses[i] = response
+        return responses
+
+def get_rag_engine(request: Request) -> RAGEngine:
     """
-    Get the RAG graph as a FastAPI dependency.
+    Get the shared RAG engine created in the app lifespan as a FastAPI dependency.
     """
-    return build_graph(vector_store, llm_config.get_llm())
\ No newline at end of file
+    return request.app.state.rag_engine
@@ -1,16 +1,52 @@
-from fastapi import FastAPI, HTTPException, Depends, APIRouter
+# Imported first, so the startup time includes all other imports
+from .startup import STARTUP
+import orjson
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, APIRouter, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import ValidationError
 from datetime import datetime
 from typing import Annotated
-from sqlmodel import Session, select
-from .llm import get_rag_graph, CompiledStateGraph
-from .models import Question, Answer, Document
-from .db import User, Conversation, Message, create_db_and_tables, get_session
-from .auth import router as auth_router, get_current_user
+from sqlalchemy import tuple_
+from sqlmodel import Session, SQLModel, select
+from .compression import CompressionMiddleware
+from .concurrency import CapacityExceeded, QuotaExceeded
+from .config import get_llm_config, get_settings
+from .conversation import ConversationWindow
+from .corpus import UnknownCorpus
+from .llm import RAGEngine, get_rag_engine
+from .metrics import REGISTRY, MetricsMiddleware, timed
+from .models import Question, Answer, BatchAnswer, ContextReference, Document
+from .db import Conversation, Message, create_db_and_tables, engine as db_engine, get_session
+from .persistence import MessageWriter, get_message_writer
+from .profiling import ProfilerMiddleware
+from .routing import LLMUnavailable
+from .auth import Principal, router as auth_router, get_current_user, is_admin, token_cache
 from fastapi.middleware.cors import CORSMiddleware
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    create_db_and_tables()
+    settings = get_settings()
+    # Build the RAG engine once per process and share it between requests
+    app.state.rag_engine = RAGEngine(
+        get_llm_config(), persist_directory=settings.vector_store_path).warm_up()
+    app.state.message_writer = MessageWriter(
+        lambda: Session(db_engine),
+        durability=settings.message_durability,
+        batch_size=settings.message_batch_size,
+        flush_interval=settings.message_flush_interval,
+        max_queued=settings.message_queue_size,
+    )
+    STARTUP.mark("ready")
+    yield
+    # Flush messages still waiting in the write-behind queue
+    await run_in_threadpool(app.state.message_writer.close)
+
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 app.include_router(auth_router)
 
 origins = [
@@ -23,100 +59,397 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-After"],
 )
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=get_settings().compression_minimum_size,
+    gzip_level=get_settings().compression_gzip_level,
+    brotli_quality=get_settings().compression_brotli_quality,
+)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(ProfilerMiddleware, allowed=is_admin, interval=get_settings().profile_interval)
 
-@app.on_event("startup")
-def on_startup() -> None:
-    create_db_and_tables()
+# Status and message of the errors to retry later, for responses, stream
+# events and batch answers alike
+RETRY_LATER_ERRORS = {
+    CapacityExceeded: (503, "Too many questions in progress, try again later"),
+    QuotaExceeded: (429, "Question quota exceeded, try again later"),
+    LLMUnavailable: (503, "No language model available, try again later"),
+}
+INVALID_RESPONSE = "Invalid response from processing pipeline"
+
+def error_message(exc: BaseException) -> str:
+    for error, (_, message) in RETRY_LATER_ERRORS.items():
+        if isinstance(exc, error):
+            return message
+    return INVALID_RESPONSE
+
+async def retry_later_handler(request: Request, exc: CapacityExceeded | QuotaExceeded | LLMUnavailable) -> JSONResponse:
+    status_code, message = RETRY_LATER_ERRORS[type(exc)]
+    return JSONResponse(
+        status_code=status_code,
+        content={"detail": message},
+        headers={"Retry-After": str(max(1, round(exc.retry_after)))},
+    )
+
+for error in RETRY_LATER_ERRORS:
+    app.add_exception_handler(error, retry_later_handler)
+
+@app.exception_handler(UnknownCorpus)
+async def unknown_corpus_handler(request: Request, exc: UnknownCorpus) -> JSONResponse:
+    return JSONResponse(
+        status_code=400,
+        content={"detail": f"Unknown corpus: {', '.join(exc.names)}"},
+    )
+
+@app.get("/metrics", include_in_schema=False)
+def metrics(
+    engine: Annotated[RAGEngine, Depends(get_rag_engine)],
+    writer: Annotated[MessageWriter, Depends(get_message_writer)]
+) -> PlainTextResponse:
+    """
+    Request and stage latencies, token usage and the counters of the
+    engine, message writer and token cache in the Prometheus text format.
+    """
+    if not get_settings().metrics_enabled:
+        raise HTTPException(status_code=404, detail="Not Found")
+    stats = {
+        **engine.stats(),
+        "message_writer": writer.stats(),
+        "auth_token_cache": token_cache.stats(),
+        "startup": STARTUP.stats(),
+    }
+    return PlainTextResponse(REGISTRY.render(stats), media_type="text/plain; version=0.0.4")
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def keyset_page(
+    db: Session,
+    statement,
+    model: type[SQLModel],
+    after: int | None,
+    limit: int,
+    response: Response
+) -> list:
+    """
+    One page of `statement` in (timestamp, id) order, starting after the row
+    with id `after`, which must be one of the rows of `statement`. Seeks
+    through the composite index instead of skipping rows like OFFSET; when
+    more rows follow, the id to pass as `after` for the next page is sent in
+    the X-Next-After header.
+    """
+    if after is not None:
+        cursor = db.exec(statement.where(model.id == after)).first()
+        if cursor is None:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        statement = statement.where(
+            tuple_(model.timestamp, model.id) > tuple_(cursor.timestamp, cursor.id))
+    rows = db.exec(statement.order_by(model.timestamp, model.id).limit(limit + 1)).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-After"] = str(rows[-1].id)
+    return rows
 
 @app.get("/user/me/conversations/", response_model=list[Conversation])
 def list_conversations(
-    current_user: Annotated[User, Depends(get_current_user)],
-    db: Annotated[Session, Depends(get_session)]
+    current_user: Annotated[Principal, Depends(get_current_user)],
+    db: Annotated[Session, Depends(get_session)],
+    response: Response,
+    after: int | None = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = PAGE_SIZE
 ) -> list[Conversation]:
     """
-    List conversations for the current user.
+    List conversations for the current user, oldest first, one page at a time.
     Requires authentication.
     """
-    statement = db.exec(select(Conversation).where(
-        Conversation.user_id == current_user.id).order_by(Conversation.timestamp, Conversation.id))
-    result = statement.all()
-    return result
+    statement = select(Conversation).where(Conversation.user_id == current_user.id)
+    return keyset_page(db, statement, Conversation, after, limit, response)
 
 @app.get("/conversation/{conversation_id}/messages/", response_model=list[Message])
 def get_conversation(
     conversation_id: int,
-    current_user: Annotated[User, Depends(get_current_user)],
-    db: Annotated[Session, Depends(get_session)]
+    current_user: Annotated[Principal, Depends(get_current_user)],
+    db: Annotated[Session, Depends(get_session)],
+    response: Response,
+    after: int | None = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = PAGE_SIZE
 ) -> list[Message]:
     """
-    Get messages from a conversation.
+    Get messages from a conversation, oldest first, one page at a time.
     Requires authentication.
     """
+    statement = select(Message).where(
+        Message.conversation_id == conversation_id, Message.user_id == current_user.id)
+    return keyset_page(db, statement, Message, after, limit, response)
+
+def get_or_create_conversation(db: Session, user: Principal) -> Conversation:
+    """
+    Get the latest conversation of the user or create a new one.
+    """
+    statement = db.exec(select(Conversation).where(
+        Conversation.user_id == user.id
+    ).order_by(Conversation.timestamp.desc(), Conversation.id.desc()).limit(1))
+    latest_conversation = statement.first()
+
+    if latest_conversation:
+        return latest_conversation
+
+    conversation = Conversation(user_id=user.id)
+    db.add(conversation)
+    db.commit()
+    db.refresh(conversation)
+    return conversation
+
+def recent_messages(db: Session, conversation_id: int, limit: int) -> list[Message]:
+    """
+    The latest `limit` messages of a conversation, oldest first.
+    """
     statement = db.exec(select(Message).where(
-        Message.conversation_id == conversation_id).order_by(Message.timestamp, Message.id))
-    result = statement.all()
-    return result
+        Message.conversation_id == conversation_id
+    ).order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit))
+    return statement.all()[::-1]
+
+async def get_conversation_window(
+    request: Question,
+    db: Session,
+    engine: RAGEngine,
+    conversation: Conversation
+) -> ConversationWindow | None:
+    if not request.conversation:
+        return None
+    return await run_in_threadpool(
+        engine.conversation_window, conversation.id,
+        lambda limit: recent_messages(db, conversation.id, limit))
+
+async def open_conversation(
+    db: Session,
+    user: Principal,
+    engine: RAGEngine,
+    request: Question | None = None
+) -> tuple[int, ConversationWindow | None]:
+    """
+    The id of the conversation a question is added to, and its window when
+    `request` is asked in conversation mode.
+    """
+    with timed("conversation"):
+        conversation = await run_in_threadpool(get_or_create_conversation, db, user)
+        window = await get_conversation_window(request, db, engine, conversation) if request else None
+    # End the read transaction, so the pooled connection is not held while answering
+    db.commit()
+    return conversation.id, window
+
+def sse_event(event: str, data) -> str:
+    """
+    Format a single Server-Sent Event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {orjson.dumps(jsonable_encoder(data)).decode()}\n\n"
+
+def context_references(request: Question, context: list[Document]) -> list[ContextReference]:
+    return [ContextReference.from_document(doc, request.snippet_length) for doc in context]
+
+def answer_context(request: Question, context: list[Document]) -> dict:
+    """
+    The context of an answer in the format the question asked for: full
+    documents, or compact references to chunks served by GET /chunks/{id}.
+    """
+    if request.context_format == "references":
+        return {"references": context_references(request, context)}
+    return {"context": context}
 
 @app.post("/ask/")
 async def ask_question(
     request: Question,
-    current_user: Annotated[User, Depends(get_current_user)],
+    current_user: Annotated[Principal, Depends(get_current_user)],
     db: Annotated[Session, Depends(get_session)],
-    graph: CompiledStateGraph = Depends(get_rag_graph)
+    engine: Annotated[RAGEngine, Depends(get_rag_engine)],
+    writer: Annotated[MessageWriter, Depends(get_message_writer)]
 ) -> Answer:
     """
     Ask a question and get an answer.
     Either creates a new conversation or adds to an existing one.
     Requires authentication.
     """
-    # Get or create conversation
-    statement = db.exec(select(Conversation).where(
-        Conversation.user_id == current_user.id
-    ).order_by(Conversation.timestamp.desc()))
-    latest_conversation = statement.first()
-    
-    if not latest_conversation:
-        conversation = Conversation(user_id=current_user.id)
-        db.add(conversation)
-        db.commit()
-        db.refresh(conversation)
-    else:
-        conversation = latest_conversation
+    conversation_id, window = await open_conversation(db, current_user, engine, request)
     
     # Invoke RAG pipeline
-    response = graph.invoke({
-        "question": request.question,
-        "context": [],
-        "answer": ""
-    })
+    response = await engine.ainvoke(
+        request.question, request.corpora, request.filter, window, user=current_user.id)
     
     if not response or "answer" not in response:
         raise HTTPException(
             status_code=500,
-            detail="Invalid response from processing pipeline"
+            detail=INVALID_RESPONSE
         )
     
-    # Save messages to database
-    question_message = Message(
-        user_id=current_user.id,
-        conversation_id=conversation.id,
-        message=request.question,
-        is_human_message=True
-    )
-    db.add(question_message)
-    
-    answer_message = Message(
-        user_id=current_user.id,
-        conversation_id=conversation.id,
-        message=response["answer"],
-        is_human_message=False
-    )
-    db.add(answer_message)
-    db.commit()
+    await writer.save(current_user.id, conversation_id, request.question, response["answer"])
+    if window is None:
+        engine.remember_turns(conversation_id, [(request.question, response["answer"])])
     
     return Answer(
         question=request.question,
-        context=response.get("context", []),
-        answer=response["answer"]
-    )
\ No newline at end of file
+        **answer_context(request, response.get("context", [])),
+        answer=response["answer"],
+        context_tokens=response.get("context_tokens"),
+        tokens_saved=response.get("tokens_saved")
+    )
+
+@app.post("/ask/stream")
+async def ask_question_stream(
+    request: Question,
+    current_user: Annotated[Principal, Depends(get_current_user)],
+    db: Annotated[Session, Depends(get_session)],
+    engine: Annotated[RAGEngine, Depends(get_rag_engine)],
+    writer: Annotated[MessageWriter, Depends(get_message_writer)]
+) -> StreamingResponse:
+    """
+    Ask a question and stream the answer as Server-Sent Events.
+    Sends a `context` event with the retrieved documents (or their
+    references) as soon as retrieval finishes, a `token` event per answer token and a final `done` event
+    (with the context token counts when the engine reports them).
+    The question and the full answer are saved once streaming completes.
+    Requires authentication.
+    """
+    conversation_id, window = await open_conversation(db, current_user, engine, request)
+    events = engine.astream(
+        request.question, request.corpora, request.filter, window, user=current_user.id)
+
+    # Pull the first event before responding, so that an overloaded engine
+    # still answers with a 503 instead of a broken stream.
+    first_event = await anext(events)
+
+    async def all_events():
+        yield first_event
+        async for item in events:
+            yield item
+
+    async def event_stream():
+        answer_tokens = []
+        answer = None
+        usage = {}
+        try:
+            async for event, data in all_events():
+                if event == "context":
+                    if request.context_format == "references":
+                        data = context_references(request, data)
+                    yield sse_event("context", data)
+                elif event == "token":
+                    answer_tokens.append(data)
+                    yield sse_event("token", {"token": data})
+                elif event == "usage":
+                    usage = data
+                elif event == "answer":
+                    answer = data
+        except Exception as exc:
+            yield sse_event("error", {"detail": error_message(exc)})
+            return
+
+        if answer is None:
+            answer = "".join(answer_tokens)
+        await writer.save(current_user.id, conversation_id, request.question, answer)
+        if window is None:
+            engine.remember_turns(conversation_id, [(request.question, answer)])
+        yield sse_event("done", {
+            "question": request.question,
+            "answer": answer,
+            "conversation_id": conversation_id,
+            **usage
+        })
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+def batch_answer(index: int, request: Question, response) -> BatchAnswer:
+    question = request.question
+    if isinstance(response, Exception):
+        return BatchAnswer(index=index, question=question, error=error_message(response))
+    if not response or "answer" not in response:
+        return BatchAnswer(index=index, question=question, error=INVALID_RESPONSE)
+    return BatchAnswer(
+        index=index,
+        question=question,
+        **answer_context(request, response.get("context", [])),
+        answer=response["answer"],
+        context_tokens=response.get("context_tokens"),
+        tokens_saved=response.get("tokens_saved")
+    )
+
+@app.post("/ask/batch")
+async def ask_questions_batch(
+    questions: list[Question],
+    current_user: Annotated[Principal, Depends(get_current_user)],
+    db: Annotated[Session, Depends(get_session)],
+    engine: Annotated[RAGEngine, Depends(get_rag_engine)],
+    writer: Annotated[MessageWriter, Depends(get_message_writer)],
+    stream: bool = False
+) -> list[BatchAnswer]:
+    """
+    Ask many questions at once and get their answers in order, or with
+    `stream=true` as NDJSON lines in the order they complete. Questions are
+    answered independently (no conversation mode) and a failed answer is
+    reported in its `error` without failing the others. All answered
+    questions are added to the latest conversation in one transaction.
+    Requires authentication.
+    """
+    max_questions = get_settings().batch_max_questions
+    if not questions or len(questions) > max_questions:
+        raise HTTPException(status_code=400, detail=f"Send between 1 and {max_questions} questions")
+    if any(question.conversation for question in questions):
+        raise HTTPException(status_code=400, detail="Conversation mode is not supported in batches")
+
+    conversation_id, _ = await open_conversation(db, current_user, engine)
+
+    items = [(question.question, question.corpora, question.filter) for question in questions]
+    results = engine.abatch_as_completed(items, return_exceptions=True, user=current_user.id)
+    # Pull the first result before responding, so that unknown corpora are
+    # still answered with a 400
+    first = await anext(results, None)
+
+    async def answers():
+        if first is not None:
+            yield batch_answer(first[0], questions[first[0]], first[1])
+        async for index, response in results:
+            yield batch_answer(index, questions[index], response)
+
+    async def save(answered: list[BatchAnswer]) -> None:
+        turns = [(answer.question, answer.answer) for answer in answered if answer.error is None]
+        if turns:
+            await writer.save_many(current_user.id, conversation_id, turns)
+            engine.remember_turns(conversation_id, turns)
+
+    if not stream:
+        answered = sorted([answer async for answer in answers()], key=lambda answer: answer.index)
+        await save(answered)
+        return answered
+
+    async def ndjson_stream():
+        answered = []
+        async for answer in answers():
+            answered.append(answer)
+            yield answer.model_dump_json() + "\n"
+        await save(sorted(answered, key=lambda answer: answer.index))
+
+    return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
+
+@app.get("/chunks/{chunk_id}")
+async def get_chunk(
+    chunk_id: str,
+    request: Request,
+    current_user: Annotated[Principal, Depends(get_current_user)],
+    engine: Annotated[RAGEngine, Depends(get_rag_engine)]
+) -> Document:
+    """
+    Get a chunk referenced by an answer's context. Chunk ids are hashes of
+    their content, so clients may cache chunks for good.
+    Requires authentication.
+    """
+    etag = f'"{chunk_id}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=86400, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    chunk = await run_in_threadpool(engine.get_chunk, chunk_id)
+    if chunk is None:
+        raise HTTPException(status_code=404, detail="Chunk not found")
+    return ORJSONResponse(jsonable_encoder(chunk), headers=headers)
+
+STARTUP.mark("import")
@@ -0,0 +1,251 @@
+# metrics.py
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing_extensions import Iterator, List, Tuple
+
+# Seconds, from a cache hit to a slow generation
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384, 65536, 262144, 1048576)
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + "}"
+
+def format_value(value: float) -> str:
+    value = float(value)
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+class Counter:
+    """
+    A monotonically increasing value per label set.
+    """
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(labels.get(label, "") for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels.get(label, "") for label in self.labels), 0.0)
+
+    def samples(self) -> Iterator[Tuple[str, dict, float]]:
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labels, key)), value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+class Histogram:
+    """
+    Observations counted into cumulative `le` buckets per label set, with
+    their count and sum, as in the Prometheus histogram type.
+    """
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> (per-bucket counts with +Inf last, count, sum)
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(label, "") for label in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        series = self._series.get(tuple(labels.get(label, "") for label in self.labels))
+        return series[1] if series else 0
+
+    def samples(self) -> Iterator[Tuple[str, dict, float]]:
+        with self._lock:
+            series = {key: (list(counts), count, total) for key, (counts, count, total) in self._series.items()}
+        for key, (counts, count, total) in sorted(series.items()):
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                yield f"{self.name}_bucket", {**labels, "le": format_value(bound)}, cumulative
+            yield f"{self.name}_count", labels, count
+            yield f"{self.name}_sum", labels, total
+
+    def clear(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Counter | Histogram] = []
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), **kwargs) -> Histogram:
+        metric = Histogram(name, help, labels, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def clear(self) -> None:
+        for metric in self.metrics:
+            metric.clear()
+
+    def render(self, stats: dict[str, dict] | None = None) -> str:
+        """
+        The metrics in the Prometheus text exposition format, followed by
+        the `stats()` of each component in `stats` as gauges.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        for component, values in (stats or {}).items():
+            lines.extend(stats_lines(component, values))
+        return "\n".join(lines) + "\n"
+
+def stats_lines(component: str, stats: dict) -> List[str]:
+    """
+    A component's `stats()` as gauges named lovechain_<component>_<key>.
+    Nested {bucket: value} dicts, like batch size histograms, become one
+    gauge with a `key` label.
+    """
+    lines = []
+    for key, value in stats.items():
+        name = f"lovechain_{component}_{key}"
+        if isinstance(value, dict):
+            samples = [({"key": str(k)}, v) for k, v in value.items()]
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            samples = [({}, value)]
+        else:
+            continue
+        lines.append(f"# HELP {name} {component} {key}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{format_labels(labels)} {format_value(v)}" for labels, v in samples)
+    return lines
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.histogram(
+    "lovechain_http_request_duration_seconds",
+    "Time from receiving a request to sending the last byte of its response",
+    ("method", "route", "status"))
+RESPONSE_SIZE = REGISTRY.histogram(
+    "lovechain_http_response_size_bytes",
+    "Bytes of response bodies as sent, after compression",
+    ("method", "route"), buckets=SIZE_BUCKETS)
+STAGE_LATENCY = REGISTRY.histogram(
+    "lovechain_stage_duration_seconds",
+    "Time spent in one stage of answering a request",
+    ("stage",))
+SCHEDULER_WAIT = REGISTRY.histogram(
+    "lovechain_scheduler_wait_seconds",
+    "Time LLM calls waited for a slot, quota or budget before they started")
+SCHEDULER_REJECTIONS = REGISTRY.counter(
+    "lovechain_scheduler_rejected_total",
+    "LLM calls rejected by reason: queue_full, user_quota, budget or expected_wait (rejected "
+    "before waiting) and timeout (after waiting)",
+    ("reason",))
+LLM_TOKENS = REGISTRY.counter(
+    "lovechain_llm_tokens_total",
+    "Tokens sent to and generated by the chat model; estimated when the provider reports no usage",
+    ("kind",))
+LLM_FIRST_TOKEN = REGISTRY.histogram(
+    "lovechain_llm_provider_first_token_seconds",
+    "Time from sending a call to a chat model provider to its first streamed token",
+    ("provider",))
+LLM_ROUTES = REGISTRY.counter(
+    "lovechain_llm_route_total",
+    "Chat model provider attempts by outcome: won, error, timeout, lost (to a hedged call), "
+    "hedged (started as one) or skipped (circuit open)",
+    ("provider", "outcome"))
+
+def timed(stage: str):
+    """
+    Time a block as one observation of `stage`: auth, conversation, condense,
+    embed, search, retrieve, assemble, ttft, generate or db_commit.
+    """
+    return STAGE_LATENCY.time(stage=stage)
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency of every HTTP request by method,
+    route template and status, and the size of its response body. The time
+    runs until the last body chunk is sent, so streamed answers are measured
+    in full.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_wrapper(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Route templates keep ids out of the label values
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_LATENCY.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                route=route,
+                status=str(status))
+            RESPONSE_SIZE.observe(size, method=scope["method"], route=route)
@@ -1,13 +1,68 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Dict, List, Literal, Optional, Union
 from langchain_core.documents import Document
+from .context import covered_ids
 
 
 class Question(BaseModel):
     question: str = Field(..., min_length=10, max_length=200)
+    corpora: Optional[List[str]] = Field(
+        default=None, description="Corpora to search, all when omitted")
+    filter: Optional[Dict[str, Union[str, int, float, bool]]] = Field(
+        default=None, description="Exact-match metadata filter, e.g. {\"book\": \"BOOK II\"}")
+    conversation: bool = Field(
+        default=False, description="Answer as a follow-up to the earlier questions of the conversation")
+    context_format: Literal["documents", "references"] = Field(
+        default="documents",
+        description="Return the context as full documents or as compact references, see GET /chunks/{id}")
+    snippet_length: int = Field(
+        default=0, ge=0, le=500, description="Characters of each chunk included in its reference")
+
+
+class ContextReference(BaseModel):
+    id: Optional[str] = Field(
+        default=None, description="Chunk id, the chunk is served by GET /chunks/{id}; none for merged chunks")
+    ids: List[str] = Field(
+        default=[], description="Ids of all the chunks the context was taken from, in text order")
+    corpus: Optional[str] = None
+    source: Optional[str] = None
+    start_index: Optional[int] = None
+    length: int = Field(..., description="Characters of the chunk used as context")
+    snippet: Optional[str] = None
+
+    @classmethod
+    def from_document(cls, doc: Document, snippet_length: int = 0) -> "ContextReference":
+        ids = covered_ids(doc)
+        return cls(
+            id=doc.id if len(ids) == 1 else None,
+            ids=ids,
+            corpus=doc.metadata.get("corpus"),
+            source=doc.metadata.get("source"),
+            start_index=doc.metadata.get("start_index"),
+            length=len(doc.page_content),
+            snippet=doc.page_content[:snippet_length] if snippet_length else None,
+        )
 
 
 class Answer(BaseModel):
     question: str
-    context: List[Document]
+    context: List[Document] = []
+    references: Optional[List[ContextReference]] = Field(
+        default=None, description="The context as references, when asked for")
     answer: str
+    context_tokens: Optional[int] = Field(
+        default=None, description="Tokens of the context passed to the model")
+    tokens_saved: Optional[int] = Field(
+        default=None, description="Context tokens saved against sending the top chunks verbatim")
+
+
+class BatchAnswer(BaseModel):
+    index: int = Field(..., description="Position of the question in the batch")
+    question: str
+    context: List[Document] = []
+    references: Optional[List[ContextReference]] = None
+    answer: Optional[str] = None
+    context_tokens: Optional[int] = None
+    tokens_saved: Optional[int] = None
+    error: Optional[str] = Field(
+        default=None, description="Why the question was not answered; the other answers are unaffected")
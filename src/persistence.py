@@ -0,0 +1,151 @@
+# persistence.py
+import asyncio
+import logging
+import queue
+import threading
+import time
+from typing_extensions import Callable, List
+from fastapi import Request
+from sqlmodel import Session
+from .db import Message
+from .metrics import timed
+
+DURABILITY_MODES = ("buffered", "committed")
+
+logger = logging.getLogger(__name__)
+
+class MessageWriter:
+    """
+    Write-behind queue for chat messages.
+
+    Requests hand their question/answer rows to `save`; one writer thread
+    drains the queue and inserts everything that arrived within
+    `flush_interval` seconds (at most `batch_size` saves) in a single
+    transaction, so neither the event loop nor the response waits on a
+    commit of its own.
+
+    Durability:
+      - "buffered": `save` returns as soon as the rows are queued. Rows are
+        committed within about `flush_interval` seconds; `close` (called on
+        shutdown) flushes whatever is still queued, but rows queued when
+        the process is killed or crashes are lost.
+      - "committed": `save` returns once the batch holding the rows has been
+        committed (group commit), so an acknowledged answer is in the
+        database; the caller still does not block the event loop.
+    What a commit guarantees is up to the database: with the SQLite pragmas
+    in `db.py` (WAL, synchronous=NORMAL) the last commits can be rolled back
+    by a power loss, though not by a crash of the application.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        durability: str = "buffered",
+        batch_size: int = 256,
+        flush_interval: float = 0.05,
+        max_queued: int = 10000,
+    ):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown message durability: {durability}")
+        self.session_factory = session_factory
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._thread.start()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "written": self.written,
+            "failed": self.failed,
+        }
+
+    async def save(self, user_id: int, conversation_id: int, question: str, answer: str) -> None:
+        await self.save_many(user_id, conversation_id, [(question, answer)])
+
+    async def save_many(self, user_id: int, conversation_id: int, turns: List[tuple[str, str]]) -> None:
+        """
+        Save (question, answer) turns; all of them are written in the same
+        transaction.
+        """
+        rows = [
+            Message(user_id=user_id, conversation_id=conversation_id, message=message, is_human_message=human)
+            for question, answer in turns
+            for message, human in ((question, True), (answer, False))
+        ]
+        if self.durability == "buffered":
+            try:
+                self._queue.put_nowait((rows, None))
+            except queue.Full:
+                # Backpressure: wait for the writer without holding the event loop
+                await asyncio.to_thread(self._queue.put, (rows, None))
+            return
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        await asyncio.to_thread(self._queue.put, (rows, (loop, future)))
+        await future
+
+    def close(self) -> None:
+        """
+        Flush everything queued so far and stop the writer thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first) -> tuple[list, bool]:
+        batch, deadline = [first], time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stopping = self._collect(first)
+            self._write(batch)
+
+    def _write(self, batch: List[tuple]) -> None:
+        error = None
+        rows = [row for rows, _ in batch for row in rows]
+        try:
+            with timed("db_commit"), self.session_factory() as session:
+                session.add_all(rows)
+                session.commit()
+            self.batches += 1
+            self.written += len(rows)
+        except Exception as exc:
+            logger.exception("Failed to save %d messages", len(rows))
+            self.failed += len(rows)
+            error = exc
+        for _, waiter in batch:
+            if waiter is None:
+                continue
+            loop, future = waiter
+            loop.call_soon_threadsafe(_resolve, future, error)
+
+def _resolve(future: asyncio.Future, error: Exception | None) -> None:
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+def get_message_writer(request: Request) -> MessageWriter:
+    return request.app.state.message_writer
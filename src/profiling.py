@@ -0,0 +1,99 @@
+# profiling.py
+import sys
+import threading
+from collections import Counter
+from typing_extensions import Callable
+
+class SamplingProfiler:
+    """
+    Sample the stack of one thread every `interval` seconds from a
+    background thread and count identical stacks.
+
+    `collapsed` returns them in the folded format ("outer;inner count" per
+    line) read by flamegraph.pl, speedscope and similar tools. Sampling the
+    event loop thread shows everything the loop ran meanwhile, including
+    other requests, and not the work handed to thread pools.
+    """
+
+    def __init__(self, thread_id: int | None = None, interval: float = 0.001):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.samples = 0
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def __enter__(self) -> "SamplingProfiler":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_qualname} ({code.co_filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        return "".join(
+            f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+class ProfilerMiddleware:
+    """
+    ASGI middleware profiling requests sent with an `X-Profile` header by a
+    caller for whom `allowed(headers)` is true (admins). The response is
+    replaced by the collapsed stacks of the request, as text/plain; the
+    original status is sent in `X-Profiled-Status`. Requests from anyone
+    else are served normally and the header is ignored.
+    """
+
+    def __init__(self, app, allowed: Callable[[dict], bool], interval: float = 0.001):
+        self.app = app
+        self.allowed = allowed
+        self.interval = interval
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        if "x-profile" not in headers or not self.allowed(headers):
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def discard(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        with SamplingProfiler(interval=self.interval) as profiler:
+            await self.app(scope, receive, discard)
+
+        body = profiler.collapsed().encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+                (b"x-profiled-status", str(status).encode()),
+                (b"x-profile-samples", str(profiler.samples).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
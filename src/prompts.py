@@ -0,0 +1,40 @@
+# prompts.py
+from langchain_core.prompts import ChatPromptTemplate
+
+# Vendored copy of the "rlm/rag-prompt" LangChain Hub prompt, so that building
+# the RAG graph does not need a network round-trip to the hub.
+RAG_PROMPT_TEMPLATE = (
+    "You are an assistant for question-answering tasks. "
+    "Use the following pieces of retrieved context to answer the question. "
+    "If you don't know the answer, just say that you don't know. "
+    "Use three sentences maximum and keep the answer concise.\n"
+    "Question: {question} \n"
+    "Context: {context} \n"
+    "Answer:"
+)
+
+RAG_PROMPT = ChatPromptTemplate.from_messages([("human", RAG_PROMPT_TEMPLATE)])
+
+CONVERSATION_RAG_PROMPT_TEMPLATE = (
+    "You are an assistant for question-answering tasks. "
+    "Use the following pieces of retrieved context and the conversation so far "
+    "to answer the question. "
+    "If you don't know the answer, just say that you don't know. "
+    "Use three sentences maximum and keep the answer concise.\n"
+    "Conversation: {history} \n"
+    "Question: {question} \n"
+    "Context: {context} \n"
+    "Answer:"
+)
+
+CONVERSATION_RAG_PROMPT = ChatPromptTemplate.from_messages([("human", CONVERSATION_RAG_PROMPT_TEMPLATE)])
+
+CONDENSE_PROMPT_TEMPLATE = (
+    "Given the following conversation and a follow up question, rephrase the "
+    "follow up question to be a standalone question. Reply with the question only.\n"
+    "Conversation: {history} \n"
+    "Follow up question: {question} \n"
+    "Standalone question:"
+)
+
+CONDENSE_PROMPT = ChatPromptTemplate.from_messages([("human", CONDENSE_PROMPT_TEMPLATE)])
@@ -0,0 +1,437 @@
+# retrieval.py
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from typing_extensions import Awaitable, Callable, List, Tuple
+from .batching import MicroBatcher
+from .corpus import UnknownCorpus
+from .lexical import BM25Index
+from .metrics import timed
+from .vectorstore import NumpyVectorStore
+
+RETRIEVAL_MODES = ("dense", "hybrid", "lexical")
+
+logger = logging.getLogger(__name__)
+
+def to_where(filter: dict | None) -> dict | None:
+    """
+    Turn a flat {field: value} metadata filter into a Chroma `where` clause.
+    """
+    if not filter:
+        return None
+    if len(filter) == 1:
+        return dict(filter)
+    return {"$and": [{key: value} for key, value in filter.items()]}
+
+def merge_by_score(
+    results: List[List[Tuple[Document, float]]],
+    k: int,
+    reverse: bool = False
+) -> List[Document]:
+    """
+    Merge per-collection (document, score) results. Scores are distances
+    (closest first) unless `reverse` is set, e.g. for BM25 scores.
+    """
+    scored = [item for result in results for item in result]
+    scored.sort(key=lambda item: item[1], reverse=reverse)
+    return [doc for doc, _ in scored[:k]]
+
+def batch_search(
+    store: VectorStore,
+    embeddings: List[List[float]],
+    k: int,
+    where: dict | None
+) -> List[List[Tuple[Document, float]]]:
+    """
+    Nearest-neighbour search for several query vectors in one call where the
+    backend supports it: one (document, distance) list per query.
+    """
+    if isinstance(store, NumpyVectorStore):
+        return store.similarity_search_by_vectors_with_relevance_scores(embeddings, k, where)
+    if hasattr(store, "_collection"):
+        result = store._collection.query(
+            query_embeddings=embeddings, n_results=k, where=where,
+            include=["documents", "metadatas", "distances"])
+        return [
+            [
+                (Document(id=id_, page_content=text, metadata=metadata or {}), distance)
+                for id_, text, metadata, distance in zip(
+                    result["ids"][i], result["documents"][i],
+                    result["metadatas"][i], result["distances"][i])
+            ]
+            for i in range(len(embeddings))
+        ]
+    return [
+        store.similarity_search_by_vector_with_relevance_scores(embedding, k=k, filter=where)
+        for embedding in embeddings
+    ]
+
+def stored_vectors(store: VectorStore, ids: List[str]) -> dict[str, List[float]]:
+    """
+    The vectors stored for the chunks with the given ids, by id, skipping
+    unknown ones (and every chunk of backends that cannot return them).
+    """
+    if isinstance(store, NumpyVectorStore):
+        return store.get_vectors(ids)
+    if hasattr(store, "_collection"):
+        result = store._collection.get(ids=list(dict.fromkeys(ids)), include=["embeddings"])
+        return dict(zip(result["ids"], result["embeddings"]))
+    return {}
+
+def doc_key(doc: Document) -> str:
+    return doc.id or f"{doc.metadata.get('corpus')}:{doc.metadata.get('start_index')}:{doc.page_content}"
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: int, rrf_k: int = 60) -> List[Document]:
+    """
+    Fuse ranked lists: every document scores sum(1 / (rrf_k + rank)).
+    """
+    scores: dict[str, float] = {}
+    docs: dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            key = doc_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+            docs.setdefault(key, doc)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [docs[key] for key in best]
+
+class CorpusRetriever:
+    """
+    Retrieval over one vector store (and optionally one BM25 index) per corpus.
+
+    In "dense" mode the question is embedded once and every selected
+    collection is searched by vector, in parallel when more than one is
+    selected; results are merged by distance. "lexical" mode searches only
+    the BM25 indexes and never calls the embedding service. "hybrid" mode
+    fuses the dense and lexical rankings with reciprocal-rank fusion and
+    falls back to the lexical ranking when embedding the question fails or
+    takes longer than `embedding_timeout` seconds.
+
+    Searching is split in two steps, so callers can embed a question once
+    and reuse the vector (for the answer cache and context assembly):
+    `aembed_question` and `asearch_by_vector`, which `asearch` chains.
+
+    With a `batch_window`, concurrent async calls are micro-batched: their
+    questions are embedded with one `aembed_documents` call and each
+    collection answers their dense searches with one batched
+    nearest-neighbour query.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        stores: dict[str, VectorStore],
+        k: int = 3,
+        lexical: dict[str, BM25Index] | None = None,
+        mode: str = "dense",
+        candidates: int = 20,
+        rrf_k: int = 60,
+        embedding_timeout: float | None = None,
+        batch_window: float | None = None,
+        max_batch_size: int = 32,
+    ):
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode: {mode}")
+        if mode != "dense" and lexical is None:
+            raise ValueError(f"Retrieval mode {mode} needs lexical indexes")
+        self.embeddings = embeddings
+        self.stores = stores
+        self.k = k
+        self.lexical = lexical or {}
+        self.mode = mode
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.embedding_timeout = embedding_timeout
+        self.embedding_fallbacks = 0
+        self.batcher = self.embedding_batcher = None
+        if batch_window:
+            self.embedding_batcher = MicroBatcher(
+                self.aembed_many, max_batch_size=max_batch_size, max_wait=batch_window)
+            self.batcher = MicroBatcher(
+                self._search_items, max_batch_size=max_batch_size, max_wait=batch_window)
+
+    def select(self, corpora: List[str] | None) -> List[str]:
+        if not corpora:
+            return list(self.stores)
+        unknown = [name for name in corpora if name not in self.stores]
+        if unknown:
+            raise UnknownCorpus(unknown)
+        return list(dict.fromkeys(corpora))
+
+    def _dense(self, name: str, embedding: List[float], k: int, filter: dict | None):
+        return self.stores[name].similarity_search_by_vector_with_relevance_scores(
+            embedding, k=k, filter=to_where(filter))
+
+    def _lexical(self, question: str, names: List[str], k: int, filter: dict | None) -> List[Document]:
+        return merge_by_score(
+            [self.lexical[name].search(question, k, to_where(filter)) for name in names if name in self.lexical],
+            k, reverse=True)
+
+    def _dense_all(self, names: List[str], embedding: List[float], k: int, filter: dict | None) -> List[Document]:
+        if len(names) == 1:
+            return merge_by_score([self._dense(names[0], embedding, k, filter)], k)
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            results = list(executor.map(lambda name: self._dense(name, embedding, k, filter), names))
+        return merge_by_score(results, k)
+
+    def _fuse(self, dense: List[Document] | None, lexical: List[Document], k: int) -> List[Document]:
+        if dense is None:
+            return lexical[:k]
+        return reciprocal_rank_fusion([dense, lexical], k, self.rrf_k)
+
+    def embed_question(self, question: str) -> List[float] | None:
+        """
+        The embedding of a question for `search_by_vector`: None in lexical
+        mode, and in hybrid mode when embedding fails.
+        """
+        if self.mode == "lexical":
+            return None
+        if self.mode == "dense":
+            return self.embeddings.embed_query(question)
+        try:
+            return self.embeddings.embed_query(question)
+        except Exception:
+            logger.exception("Embedding failed, falling back to lexical retrieval")
+            self.embedding_fallbacks += 1
+            return None
+
+    def search(
+        self,
+        question: str,
+        corpora: List[str] | None = None,
+        filter: dict | None = None,
+        k: int | None = None,
+    ) -> List[Document]:
+        self.select(corpora)
+        return self.search_by_vector(question, self.embed_question(question), corpora, filter, k)
+
+    def search_by_vector(
+        self,
+        question: str,
+        embedding: List[float] | None,
+        corpora: List[str] | None = None,
+        filter: dict | None = None,
+        k: int | None = None,
+    ) -> List[Document]:
+        """
+        Search with the question's `embedding` from `embed_question`; without
+        one, hybrid mode only searches the lexical indexes.
+        """
+        k = k or self.k
+        names = self.select(corpora)
+        if self.mode == "lexical":
+            return self._lexical(question, names, k, filter)
+        if self.mode == "dense":
+            return self._dense_all(names, self._require(embedding), k, filter)
+
+        lexical = self._lexical(question, names, self.candidates, filter)
+        if embedding is None:
+            return self._fuse(None, lexical, k)
+        return self._fuse(self._dense_all(names, embedding, self.candidates, filter), lexical, k)
+
+    @staticmethod
+    def _require(embedding):
+        if embedding is None:
+            raise ValueError("Dense retrieval needs the question's embedding")
+        return embedding
+
+    def stored_vectors(self, docs: List[Document]) -> List[List[float]] | None:
+        """
+        The vectors stored with retrieved chunks, in order, so they need not
+        be embedded again; None when any chunk has none.
+        """
+        default = next(iter(self.stores)) if len(self.stores) == 1 else None
+        wanted: dict[str, List[str]] = {}
+        for doc in docs:
+            name = doc.metadata.get("corpus", default)
+            if doc.id is None or self.stores.get(name) is None:
+                return None
+            wanted.setdefault(name, []).append(doc.id)
+        found: dict[str, List[float]] = {}
+        for name, ids in wanted.items():
+            found.update(stored_vectors(self.stores[name], ids))
+        if any(doc.id not in found for doc in docs):
+            return None
+        return [found[doc.id] for doc in docs]
+
+    async def aembed(self, question: str) -> List[float]:
+        """
+        Embed a question, micro-batched with concurrent ones when there is a
+        `batch_window`.
+        """
+        if self.embedding_batcher is not None:
+            return await self.embedding_batcher.submit(question)
+        with timed("embed"):
+            return await self.embeddings.aembed_query(question)
+
+    async def aembed_many(self, questions: List[str]) -> List[List[float]]:
+        with timed("embed"):
+            return await self.embeddings.aembed_documents(questions)
+
+    async def _aembed_for_search(self, embed: Callable[[], Awaitable], count: int):
+        if self.mode == "lexical":
+            return None
+        if self.mode == "dense":
+            return await embed()
+        try:
+            return await asyncio.wait_for(embed(), self.embedding_timeout)
+        except Exception:
+            logger.warning("Embedding failed or timed out, falling back to lexical retrieval")
+            self.embedding_fallbacks += count
+            return None
+
+    async def aembed_question(self, question: str) -> List[float] | None:
+        """
+        The embedding of a question for `asearch_by_vector`: None in lexical
+        mode, and in hybrid mode when embedding fails or takes longer than
+        `embedding_timeout` seconds.
+        """
+        return await self._aembed_for_search(lambda: self.aembed(question), 1)
+
+    async def aembed_questions(self, questions: List[str]) -> List[List[float]] | None:
+        """
+        The embeddings of several questions, in one call, see `aembed_question`.
+        """
+        return await self._aembed_for_search(lambda: self.aembed_many(questions), len(questions))
+
+    async def _search_items(self, items: List[tuple]) -> List[List[Document]]:
+        """
+        Answer a micro-batch of (question, corpora, k, filter, vector) dense searches.
+        """
+        return await self._search_batch([item[:4] for item in items], [item[4] for item in items])
+
+    async def _search_batch(self, items: List[tuple], vectors: List[List[float]]) -> List[List[Document]]:
+        """
+        Dense searches for (question, corpora, k, filter) items with their
+        query `vectors`: one batched query per corpus, k and filter.
+        """
+        groups: dict[tuple, List[int]] = {}
+        for i, (_, names, k, filter) in enumerate(items):
+            for name in names:
+                groups.setdefault((name, k, json.dumps(filter, sort_keys=True)), []).append(i)
+
+        results: List[List[List[Tuple[Document, float]]]] = [[] for _ in items]
+
+        async def search_group(name: str, k: int, filter: str, indexes: List[int]) -> None:
+            found = await asyncio.to_thread(
+                batch_search, self.stores[name], [vectors[i] for i in indexes],
+                k, to_where(json.loads(filter)))
+            for i, result in zip(indexes, found):
+                results[i].append(result)
+
+        with timed("search"):
+            await asyncio.gather(*(search_group(*key, indexes) for key, indexes in groups.items()))
+        return [merge_by_score(results[i], items[i][2]) for i in range(len(items))]
+
+    async def _adense(
+        self, question: str, names: List[str], k: int, filter: dict | None, embedding: List[float]
+    ) -> List[Document]:
+        if self.batcher is not None:
+            return await self.batcher.submit((question, tuple(names), k, filter, embedding))
+        with timed("search"):
+            results = await asyncio.gather(*(
+                asyncio.to_thread(self._dense, name, embedding, k, filter)
+                for name in names
+            ))
+        return merge_by_score(list(results), k)
+
+    async def asearch(
+        self,
+        question: str,
+        corpora: List[str] | None = None,
+        filter: dict | None = None,
+        k: int | None = None,
+    ) -> List[Document]:
+        self.select(corpora)
+        return await self.asearch_by_vector(question, await self.aembed_question(question), corpora, filter, k)
+
+    async def asearch_by_vector(
+        self,
+        question: str,
+        embedding: List[float] | None,
+        corpora: List[str] | None = None,
+        filter: dict | None = None,
+        k: int | None = None,
+    ) -> List[Document]:
+        """
+        Search with the question's `embedding` from `aembed_question`;
+        without one, hybrid mode only searches the lexical indexes.
+        """
+        k = k or self.k
+        names = self.select(corpora)
+        if self.mode == "lexical":
+            return self._lexical(question, names, k, filter)
+        if self.mode == "dense":
+            return await self._adense(question, names, k, filter, self._require(embedding))
+
+        lexical = self._lexical(question, names, self.candidates, filter)
+        dense = None
+        if embedding is not None:
+            try:
+                dense = await self._adense(question, names, self.candidates, filter, embedding)
+            except Exception:
+                logger.warning("Dense search failed, falling back to lexical retrieval")
+                self.embedding_fallbacks += 1
+        return self._fuse(dense, lexical, k)
+
+    async def asearch_many(
+        self,
+        questions: List[str],
+        corpora: List[List[str] | None],
+        filters: List[dict | None],
+        k: int | None = None,
+    ) -> List[List[Document]]:
+        """
+        Search for several questions at once: they are embedded in one call
+        and searched with `asearch_many_by_vector`.
+        """
+        for names in corpora:
+            self.select(names)
+        return await self.asearch_many_by_vector(
+            questions, await self.aembed_questions(questions), corpora, filters, k)
+
+    async def asearch_many_by_vector(
+        self,
+        questions: List[str],
+        vectors: List[List[float]] | None,
+        corpora: List[List[str] | None],
+        filters: List[dict | None],
+        k: int | None = None,
+    ) -> List[List[Document]]:
+        """
+        Search for several questions with their `vectors` from
+        `aembed_questions`. Dense searches run as one batched query per
+        corpus and filter; without vectors, hybrid mode only searches the
+        lexical indexes.
+        """
+        k = k or self.k
+        names = [self.select(names) for names in corpora]
+        if self.mode == "lexical":
+            return [
+                self._lexical(question, n, k, filter)
+                for question, n, filter in zip(questions, names, filters)
+            ]
+
+        dense_k = k if self.mode == "dense" else self.candidates
+        items = [(question, tuple(n), dense_k, filter) for question, n, filter in zip(questions, names, filters)]
+        if self.mode == "dense":
+            return await self._search_batch(items, self._require(vectors))
+
+        lexical = [
+            self._lexical(question, n, self.candidates, filter)
+            for question, n, filter in zip(questions, names, filters)
+        ]
+        dense = None
+        if vectors is not None:
+            try:
+                dense = await self._search_batch(items, vectors)
+            except Exception:
+                logger.warning("Dense search failed, falling back to lexical retrieval")
+                self.embedding_fallbacks += len(questions)
+        if dense is None:
+            return [self._fuse(None, found, k) for found in lexical]
+        return [self._fuse(found, lexical_found, k) for found, lexical_found in zip(dense, lexical)]
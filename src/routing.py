@@ -0,0 +1,365 @@
+# routing.py
+import asyncio
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.chat_models import agenerate_from_stream, generate_from_stream
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from typing_extensions import AsyncIterator, Callable, Iterator, List
+from .metrics import LLM_FIRST_TOKEN, LLM_ROUTES
+
+class LLMUnavailable(Exception):
+    """
+    Raised when no provider answered: all of them failed, missed the
+    deadline or have an open circuit.
+    """
+
+    def __init__(self, message: str = "No language model available", retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class CircuitBreaker:
+    """
+    Track the outcomes and times to first token of a provider's last
+    `window` calls.
+
+    The circuit opens when `min_calls` or more calls were made and at least
+    `error_rate` of them failed, and stays open for `cooldown` seconds; no
+    calls are sent to the provider meanwhile. After that one trial call is
+    let through (half open): its success closes the circuit, its failure
+    opens it again.
+    """
+
+    def __init__(
+        self,
+        window: int = 20,
+        min_calls: int = 5,
+        error_rate: float = 0.5,
+        cooldown: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.min_calls = min_calls
+        self.threshold = error_rate
+        self.cooldown = cooldown
+        self.clock = clock
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.opened_at: float | None = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self._trial or self.clock() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown - self.clock())
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record(self, ok: bool, latency: float | None = None) -> None:
+        with self._lock:
+            if latency is not None:
+                self.latencies.append(latency)
+            if self._trial:
+                # The trial call decides alone, older outcomes are stale
+                self._trial = False
+                self.outcomes.clear()
+                self.outcomes.append(ok)
+                self.opened_at = None if ok else self.clock()
+                return
+            self.outcomes.append(ok)
+            if (
+                self.opened_at is None
+                and len(self.outcomes) >= self.min_calls
+                and self.error_rate >= self.threshold
+            ):
+                self.opened_at = self.clock()
+
+    def release(self) -> None:
+        """
+        End a call without an outcome, e.g. because its caller went away.
+        """
+        with self._lock:
+            self._trial = False
+
+@dataclass
+class Provider:
+    name: str
+    model: BaseChatModel
+    breaker: CircuitBreaker = field(default_factory=CircuitBreaker)
+    wins: int = 0
+
+@dataclass
+class Attempt:
+    provider: Provider
+    stream: AsyncIterator | None
+    started: float
+    first_token: float | None = None
+
+async def first_chunk(stream: AsyncIterator):
+    return await anext(stream, None)
+
+class RoutedChatModel(BaseChatModel):
+    """
+    Route each call over several chat models (providers) in order of
+    preference, usually ending with a local model as the fallback.
+
+    - A call goes to the first provider whose circuit is not open.
+    - When it has not streamed a token after `hedge_delay` seconds, the same
+      call is sent to the next provider as well (a hedged request). The
+      first of them to stream a token answers and the other is cancelled.
+    - A provider failing before its first token is replaced by the next one.
+    - The whole answer must arrive within `deadline` seconds.
+
+    Raises `LLMUnavailable` when no provider answered in time. Answers are
+    never mixed: once a provider streamed a token, its errors are raised.
+    The synchronous methods only fall back on errors.
+    """
+    providers: List[Provider]
+    deadline: float = 60.0
+    hedge_delay: float | None = 2.0
+    model_name: str = ""
+    calls: int = 0
+    hedged: int = 0
+    fallbacks: int = 0
+    unavailable: int = 0
+
+    def model_post_init(self, __context) -> None:
+        # The primary model names the router, e.g. to pick a tokenizer
+        if not self.model_name and self.providers:
+            model = self.providers[0].model
+            self.model_name = getattr(model, "model_name", None) or getattr(model, "model", self.providers[0].name)
+
+    @property
+    def _llm_type(self) -> str:
+        return "routed"
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "fallbacks": self.fallbacks,
+            "unavailable": self.unavailable,
+            "wins": {p.name: p.wins for p in self.providers},
+            "circuit_open": {p.name: int(p.breaker.state == "open") for p in self.providers},
+            "error_rate": {p.name: p.breaker.error_rate for p in self.providers},
+            "first_token_p50_seconds": {p.name: percentile(p.breaker.latencies, 0.5) for p in self.providers},
+            "first_token_p95_seconds": {p.name: percentile(p.breaker.latencies, 0.95) for p in self.providers},
+        }
+
+    def _unavailable(self, message: str) -> LLMUnavailable:
+        self.unavailable += 1
+        retry_after = min((p.breaker.retry_after() for p in self.providers), default=1.0)
+        return LLMUnavailable(message, retry_after=max(1.0, retry_after))
+
+    def _available(self) -> Iterator[Provider]:
+        for provider in self.providers:
+            if provider.breaker.allow():
+                yield provider
+            else:
+                LLM_ROUTES.inc(provider=provider.name, outcome="skipped")
+
+    def _finish(self, attempt: Attempt, outcome: str) -> None:
+        """
+        Record how an attempt ended: won, error, timeout or lost (to a faster
+        provider). Only won counts as a success.
+        """
+        ok = outcome == "won"
+        latency = attempt.first_token - attempt.started if attempt.first_token is not None else None
+        attempt.provider.breaker.record(ok, latency)
+        attempt.provider.wins += ok
+        LLM_ROUTES.inc(provider=attempt.provider.name, outcome=outcome)
+
+    async def _race(self, messages: List[BaseMessage], stop: List[str] | None, **kwargs):
+        """
+        The attempt that streamed a token first, that chunk and the deadline
+        of the call.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        hedge_at = loop.time() + self.hedge_delay if self.hedge_delay is not None else None
+        available = self._available()
+        attempts: dict[asyncio.Future, Attempt] = {}
+
+        def launch() -> Provider | None:
+            provider = next(available, None)
+            if provider is not None:
+                stream = aiter(provider.model.astream(messages, stop=stop, **kwargs))
+                attempts[asyncio.ensure_future(first_chunk(stream))] = Attempt(provider, stream, loop.time())
+            return provider
+
+        self.calls += 1
+        if launch() is None:
+            raise self._unavailable("All language model circuits are open")
+        winner, chunk, error, completed = None, None, None, False
+        try:
+            while winner is None and attempts:
+                wake_at = deadline if hedge_at is None else min(deadline, hedge_at)
+                done, _ = await asyncio.wait(
+                    attempts, timeout=max(0.0, wake_at - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    attempt = attempts.pop(task)
+                    try:
+                        first = task.result()
+                    except Exception as exc:
+                        error = exc
+                        self._finish(attempt, "error")
+                        self.fallbacks += launch() is not None
+                        continue
+                    attempt.first_token = loop.time()
+                    LLM_FIRST_TOKEN.observe(attempt.first_token - attempt.started, provider=attempt.provider.name)
+                    if winner is None:
+                        winner, chunk = attempt, first if first is not None else AIMessageChunk(content="")
+                    else:
+                        await attempt.stream.aclose()
+                        self._finish(attempt, "lost")
+                if winner is None and not done:
+                    if loop.time() >= deadline:
+                        break
+                    hedge_at = None
+                    hedge = launch()
+                    if hedge is not None:
+                        self.hedged += 1
+                        LLM_ROUTES.inc(provider=hedge.name, outcome="hedged")
+            completed = True
+        finally:
+            for task, attempt in attempts.items():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await attempt.stream.aclose()
+                if completed:
+                    self._finish(attempt, "lost" if winner is not None else "timeout")
+                else:
+                    # Cut short because the caller went away, which says
+                    # nothing about the provider
+                    attempt.provider.breaker.release()
+            if not completed and winner is not None:
+                await winner.stream.aclose()
+                winner.provider.breaker.release()
+        if winner is None:
+            if error is not None and loop.time() < deadline:
+                raise self._unavailable(f"All language models failed: {error}") from error
+            raise self._unavailable(f"No language model answered within {self.deadline:g} s")
+        return winner, chunk, deadline
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: List[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        attempt, chunk, deadline = await self._race(messages, stop, **kwargs)
+        outcome = None
+        try:
+            while chunk is not None:
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.content, chunk=chunk)
+                yield ChatGenerationChunk(message=chunk)
+                try:
+                    async with asyncio.timeout_at(deadline):
+                        chunk = await anext(attempt.stream, None)
+                except TimeoutError:
+                    outcome = "timeout"
+                    raise self._unavailable(f"The answer did not complete within {self.deadline:g} s")
+            outcome = "won"
+        except (GeneratorExit, asyncio.CancelledError):
+            raise
+        except Exception:
+            outcome = outcome or "error"
+            raise
+        finally:
+            await attempt.stream.aclose()
+            if outcome is None:
+                attempt.provider.breaker.release()
+            else:
+                self._finish(attempt, outcome)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: List[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs
+    ) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: List[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs
+    ) -> Iterator[ChatGenerationChunk]:
+        self.calls += 1
+        error = None
+        for provider in self._available():
+            attempt = Attempt(provider, None, time.monotonic())
+            stream = provider.model.stream(messages, stop=stop, **kwargs)
+            try:
+                chunk = next(stream, None)
+            except Exception as exc:
+                error = exc
+                self._finish(attempt, "error")
+                self.fallbacks += 1
+                continue
+            attempt.first_token = time.monotonic()
+            LLM_FIRST_TOKEN.observe(attempt.first_token - attempt.started, provider=provider.name)
+            outcome = None
+            try:
+                while chunk is not None:
+                    if run_manager:
+                        run_manager.on_llm_new_token(chunk.content, chunk=chunk)
+                    yield ChatGenerationChunk(message=chunk)
+                    chunk = next(stream, None)
+                outcome = "won"
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                if outcome is None:
+                    provider.breaker.release()
+                else:
+                    self._finish(attempt, outcome)
+            return
+        if error is not None:
+            raise self._unavailable(f"All language models failed: {error}") from error
+        raise self._unavailable("All language model circuits are open")
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: List[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs
+    ) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
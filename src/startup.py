@@ -0,0 +1,106 @@
+# startup.py
+"""
+Startup time of the API.
+
+Usage:
+    python -m src.startup [--top 15]
+
+Imports the app in a fresh interpreter with `python -X importtime`, prints
+the import time of the slowest top-level packages, then runs the app's
+startup (lifespan) and prints the time until it was ready to serve. The
+same phases are exported on /metrics as lovechain_startup_<phase>_seconds.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from collections import Counter
+
+READY_SCRIPT = """
+import asyncio, json
+from src.main import app
+from src.startup import STARTUP
+
+async def start():
+    async with app.router.lifespan_context(app):
+        pass
+
+asyncio.run(start())
+print(json.dumps(STARTUP.stats()))
+"""
+
+class StartupTimer:
+    """
+    Seconds from the first import of the app to each startup phase:
+    "import" once the app module is loaded, "ready" once the lifespan has
+    built everything requests need.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: dict[str, float] = {}
+
+    def mark(self, phase: str) -> float:
+        return self.phases.setdefault(phase, time.perf_counter() - self.started)
+
+    def stats(self) -> dict:
+        return {f"{phase}_seconds": seconds for phase, seconds in self.phases.items()}
+
+STARTUP = StartupTimer()
+
+def parse_importtime(output: str) -> Counter:
+    """
+    Self import time in seconds per top-level package from the stderr of
+    `python -X importtime`.
+    """
+    seconds: Counter = Counter()
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue  # the header line
+        seconds[name.strip().split(".")[0]] += int(self_us) / 1e6
+    return seconds
+
+def import_times(module: str = "src.main") -> Counter:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True)
+    return parse_importtime(result.stderr)
+
+def loaded_modules(module: str = "src.main") -> set[str]:
+    """
+    Every module loaded by importing `module` in a fresh interpreter.
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", f"import json, sys, {module}; print(json.dumps(sorted(sys.modules)))"],
+        capture_output=True, text=True, check=True)
+    return set(json.loads(result.stdout))
+
+def time_to_ready(env: dict | None = None) -> dict:
+    """
+    The startup phases of the app started in a fresh interpreter.
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", READY_SCRIPT], capture_output=True, text=True, check=True, env=env)
+    return json.loads(result.stdout.splitlines()[-1])
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Report where the startup time of the API goes.")
+    parser.add_argument("--top", type=int, default=15, help="packages to list")
+    parser.add_argument("--module", default="src.main", help="module to import")
+    args = parser.parse_args(argv)
+
+    seconds = import_times(args.module)
+    print(f"{'package':<28}{'import s':>9}")
+    for package, value in seconds.most_common(args.top):
+        print(f"{package:<28}{value:>9.3f}")
+    print(f"{'total':<28}{sum(seconds.values()):>9.3f}")
+
+    phases = time_to_ready()
+    print(", ".join(f"{phase.removesuffix('_seconds')} after {value:.2f} s" for phase, value in phases.items()))
+
+if __name__ == "__main__":
+    main()
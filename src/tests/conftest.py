@@ -1,3 +1,4 @@
+import os
 import pytest
 import sys
 from pathlib import Path
@@ -5,9 +6,15 @@ from fastapi.testclient import TestClient
 from sqlmodel import Session, SQLModel, create_engine
 from sqlmodel.pool import StaticPool
 from datetime import datetime, timezone
-from app.main import app
-from app.db import User, Message, Conversation
-from app.auth import get_session, get_current_user
+
+os.environ.setdefault("AUTH_SECRET_KEY", "test-secret-key")
+
+from src.main import app
+from src.db import User, Message, Conversation
+from src.auth import get_session, get_current_user, get_password_hash, token_cache, user_fingerprints
+from src.llm import get_rag_engine
+from src.persistence import MessageWriter, get_message_writer
+from langchain_core.documents import Document
 
 src_path = Path(__file__).parent.parent / "src"
 sys.path.append(str(src_path))
@@ -26,14 +33,20 @@ def client_fixture(session: Session):
     def get_session_override():
         return session
 
+    # Commit messages before responding, so tests can read them right away
+    writer = MessageWriter(lambda: Session(session.get_bind()), durability="committed")
     app.dependency_overrides[get_session] = get_session_override
+    app.dependency_overrides[get_message_writer] = lambda: writer
+    token_cache.clear()
+    user_fingerprints.clear()
     client = TestClient(app)
     yield client
     app.dependency_overrides.clear()
+    writer.close()
 
 @pytest.fixture(name="test_user")
 def test_user_fixture(session: Session):
-    user = User(username="testuser", password="hashed_password")
+    user = User(username="testuser", password=get_password_hash("testpassword"))
     session.add(user)
     session.commit()
     session.refresh(user)
@@ -45,4 +58,59 @@ def authenticated_client_fixture(client: TestClient, test_user: User):
         return test_user
 
     app.dependency_overrides[get_current_user] = get_current_user_override
-    return client
\ No newline at end of file
+    return client
+
+CHUNK = Document(
+    id="c0ffee-0", page_content="test context",
+    metadata={"corpus": "hume", "source": "text/hume.txt", "start_index": 42})
+
+class FakeRAGEngine:
+    def __init__(self, answer: str = "test answer"):
+        self.answer = answer
+        self.questions = []
+        self.windows = []
+        self.remembered = []
+
+    def stats(self) -> dict:
+        return {"limiter": {"in_flight": 0, "waiting": 0, "rejected": 0}}
+
+    def conversation_window(self, conversation_id: int, load):
+        window = [message.message for message in load(10)]
+        self.windows.append(window)
+        return window
+
+    def remember_turns(self, conversation_id: int, turns):
+        self.remembered.extend(turns)
+
+    def invoke(self, question: str, corpora=None, filter=None, window=None) -> dict:
+        self.questions.append(question)
+        return {
+            "question": question,
+            "context": [CHUNK],
+            "answer": self.answer
+        }
+
+    def get_chunk(self, chunk_id: str):
+        return CHUNK if chunk_id == CHUNK.id else None
+
+    async def ainvoke(self, question: str, corpora=None, filter=None, window=None, user=None) -> dict:
+        return self.invoke(question, corpora, filter)
+
+    async def astream(self, question: str, corpora=None, filter=None, window=None, user=None):
+        response = self.invoke(question, corpora, filter)
+        yield "context", response["context"]
+        for token in response["answer"].split(" "):
+            yield "token", token
+        yield "answer", response["answer"]
+
+    async def abatch_as_completed(self, items, return_exceptions=False, max_concurrency=None, user=None):
+        # Out of order, as answers complete
+        for i in reversed(range(len(items))):
+            question, corpora, filter = items[i]
+            yield i, self.invoke(question, corpora, filter)
+
+@pytest.fixture(name="rag_engine")
+def rag_engine_fixture():
+    engine = FakeRAGEngine()
+    app.dependency_overrides[get_rag_engine] = lambda: engine
+    return engine
@@ -1,7 +1,12 @@
 # tests/test_auth.py
+from unittest.mock import patch
 from fastapi import status
+from passlib.context import CryptContext
 import pytest
-from app.auth import get_password_hash, verify_password
+from sqlmodel import select
+from src import auth
+from src.auth import get_password_hash, token_cache, user_fingerprints, verify_password
+from src.db import Conversation, User
 
 def test_password_hashing():
     password = "testpassword"
@@ -41,4 +46,109 @@ def test_login_failure(client):
         "/auth/token",
         data={"username": "wronguser", "password": "wrongpassword"}
     )
-    assert response.status_code == status.HTTP_401_UNAUTHORIZED
\ No newline at end of file
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+def login(client, password="testpassword"):
+    response = client.post("/auth/token", data={"username": "testuser", "password": password})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+def test_verified_tokens_are_cached(client, test_user):
+    headers = login(client)
+    for _ in range(3):
+        response = client.get("/auth/users/me/", headers=headers)
+        assert response.json() == {"id": test_user.id, "username": "testuser"}
+    assert token_cache.stats()["hits"] == 2
+    assert token_cache.stats()["misses"] == 1
+
+def test_invalid_token_is_rejected(client, test_user):
+    response = client.get("/auth/users/me/", headers={"Authorization": "Bearer not-a-token"})
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+def test_stateless_tokens_skip_user_lookup(client, test_user):
+    with patch.object(auth.settings, "auth_stateless_tokens", True):
+        headers = login(client)
+        with patch.object(auth, "get_user", side_effect=AssertionError("unexpected lookup")):
+            response = client.get("/auth/users/me/", headers=headers)
+    assert response.json()["id"] == test_user.id
+
+def test_password_change_revokes_tokens(client, test_user):
+    old_headers = login(client)
+    assert client.get("/auth/users/me/", headers=old_headers).status_code == status.HTTP_200_OK
+
+    response = client.post(
+        "/auth/users/me/password",
+        json={"current_password": "wrong", "new_password": "newpassword"},
+        headers=old_headers)
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = client.post(
+        "/auth/users/me/password",
+        json={"current_password": "testpassword", "new_password": "newpassword"},
+        headers=old_headers)
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    assert client.get("/auth/users/me/", headers=old_headers).status_code == status.HTTP_401_UNAUTHORIZED
+
+    new_headers = login(client, "newpassword")
+    assert client.get("/auth/users/me/", headers=new_headers).status_code == status.HTTP_200_OK
+
+def test_revocation_outlives_the_process(client, session, test_user):
+    with patch.object(auth.settings, "auth_stateless_tokens", True):
+        headers = login(client)
+        assert client.get("/auth/users/me/", headers=headers).status_code == status.HTTP_200_OK
+
+        # Another worker changes the password; this one restarts
+        test_user.password = get_password_hash("newpassword")
+        test_user.password_version += 1
+        session.add(test_user)
+        session.commit()
+        token_cache.clear()
+        user_fingerprints.clear()
+        assert client.get("/auth/users/me/", headers=headers).status_code == status.HTTP_401_UNAUTHORIZED
+        assert client.get("/auth/users/me/", headers=login(client, "newpassword")).status_code == status.HTTP_200_OK
+
+def test_rehashing_keeps_stateless_tokens_valid(client, session, test_user):
+    with patch.object(auth.settings, "auth_stateless_tokens", True):
+        old_headers = login(client)
+        assert client.get("/auth/users/me/", headers=old_headers).status_code == status.HTTP_200_OK
+
+        with patch.object(auth, "pwd_context", CryptContext(schemes=["bcrypt"], bcrypt__rounds=4)):
+            new_headers = login(client)
+        session.refresh(test_user)
+        assert test_user.password.startswith("$2b$04$")
+        assert client.get("/auth/users/me/", headers=new_headers).status_code == status.HTTP_200_OK
+        assert client.get("/auth/users/me/", headers=old_headers).status_code == status.HTTP_200_OK
+
+        # Neither is revoked on another worker or after a restart
+        token_cache.clear()
+        user_fingerprints.clear()
+        for headers in (old_headers, new_headers):
+            assert client.get("/auth/users/me/", headers=headers).status_code == status.HTTP_200_OK
+
+def test_cached_tokens_are_rechecked_when_the_fingerprint_expires(client, session, test_user):
+    headers = login(client)
+    assert client.get("/auth/users/me/", headers=headers).status_code == status.HTTP_200_OK
+
+    # Deleted by another worker: this one notices once the fingerprint expires
+    session.delete(test_user)
+    session.commit()
+    assert client.get("/auth/users/me/", headers=headers).status_code == status.HTTP_200_OK
+    with patch.object(auth.user_fingerprints, "ttl", 0):
+        user_fingerprints.clear()
+        assert client.get("/auth/users/me/", headers=headers).status_code == status.HTTP_401_UNAUTHORIZED
+
+def test_deleted_user_tokens_are_rejected(client, session, test_user):
+    session.add(Conversation(user_id=test_user.id))
+    session.commit()
+    with patch.object(auth.settings, "auth_stateless_tokens", True):
+        headers = login(client)
+        assert client.delete("/auth/users/me", headers=headers).status_code == status.HTTP_204_NO_CONTENT
+        assert client.get("/auth/users/me/", headers=headers).status_code == status.HTTP_401_UNAUTHORIZED
+    assert session.exec(select(User)).first() is None
+
+def test_login_rehashes_when_work_factor_changes(client, session, test_user):
+    old_hash = test_user.password
+    with patch.object(auth, "pwd_context", CryptContext(schemes=["bcrypt"], bcrypt__rounds=4)):
+        login(client)
+    session.refresh(test_user)
+    assert test_user.password.startswith("$2b$04$")
+    assert test_user.password != old_hash
+    assert verify_password("testpassword", test_user.password)
@@ -0,0 +1,78 @@
+# tests/test_batching.py
+import asyncio
+import pytest
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from src.batching import MicroBatcher
+from src.retrieval import CorpusRetriever
+from src.vectorstore import NumpyVectorStore
+
+def test_batcher_returns_each_result_to_its_caller():
+    calls = []
+
+    async def handler(items):
+        calls.append(list(items))
+        return [item * 2 for item in items]
+
+    async def main():
+        batcher = MicroBatcher(handler, max_batch_size=4, max_wait=0.01)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(6)))
+        return batcher, results
+
+    batcher, results = asyncio.run(main())
+    assert results == [0, 2, 4, 6, 8, 10]
+    # Four items fill a batch at once, the other two wait for the window
+    assert calls == [[0, 1, 2, 3], [4, 5]]
+    assert batcher.stats()["batch_size_histogram"] == {2: 1, 4: 1}
+    assert batcher.stats()["mean_batch_size"] == 3.0
+
+def test_batcher_propagates_handler_errors():
+    async def handler(items):
+        raise ConnectionError("embedding service is down")
+
+    async def main():
+        batcher = MicroBatcher(handler, max_wait=0.001)
+        return await asyncio.gather(batcher.submit("a"), batcher.submit("b"), return_exceptions=True)
+
+    assert all(isinstance(result, ConnectionError) for result in asyncio.run(main()))
+
+class CountingEmbeddings(DeterministicFakeEmbedding):
+    calls: int = 0
+
+    async def aembed_documents(self, texts):
+        self.calls += 1
+        return self.embed_documents(texts)
+
+@pytest.mark.parametrize("backend", ["chroma", "numpy"])
+def test_retriever_batches_concurrent_searches(tmp_path, backend):
+    embeddings = CountingEmbeddings(size=16)
+    texts = [f"hume chunk {i}" for i in range(6)]
+    metadatas = [{"corpus": "hume", "book": f"BOOK {i % 2}"} for i in range(6)]
+    if backend == "numpy":
+        store = NumpyVectorStore(str(tmp_path / "numpy"), embeddings)
+        store.add_texts(texts, metadatas)
+    else:
+        store = Chroma(collection_name="corpus_hume", embedding_function=embeddings,
+                       persist_directory=str(tmp_path / "store"))
+        store.add_documents([Document(page_content=t, metadata=m) for t, m in zip(texts, metadatas)])
+    batched = CorpusRetriever(embeddings, {"hume": store}, k=2, batch_window=0.01)
+    plain = CorpusRetriever(embeddings, {"hume": store}, k=2)
+
+    questions = [f"hume chunk {i}" for i in range(6)]
+
+    async def main(retriever):
+        return await asyncio.gather(
+            *(retriever.asearch(q) for q in questions),
+            retriever.asearch("hume chunk 1", filter={"book": "BOOK 0"}))
+
+    results = asyncio.run(main(batched))
+    assert embeddings.calls == 1
+    assert batched.batcher.stats()["batch_size_histogram"] == {8: 1}
+    for question, docs in zip(questions, results):
+        assert docs[0].page_content == question
+    assert {doc.metadata["book"] for doc in results[-1]} == {"BOOK 0"}
+
+    expected = asyncio.run(main(plain))
+    assert [[d.page_content for d in docs] for docs in results] == \
+        [[d.page_content for d in docs] for docs in expected]
@@ -0,0 +1,64 @@
+# tests/test_cache.py
+import pytest
+from langchain_core.documents import Document
+from src.cache import (
+    AnswerCache, InMemoryCacheBackend, SQLiteCacheBackend, normalize_question
+)
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteCacheBackend(str(tmp_path / "cache.db"))
+    return InMemoryCacheBackend()
+
+def test_normalize_question():
+    assert normalize_question("  What is  Hume's view of causation? ") == \
+        "what is hume's view of causation"
+
+def test_exact_hit(backend):
+    cache = AnswerCache(backend)
+    cache.store("What is causation?", "An answer", [Document(id="c1", page_content="ctx", metadata={"start_index": 3})])
+
+    entry = cache.lookup("what is   causation")
+    assert entry.answer == "An answer"
+    assert entry.context[0].id == "c1"
+    assert entry.context[0].metadata == {"start_index": 3}
+    assert cache.stats()["exact_hits"] == 1
+
+def test_semantic_hit(backend):
+    cache = AnswerCache(backend, similarity_threshold=0.9)
+    cache.store("What is causation?", "An answer", [], embedding=[1.0, 0.0, 0.0])
+
+    assert cache.lookup("Explain causation", [0.99, 0.1, 0.0]).answer == "An answer"
+    assert cache.lookup("What is the self?", [0.0, 1.0, 0.0]) is None
+    stats = cache.stats()
+    assert stats["semantic_hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == 0.5
+
+def test_ttl_expiry(backend):
+    cache = AnswerCache(backend, ttl=0)
+    cache.store("What is causation?", "An answer", [])
+    assert cache.lookup("What is causation?") is None
+    assert len(backend) == 0
+
+def test_lru_eviction(backend):
+    cache = AnswerCache(backend, max_entries=2)
+    cache.store("question one", "1", [])
+    cache.store("question two", "2", [])
+    cache.lookup("question one")
+    cache.store("question three", "3", [])
+
+    assert cache.lookup("question two") is None
+    assert cache.lookup("question one").answer == "1"
+    assert cache.lookup("question three").answer == "3"
+
+def test_invalidate_on_namespace_change(backend):
+    cache = AnswerCache(backend)
+    cache.invalidate("corpus-v1")
+    cache.store("What is causation?", "An answer", [])
+
+    cache.invalidate("corpus-v1")
+    assert cache.contains("What is causation?")
+    cache.invalidate("corpus-v2")
+    assert not cache.contains("What is causation?")
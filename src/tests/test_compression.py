@@ -0,0 +1,65 @@
+# tests/test_compression.py
+import gzip
+import zlib
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.testclient import TestClient
+from src.compression import CompressionMiddleware, accepted_encodings
+
+BODY = "impressions and ideas " * 100
+
+app = FastAPI()
+app.add_middleware(CompressionMiddleware, minimum_size=500)
+
+@app.get("/large")
+def large() -> PlainTextResponse:
+    return PlainTextResponse(BODY)
+
+@app.get("/small")
+def small() -> PlainTextResponse:
+    return PlainTextResponse("ideas")
+
+@app.get("/lines")
+def lines() -> StreamingResponse:
+    return StreamingResponse((f"line {i}\n" for i in range(50)), media_type="application/x-ndjson")
+
+@app.get("/events")
+def events() -> StreamingResponse:
+    return StreamingResponse(iter([BODY]), media_type="text/event-stream")
+
+client = TestClient(app)
+
+def raw_get(path: str, encoding: str = "gzip"):
+    # httpx decodes responses itself; read the bytes as sent
+    with client.stream("GET", path, headers={"Accept-Encoding": encoding}) as response:
+        return response, b"".join(response.iter_raw())
+
+def test_accepted_encodings():
+    assert accepted_encodings("gzip, deflate, br;q=0") == {"gzip", "deflate"}
+    assert accepted_encodings("") == set()
+
+def test_compresses_large_responses():
+    response, body = raw_get("/large")
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert int(response.headers["Content-Length"]) == len(body) < len(BODY)
+    assert gzip.decompress(body).decode() == BODY
+
+def test_sends_small_and_unaccepted_responses_as_they_are():
+    response, body = raw_get("/small")
+    assert "Content-Encoding" not in response.headers
+    assert body == b"ideas"
+    response, body = raw_get("/large", encoding="identity")
+    assert "Content-Encoding" not in response.headers
+    assert body.decode() == BODY
+
+def test_compresses_streams_chunk_by_chunk():
+    response, body = raw_get("/lines")
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in response.headers
+    assert zlib.decompress(body, 31).decode() == "".join(f"line {i}\n" for i in range(50))
+
+def test_skips_event_streams():
+    response, body = raw_get("/events")
+    assert "Content-Encoding" not in response.headers
+    assert body.decode() == BODY
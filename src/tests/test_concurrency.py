@@ -0,0 +1,152 @@
+# tests/test_concurrency.py
+import asyncio
+import time
+import pytest
+from src.concurrency import CapacityExceeded, FairScheduler, QuotaExceeded, TokenBucket
+
+def test_limiter_caps_in_flight_calls():
+    limiter = FairScheduler(max_concurrent=2, max_waiting=10, timeout=1.0)
+    peak = 0
+
+    async def call():
+        nonlocal peak
+        async with limiter.slot():
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(*(call() for _ in range(6)))
+
+    asyncio.run(main())
+    assert peak == 2
+    assert limiter.in_flight == 0
+    assert limiter.rejected == 0
+
+def test_limiter_rejects_when_queue_is_full():
+    limiter = FairScheduler(max_concurrent=1, max_waiting=1, timeout=1.0)
+
+    async def call():
+        async with limiter.slot():
+            await asyncio.sleep(0.05)
+
+    async def main():
+        return await asyncio.gather(*(call() for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert sum(isinstance(r, CapacityExceeded) for r in results) == 1
+    assert limiter.rejected == 1
+
+def test_limiter_rejects_after_timeout():
+    limiter = FairScheduler(max_concurrent=1, max_waiting=5, timeout=0.01)
+
+    async def main():
+        async with limiter.slot():
+            with pytest.raises(CapacityExceeded):
+                async with limiter.slot():
+                    pass
+
+    asyncio.run(main())
+    assert limiter.rejected == 1
+
+class Clock:
+    now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+def test_token_bucket_reserves_ahead():
+    clock = Clock()
+    bucket = TokenBucket(rate=10.0, capacity=20.0, clock=clock)
+    assert bucket.reserve(15) == 0.0
+    assert bucket.reserve(15) == pytest.approx(1.0)
+    clock.now = 1.0
+    assert bucket.level == pytest.approx(0.0)
+    bucket.refund(100)
+    assert bucket.full
+
+def test_scheduler_serves_users_fairly():
+    scheduler = FairScheduler(max_concurrent=1, max_waiting=10, timeout=1.0)
+    order = []
+
+    async def call(user: str):
+        async with scheduler.slot(user):
+            order.append(user)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        # One user queues a burst before another user's single call
+        busy = [asyncio.ensure_future(call("script")) for _ in range(4)]
+        await asyncio.sleep(0)
+        await asyncio.gather(call("person"), *busy)
+
+    asyncio.run(main())
+    # FIFO order would run it last
+    assert order.index("person") == 1
+    assert scheduler.in_flight == 0 and not scheduler.waiters
+
+def test_scheduler_weights_users():
+    scheduler = FairScheduler(max_concurrent=1, max_waiting=10, timeout=1.0, weights={"paid": 3.0})
+    order = []
+
+    async def call(user: str):
+        async with scheduler.slot(user):
+            order.append(user)
+            await asyncio.sleep(0.001)
+
+    async def main():
+        await asyncio.gather(*(call(user) for _ in range(4) for user in ("free", "paid")))
+
+    asyncio.run(main())
+    assert order == ["free"] + ["paid"] * 4 + ["free"] * 3
+
+def test_scheduler_rejects_over_user_quota_early():
+    scheduler = FairScheduler(max_concurrent=4, max_waiting=10, timeout=1.0, user_requests_per_minute=2)
+
+    async def main():
+        for _ in range(2):
+            async with scheduler.slot("script"):
+                pass
+        with pytest.raises(QuotaExceeded) as rejected:
+            async with scheduler.slot("script"):
+                pass
+        # Other users keep their own quota
+        async with scheduler.slot("person"):
+            pass
+        return rejected.value
+
+    error = asyncio.run(main())
+    assert 25 < error.retry_after <= 30
+    assert scheduler.rejected == 1
+
+def test_scheduler_charges_used_tokens_against_budget():
+    scheduler = FairScheduler(
+        max_concurrent=4, max_waiting=10, timeout=1.0, tokens_per_minute=6000, expected_tokens=2000)
+
+    async def main():
+        async with scheduler.slot("person") as ticket:
+            ticket.used_tokens = 500
+        assert scheduler.budget.level == pytest.approx(5500, abs=1)
+        async with scheduler.slot("person") as ticket:
+            ticket.used_tokens = 5000
+        # 500 tokens left and 2000 expected: a 15 s wait is over the timeout
+        with pytest.raises(CapacityExceeded) as rejected:
+            async with scheduler.slot("other"):
+                pass
+        return rejected.value
+
+    error = asyncio.run(main())
+    assert not isinstance(error, QuotaExceeded)
+    assert error.retry_after == pytest.approx(15, abs=0.5)
+
+def test_scheduler_waits_for_budget():
+    scheduler = FairScheduler(
+        max_concurrent=4, max_waiting=10, timeout=1.0, tokens_per_minute=60000, expected_tokens=600)
+    scheduler.budget.reserve(60000 - 300)
+
+    async def main():
+        started = time.monotonic()
+        async with scheduler.slot("person"):
+            return time.monotonic() - started
+
+    # 300 tokens short at 1000 tokens per second
+    assert 0.25 < asyncio.run(main()) < 0.9
@@ -0,0 +1,70 @@
+# tests/test_context.py
+from langchain_core.documents import Document
+from src.context import ContextAssembler, merge_overlapping, trim_sentences, truncate_to_tokens
+from src.ingest import estimate_tokens
+from src.models import ContextReference
+
+TEXT = "".join(f"Sentence number {i} is about ideas. " for i in range(100))
+
+def chunk(start: int, end: int, source: str = "treatise.txt") -> Document:
+    return Document(
+        id=f"{source}:{start}",
+        page_content=TEXT[start:end],
+        metadata={"source": source, "start_index": start, "end_index": end})
+
+def test_merge_overlapping_chunks():
+    merged = merge_overlapping([
+        chunk(800, 1800), chunk(0, 1000), chunk(3000, 3500), chunk(0, 500, "other.txt")])
+    assert [doc.page_content for doc in merged] == [TEXT[0:1800], TEXT[3000:3500], TEXT[0:500]]
+    assert merged[0].id == "treatise.txt:800"
+    assert (merged[0].metadata["start_index"], merged[0].metadata["end_index"]) == (0, 1800)
+    assert merged[0].metadata["chunk_ids"] == ["treatise.txt:0", "treatise.txt:800"]
+    assert "chunk_ids" not in merged[1].metadata
+
+def test_references_to_merged_chunks_list_every_chunk():
+    merged = merge_overlapping([chunk(0, 1000), chunk(800, 1800)])
+    reference = ContextReference.from_document(merged[0])
+    assert (reference.id, reference.ids) == (None, ["treatise.txt:0", "treatise.txt:800"])
+    assert (reference.start_index, reference.length) == (0, 1800)
+    single = ContextReference.from_document(chunk(0, 1000))
+    assert (single.id, single.ids) == ("treatise.txt:0", ["treatise.txt:0"])
+
+def test_chunks_without_offsets_are_kept():
+    docs = [Document(page_content="a"), Document(page_content="a")]
+    assert merge_overlapping(docs) == docs
+
+def test_trim_sentences():
+    text = "Impressions are lively. The weather was fine. Ideas copy impressions."
+    assert trim_sentences("Where do ideas come from?", text) == "Ideas copy impressions."
+    assert trim_sentences("What about justice?", text) == text
+
+def test_truncate_to_tokens():
+    assert truncate_to_tokens("One two. Three four. Five six.", 4, estimate_tokens) == "One two."
+
+def test_adaptive_k_skips_redundant_and_weak_chunks():
+    vectors = {
+        "best": [0.95, 0.3, 0.0],
+        "duplicate": [0.95, 0.3, 0.0],
+        "other": [0.9, 0.0, 0.4],
+        "weak": [0.1, 1.0, 0.0],
+    }
+    candidates = [Document(page_content=f"{name} chunk") for name in vectors]
+    assembler = ContextAssembler(max_chunks=3, mmr_lambda=0.5)
+    docs, report = assembler.assemble("question", candidates, [1.0, 0.0, 0.0], list(vectors.values()))
+    assert [doc.page_content for doc in docs] == ["best chunk", "other chunk"]
+    assert report.candidates == 4
+    assert report.chunks == 2
+
+def test_without_vectors_the_ranking_is_kept():
+    candidates = [chunk(0, 500), chunk(2000, 2500), chunk(4000, 4500), chunk(6000, 6500)]
+    docs, _ = ContextAssembler(max_chunks=3).assemble("ideas", candidates, [1.0, 0.0], None)
+    assert docs == candidates[:3]
+
+def test_token_budget_cuts_the_last_chunk():
+    assembler = ContextAssembler(max_chunks=3, max_tokens=300)
+    docs, report = assembler.assemble("ideas", [chunk(0, 1000), chunk(2000, 3000), chunk(4000, 5000)])
+    assert docs[0].page_content == TEXT[0:1000]
+    assert TEXT[2000:3000].startswith(docs[1].page_content)
+    assert report.context_tokens <= 300
+    assert report.tokens_saved == report.baseline_tokens - report.context_tokens > 0
+    assert assembler.stats()["tokens_saved"] == report.tokens_saved
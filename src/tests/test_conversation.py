@@ -0,0 +1,63 @@
+# tests/test_conversation.py
+import asyncio
+from types import SimpleNamespace
+from langchain_core.documents import Document
+from langchain_core.language_models import FakeListChatModel
+from src.conversation import ConversationWindows, Turn, acondense_question, retrieval_scope
+
+def message(text: str, human: bool):
+    return SimpleNamespace(message=text, is_human_message=human)
+
+def test_window_is_loaded_once_and_kept_up_to_date():
+    loads = []
+
+    def load(limit):
+        loads.append(limit)
+        return [
+            message("What is an impression?", True),
+            message("A lively perception.", False),
+            message("What is an idea?", True),
+            message("A faint image of an impression.", False),
+        ]
+
+    windows = ConversationWindows(max_messages=4)
+    window = windows.get(7, load)
+    assert [t.question for t in window.turns] == ["What is an impression?", "What is an idea?"]
+
+    window.add(Turn("What is belief?", "A lively idea."))
+    assert windows.get(7, load) is window
+    # Only the last two turns fit in four messages
+    assert [t.question for t in window.turns] == ["What is an idea?", "What is belief?"]
+    assert loads == [4]
+    assert windows.stats()["window_hit_rate"] == 0.5
+
+def test_turns_saved_outside_conversation_mode_are_appended():
+    windows = ConversationWindows(max_messages=4)
+    windows.append(7, [("What is an idea?", "A faint image.")])
+    assert windows.stats()["conversations"] == 0
+
+    window = windows.get(7, lambda limit: [])
+    windows.append(7, [("What is an idea?", "A faint image."), ("What is belief?", "A lively idea.")])
+    assert window.history(100) == [("What is an idea?", "A faint image."), ("What is belief?", "A lively idea.")]
+
+def test_history_stays_within_token_budget():
+    windows = ConversationWindows(max_messages=10)
+    window = windows.get(1, lambda limit: [])
+    for i in range(5):
+        window.add(Turn(f"question {i} " + "x" * 40, f"answer {i} " + "y" * 40))
+    history = window.history(max_tokens=60)
+    assert [question.split(" x")[0] for question, _ in history] == ["question 3", "question 4"]
+
+def test_similar_turn_needs_same_scope():
+    window = ConversationWindows().get(1, lambda limit: [])
+    context = [Document(page_content="Of the origin of our ideas")]
+    window.add(Turn("q", "a", context, embedding=[1.0, 0.0], scope=retrieval_scope(None, None)))
+    assert window.similar_turn([0.9, 0.1], retrieval_scope(None, None), 0.9).context == context
+    assert window.similar_turn([0.0, 1.0], retrieval_scope(None, None), 0.9) is None
+    assert window.similar_turn([1.0, 0.0], retrieval_scope(["hume"], None), 0.9) is None
+
+def test_condense_question():
+    llm = FakeListChatModel(responses=["What does Hume say about the self?"])
+    history = [("What is personal identity?", "A fiction of the imagination.")]
+    assert asyncio.run(acondense_question(llm, "And the self?", history)) == "What does Hume say about the self?"
+    assert asyncio.run(acondense_question(llm, "What is the self?", [])) == "What is the self?"
@@ -0,0 +1,69 @@
+# tests/test_embeddings.py
+import asyncio
+import threading
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from src.config import LLMConfig, Settings
+from src.embeddings import CachedEmbeddings
+
+class CountingEmbeddings(DeterministicFakeEmbedding):
+    calls: list = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return super().embed_documents(texts)
+
+def make_cached(path, model="fake", dimensions=None):
+    underlying = CountingEmbeddings(size=8, calls=[])
+    return CachedEmbeddings(underlying, path=str(path), model=model, dimensions=dimensions)
+
+def test_only_missing_texts_are_embedded(tmp_path):
+    cached = make_cached(tmp_path / "emb.db")
+    first = cached.embed_documents(["a", "b"])
+    second = cached.embed_documents(["b", "c", "c"])
+
+    assert cached.underlying.calls == [["a", "b"], ["c"]]
+    assert second[0] == first[1]
+    assert second[1] == second[2]
+    assert (cached.hits, cached.misses) == (1, 3)
+
+def test_cache_persists_and_is_shared_with_queries(tmp_path):
+    vectors = make_cached(tmp_path / "emb.db").embed_documents(["a"])
+
+    cached = make_cached(tmp_path / "emb.db")
+    assert asyncio.run(cached.aembed_query("a")) == vectors[0]
+    assert cached.embed_query("a") == vectors[0]
+    assert cached.underlying.calls == []
+
+def test_async_embedding_reads_and_writes_the_cache_off_the_event_loop(tmp_path):
+    cached = make_cached(tmp_path / "emb.db")
+    threads = []
+    get_many, set_many = cached._get_many, cached._set_many
+    cached._get_many = lambda keys: threads.append(threading.get_ident()) or get_many(keys)
+    cached._set_many = lambda items: threads.append(threading.get_ident()) or set_many(items)
+
+    async def embed():
+        return threading.get_ident(), await cached.aembed_documents(["a", "b"])
+
+    loop_thread, vectors = asyncio.run(embed())
+    assert len(threads) == 2 and loop_thread not in threads
+    assert cached.embed_documents(["a", "b"]) == vectors
+    assert cached.underlying.calls == [["a", "b"]]
+
+def test_cache_is_keyed_by_model_and_dimension(tmp_path):
+    make_cached(tmp_path / "emb.db", model="fake").embed_documents(["a"])
+
+    other_model = make_cached(tmp_path / "emb.db", model="other")
+    other_model.embed_documents(["a"])
+    other_dimensions = make_cached(tmp_path / "emb.db", model="fake", dimensions=256)
+    other_dimensions.embed_documents(["a"])
+    assert other_model.underlying.calls == [["a"]]
+    assert other_dimensions.underlying.calls == [["a"]]
+
+def test_llm_config_wraps_embeddings(tmp_path):
+    settings = Settings(embedding_cache_path=str(tmp_path / "emb.db"))
+    embeddings = LLMConfig(settings).get_embeddings()
+    assert isinstance(embeddings, CachedEmbeddings)
+    assert embeddings.namespace == "llama3.2:default"
+
+    settings = Settings(embedding_cache_enabled=False)
+    assert not isinstance(LLMConfig(settings).get_embeddings(), CachedEmbeddings)
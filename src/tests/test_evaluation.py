@@ -0,0 +1,93 @@
+# tests/test_evaluation.py
+import json
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from src.corpus import Corpus, load_registry
+from src.evaluation import (
+    EVAL_QUESTIONS_PATH, EvalQuestion, HashingEmbeddings, first_relevant_rank,
+    load_questions, locate, mean_reciprocal_rank, recall_at_k, sweep,
+)
+
+PARAGRAPHS = [
+    "All the perceptions of the human mind resolve themselves into two distinct kinds.",
+    "Reason is, and ought only to be the slave of the passions.",
+    "Morality, therefore, is more properly felt than judged of.",
+]
+
+@pytest.fixture
+def corpus(tmp_path):
+    path = tmp_path / "text.txt"
+    filler = "Of the origin of our ideas and of custom and habit. " * 12
+    path.write_text("\n\n".join(f"{filler}\n{p}\n{filler}" for p in PARAGRAPHS), encoding="utf-8")
+    return Corpus(name="test", path=str(path))
+
+@pytest.fixture
+def questions_file(tmp_path, corpus):
+    path = tmp_path / "questions.json"
+    path.write_text(json.dumps({"corpus": "test", "questions": [
+        {"question": "What are the two kinds of perceptions?", "passage": PARAGRAPHS[0]},
+        {"question": "Is reason the slave of the passions?", "passage": PARAGRAPHS[1]},
+        {"question": "Is morality felt or judged?", "passage": PARAGRAPHS[2]},
+    ]}), encoding="utf-8")
+    return str(path)
+
+def test_locate_ignores_line_breaks():
+    text = "Of the will.\nReason is, and ought\n  only to be the slave"
+    start, end = locate("Reason is, and ought only to be", text)
+    assert text[start:end] == "Reason is, and ought\n  only to be"
+    assert locate("not in the text", text) is None
+
+def test_load_questions(questions_file, corpus):
+    loaded, questions = load_questions(questions_file, {"test": corpus})
+    assert loaded == corpus
+    text = open(corpus.path, encoding="utf-8").read()
+    assert [text[q.start:q.end] for q in questions] == PARAGRAPHS
+
+def test_load_questions_rejects_unknown_passages(tmp_path, corpus):
+    path = tmp_path / "questions.json"
+    path.write_text(json.dumps({"corpus": "test", "questions": [
+        {"question": "?", "passage": "a passage Hume never wrote"}]}), encoding="utf-8")
+    with pytest.raises(ValueError):
+        load_questions(str(path), {"test": corpus})
+
+def test_bundled_passages_are_in_the_corpus():
+    _, questions = load_questions(EVAL_QUESTIONS_PATH, load_registry())
+    assert len(questions) == 30
+
+def test_relevance_and_metrics():
+    question = EvalQuestion("?", "x" * 100, start=1000, end=1100)
+    covering = Document(page_content="y" * 500, metadata={"start_index": 800})
+    grazing = Document(page_content="y" * 500, metadata={"start_index": 1080})
+    elsewhere = Document(page_content="y" * 500, metadata={"start_index": 0})
+    assert first_relevant_rank([elsewhere, grazing, covering], question) == 3
+    assert first_relevant_rank([elsewhere], question) is None
+
+    ranks = [1, 3, None, 2]
+    assert recall_at_k(ranks, 1) == 0.25
+    assert recall_at_k(ranks, 3) == 0.75
+    assert mean_reciprocal_rank(ranks) == pytest.approx((1 + 1 / 3 + 1 / 2) / 4)
+
+def test_hashing_embeddings():
+    embeddings = HashingEmbeddings(dimensions=64)
+    a, b, c = embeddings.embed_documents([
+        "the slave of the passions", "reason is the slave of the passions", "the idea of time"])
+    assert a == embeddings.embed_query("the slave of the passions")
+    assert len(a) == 64 and np.linalg.norm(a) == pytest.approx(1.0)
+    assert np.dot(a, b) > np.dot(a, c)
+
+def test_sweep(questions_file, corpus):
+    _, questions = load_questions(questions_file, {"test": corpus})
+    rows = sweep(
+        corpus, questions, HashingEmbeddings(), chunk_sizes=[200, 400], overlaps=[0, 400],
+        backends=["numpy"], modes=["dense", "lexical"], ks=[1, 3])
+    # Overlaps as long as the chunks are skipped
+    assert [(r["chunk_size"], r["backend"], r["mode"]) for r in rows] == [
+        (200, "bm25", "lexical"), (200, "numpy", "dense"),
+        (400, "bm25", "lexical"), (400, "numpy", "dense"),
+    ]
+    for row in rows:
+        assert row["chunks"] > 0 and row["index_bytes"] > 0 and row["build_seconds"] > 0
+        assert row["recall"]["1"] <= row["recall"]["3"]
+        assert row["query_p50_ms"] <= row["query_p95_ms"]
+    assert rows[0]["recall"]["3"] == 1.0
@@ -0,0 +1,131 @@
+# tests/test_ingest.py
+import os
+from unittest.mock import patch
+import pytest
+from langchain_chroma import Chroma
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from src.corpus import Corpus
+from src.ingest import (
+    chunk_ids, get_text_splitter, ingest, iter_chunks, load_chunks,
+)
+
+class CountingEmbeddings(DeterministicFakeEmbedding):
+    embedded: list = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return super().embed_documents(texts)
+
+@pytest.fixture
+def text_file(tmp_path):
+    path = tmp_path / "text.txt"
+    paragraphs = [f"Paragraph {i}. " + "Of the origin of our ideas. " * 20 for i in range(30)]
+    paragraphs[0] = "BOOK I OF THE UNDERSTANDING\n\nPART I OF IDEAS\n\nSECT. I. OF THE ORIGIN OF OUR IDEAS."
+    paragraphs[15] = "SECT. II. DIVISION OF THE SUBJECT"
+    path.write_text("\n\n".join(paragraphs), encoding="utf-8")
+    return path
+
+@pytest.fixture
+def corpus(text_file):
+    return Corpus(name="test", path=str(text_file))
+
+@pytest.fixture
+def store(tmp_path):
+    embeddings = CountingEmbeddings(size=16, embedded=[])
+    vector_store = Chroma(
+        embedding_function=embeddings, persist_directory=str(tmp_path / "store"))
+    return vector_store, embeddings
+
+def test_iter_chunks_has_file_offsets(text_file):
+    text = text_file.read_text(encoding="utf-8")
+    for doc in iter_chunks(str(text_file), get_text_splitter(), segment_size=2000):
+        start, end = doc.metadata["start_index"], doc.metadata["end_index"]
+        assert text[start:end] == doc.page_content
+
+def test_iter_chunks_tracks_sections(text_file):
+    docs = list(iter_chunks(str(text_file), get_text_splitter(), segment_size=2000))
+    assert docs[1].metadata["book"] == "BOOK I"
+    assert docs[1].metadata["part"] == "PART I"
+    assert docs[1].metadata["section"] == "SECT. I"
+    assert docs[1].metadata["section_title"] == "OF THE ORIGIN OF OUR IDEAS."
+    assert docs[-1].metadata["section"] == "SECT. II"
+
+def test_iter_chunks_never_cross_sections(text_file):
+    docs = list(iter_chunks(str(text_file), get_text_splitter(), segment_size=2000))
+    for doc in docs:
+        assert doc.page_content.count("SECT.") <= 1
+        if "SECT. II." in doc.page_content:
+            assert doc.page_content.startswith("SECT. II.")
+    assert not any("BOOK I" in doc.page_content for doc in docs)
+
+def test_iter_chunks_strips_boilerplate(tmp_path):
+    path = tmp_path / "gutenberg.txt"
+    path.write_text(
+        "The Project Gutenberg eBook of A Treatise\n\nLicence header.\n\n"
+        "*** START OF THE PROJECT GUTENBERG EBOOK A TREATISE ***\n\n"
+        "CONTENTS\n\n   BOOK I. OF THE UNDERSTANDING\n   SECT. I. OF IDEAS\n\n"
+        "BOOK I. OF THE UNDERSTANDING\n\nSECT. I. OF IDEAS\n\nAll perceptions are impressions or ideas.\n\n"
+        "*** END OF THE PROJECT GUTENBERG EBOOK A TREATISE ***\n\nLicence footer.\n",
+        encoding="utf-8")
+    text = path.read_text(encoding="utf-8")
+    docs = list(iter_chunks(str(path), get_text_splitter()))
+    assert [doc.page_content for doc in docs] == ["SECT. I. OF IDEAS\n\nAll perceptions are impressions or ideas."]
+    assert docs[0].metadata["book_title"] == "OF THE UNDERSTANDING"
+    assert text[docs[0].metadata["start_index"]:docs[0].metadata["end_index"]] == docs[0].page_content
+
+def test_chunks_match_file_offsets_around_skipped_contents(tmp_path):
+    path = tmp_path / "treatise.txt"
+    path.write_text(
+        "BOOK I. OF THE UNDERSTANDING\n\nThe introduction to the book.\n\n"
+        "CONTENTS\n\n   SECT. I. OF IDEAS\n   SECT. II. OF IMPRESSIONS\n\n"
+        "All perceptions are impressions or ideas.\n",
+        encoding="utf-8")
+    text = path.read_text(encoding="utf-8")
+    docs = list(iter_chunks(str(path), get_text_splitter()))
+    assert [doc.page_content for doc in docs] == [
+        "BOOK I. OF THE UNDERSTANDING\n\nThe introduction to the book.",
+        "All perceptions are impressions or ideas."]
+    for doc in docs:
+        assert text[doc.metadata["start_index"]:doc.metadata["end_index"]] == doc.page_content
+        assert doc.metadata["book"] == "BOOK I"
+
+def test_load_chunks_reuses_artifact(tmp_path, text_file, corpus):
+    directory = str(tmp_path / "chunks")
+    docs = load_chunks(corpus, get_text_splitter(), directory)
+    assert len(os.listdir(directory)) == 1
+
+    with patch("src.ingest.iter_chunks") as iter_chunks_mock:
+        assert load_chunks(corpus, get_text_splitter(), directory) == docs
+    iter_chunks_mock.assert_not_called()
+
+    # Other splitter parameters or another text make a new artifact
+    smaller = load_chunks(corpus, get_text_splitter(chunk_size=500, chunk_overlap=50), directory)
+    assert len(smaller) > len(docs)
+    text_file.write_text(text_file.read_text(encoding="utf-8") + "\n\nMore.", encoding="utf-8")
+    assert load_chunks(corpus, get_text_splitter(), directory)[-1].page_content.endswith("More.")
+    assert len(os.listdir(directory)) == 1
+
+def test_ingest_is_incremental(text_file, corpus, store):
+    vector_store, embeddings = store
+    report = ingest(vector_store, embeddings, corpus, batch_size=4, workers=2)
+    assert report.embedded == report.chunks == vector_store._collection.count()
+    assert report.chunks_per_second > 0
+
+    embeddings.embedded.clear()
+    report = ingest(vector_store, embeddings, corpus, batch_size=4, workers=2)
+    assert report.embedded == 0
+    assert report.unchanged == report.chunks
+    assert embeddings.embedded == []
+
+    text = text_file.read_text(encoding="utf-8")
+    text_file.write_text(text.replace("Paragraph 29.", "Changed paragraph."), encoding="utf-8")
+    report = ingest(vector_store, embeddings, corpus, batch_size=4, workers=2)
+    assert 0 < report.embedded < report.chunks
+    assert report.deleted == report.embedded
+    assert vector_store._collection.count() == report.chunks
+    assert all("Changed paragraph." in text for text in embeddings.embedded)
+
+def test_chunk_ids_are_unique_for_repeated_chunks():
+    docs = list(get_text_splitter().create_documents(["same", "same"], [{"source": "a"}] * 2))
+    ids = chunk_ids(docs)
+    assert len(set(ids)) == 2
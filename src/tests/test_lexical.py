@@ -0,0 +1,37 @@
+# tests/test_lexical.py
+import numpy as np
+import pytest
+from src.lexical import BM25Index, tokenize
+
+@pytest.fixture
+def index():
+    texts = [
+        "Of the origin of our ideas and impressions.",
+        "All the perceptions of the human mind resolve themselves into impressions and ideas.",
+        "Of personal identity and the self.",
+        "Of the ideas of space and time.",
+    ]
+    metadatas = [{"book": "BOOK I", "i": i} for i in range(4)]
+    return BM25Index.build([f"id{i}" for i in range(4)], texts, metadatas)
+
+def test_tokenize_drops_stopwords():
+    assert tokenize("Of the Origin of our IDEAS, and impressions!") == ["origin", "our", "ideas", "impressions"]
+
+def test_search_ranks_exact_terms(index):
+    results = index.search("impressions and ideas", k=4)
+    assert {doc.id for doc, _ in results[:2]} == {"id0", "id1"}
+    assert [score for _, score in results] == sorted((score for _, score in results), reverse=True)
+
+    assert [doc.id for doc, _ in index.search("personal identity")] == ["id2"]
+    assert index.search("causation") == []
+
+def test_search_with_filter(index):
+    results = index.search("ideas", k=4, filter={"$and": [{"book": "BOOK I"}, {"i": 3}]})
+    assert [doc.id for doc, _ in results] == ["id3"]
+
+def test_save_and_load(index, tmp_path):
+    index.save(str(tmp_path))
+    loaded = BM25Index.load(str(tmp_path))
+    assert isinstance(loaded.postings, np.memmap)
+    assert [doc.id for doc, _ in loaded.search("space time")] == ["id3"]
+    np.testing.assert_allclose(loaded.scores("ideas"), index.scores("ideas"))
@@ -1,45 +1,303 @@
 # tests/test_llm.py
+import asyncio
 from unittest.mock import Mock, patch
 import pytest
-from app.llm import load_split_text, build_graph, setup_llm
-
-@pytest.fixture
-def mock_text_loader():
-    with patch("llm.TextLoader") as mock:
-        mock.return_value.load.return_value = [Mock(page_content="test content")]
-        yield mock
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models import FakeListChatModel
+from src.config import LLMConfig, Settings
+from src.corpus import Corpus, UnknownCorpus
+from src.vectorstore import NumpyVectorStore
+from src.llm import load_split_text, build_graph, initial_state, RAGEngine
+from src.metrics import LLM_TOKENS, STAGE_LATENCY
 
 @pytest.fixture
 def mock_text_splitter():
-    with patch("llm.RecursiveCharacterTextSplitter") as mock:
-        mock.return_value.split_documents.return_value = [
-            Mock(page_content="split content 1"),
-            Mock(page_content="split content 2")
+    with patch("src.llm.get_text_splitter") as mock:
+        mock.return_value.create_documents.return_value = [
+            Document(page_content="split content 1", metadata={"start_index": 0}),
+            Document(page_content="split content 2", metadata={"start_index": 16})
         ]
         yield mock
 
-def test_load_split_text(mock_text_loader, mock_text_splitter):
-    result = load_split_text("test.txt")
+@pytest.fixture
+def llm_config():
+    config = Mock()
+    config.settings = Settings(ingest_on_startup=True)
+    config.get_embeddings.return_value = DeterministicFakeEmbedding(size=16)
+    config.get_llm.return_value = FakeListChatModel(responses=["fake answer"])
+    return config
+
+@pytest.fixture
+def corpora(tmp_path):
+    path = tmp_path / "text.txt"
+    path.write_text("Of the origin of our ideas. " * 100, encoding="utf-8")
+    return {"test": Corpus(name="test", path=str(path))}
+
+def test_load_split_text(tmp_path, mock_text_splitter):
+    path = tmp_path / "test.txt"
+    path.write_text("split content 1 split content 2\n", encoding="utf-8")
+    result = load_split_text(str(path))
     assert len(result) == 2
     assert result[0].page_content == "split content 1"
     assert result[1].page_content == "split content 2"
 
-@patch("llm.ChatOllama")
-@patch("llm.Chroma")
-def test_build_graph(mock_chroma, mock_chat_ollama):
-    mock_vector_store = Mock()
-    mock_llm = Mock()
-    
-    graph = build_graph(mock_vector_store, mock_llm)
-    assert graph is not None
-    # Add more specific assertions based on your graph structure
-
-@patch("llm.ChatOllama")
-@patch("llm.OllamaEmbeddings")
-@patch("llm.Chroma")
-def test_setup_llm(mock_chroma, mock_embeddings, mock_chat_ollama):
-    with patch("llm.load_split_text") as mock_load_split:
-        mock_load_split.return_value = [Mock(page_content="test content")]
-        graph = setup_llm()
-        assert graph is not None
-        # Add more specific assertions based on your graph structure
\ No newline at end of file
+def test_build_graph():
+    mock_retriever = Mock()
+    mock_retriever.embed_question.return_value = [0.5, 0.5]
+    mock_retriever.search_by_vector.return_value = [
+        Document(page_content="test context")]
+    mock_llm = FakeListChatModel(responses=["test answer"])
+
+    graph = build_graph(mock_retriever, mock_llm)
+    response = graph.invoke(initial_state("test question", ["test"], {"book": "BOOK I"}))
+    assert response["answer"] == "test answer"
+    mock_retriever.search_by_vector.assert_called_once_with(
+        "test question", [0.5, 0.5], ["test"], {"book": "BOOK I"})
+    assert response["embedding"] == [0.5, 0.5]
+    assert response["context"][0].page_content == "test context"
+
+def test_rag_engine_builds_once(llm_config, corpora, tmp_path):
+    engine = RAGEngine(
+        llm_config, corpora=corpora, persist_directory=str(tmp_path / "store"))
+    assert not engine.ready
+
+    engine.warm_up()
+    graph = engine.graph
+    engine.warm_up()
+    assert engine.ready
+    assert engine.graph is graph
+    assert llm_config.get_llm.call_count == 1
+
+    response = engine.invoke("What is an idea?")
+    assert response["answer"] == "fake answer"
+    # The overlapping chunks of the small test corpus are merged into one
+    assert len(response["context"]) == 1
+    assert response["tokens_saved"] > 0
+
+def test_rag_engine_ainvoke(llm_config, corpora, tmp_path):
+    engine = RAGEngine(
+        llm_config, corpora=corpora, persist_directory=str(tmp_path / "store"))
+    engine.warm_up()
+
+    response = asyncio.run(engine.ainvoke("What is an idea?"))
+    assert response["answer"] == "fake answer"
+    assert len(response["context"]) == 1
+    assert engine.limiter.in_flight == 0
+
+def test_rag_engine_caches_answers(llm_config, corpora, tmp_path):
+    engine = RAGEngine(
+        llm_config, corpora=corpora, persist_directory=str(tmp_path / "store"))
+    engine.warm_up()
+    engine.llm.responses = ["first answer", "second answer"]
+
+    first = asyncio.run(engine.ainvoke("What is an idea?"))
+    second = asyncio.run(engine.ainvoke("what is an idea"))
+    assert first["answer"] == second["answer"] == "first answer"
+    assert second["context"] == first["context"]
+    assert engine.cache.stats()["exact_hits"] == 1
+
+    # The same embedding is a perfect semantic match
+    engine.cache.backend.clear()
+    engine.cache.store("What is an idea?", "cached", [], embedding=[1.0] * 16)
+    engine.retriever.aembed = Mock(side_effect=lambda q: asyncio.sleep(0, [1.0] * 16))
+    assert asyncio.run(engine.ainvoke("Tell me what ideas are"))["answer"] == "cached"
+    assert engine.cache.stats()["semantic_hits"] == 1
+
+def test_rag_engine_abatch(llm_config, corpora, tmp_path):
+    class CountingEmbeddings(DeterministicFakeEmbedding):
+        calls: list = []
+
+        async def aembed_documents(self, texts):
+            self.calls.append(texts)
+            return await super().aembed_documents(texts)
+
+    embeddings = CountingEmbeddings(size=16, calls=[])
+    llm_config.get_embeddings.return_value = embeddings
+    engine = RAGEngine(
+        llm_config, corpora=corpora, persist_directory=str(tmp_path / "store"))
+    engine.warm_up()
+    embeddings.calls.clear()
+
+    items = [(f"What is idea number {i}?", None, None) for i in range(4)] + [("What is an idea?", ["test"], None)]
+    responses = asyncio.run(engine.abatch(items, max_concurrency=2))
+    assert [response["question"] for response in responses] == [question for question, _, _ in items]
+    assert all(response["answer"] == "fake answer" and response["context"] for response in responses)
+    # One call for the answer cache and retrieval of the whole batch; the
+    # others embed retrieved chunks for context assembly
+    question_calls = [texts for texts in embeddings.calls if "What is an idea?" in texts]
+    assert question_calls == [[question for question, _, _ in items]]
+    assert engine.limiter.in_flight == 0
+
+    # Unscoped questions are answered from the cache the second time
+    responses = asyncio.run(engine.abatch(items[:4]))
+    assert engine.cache.stats()["exact_hits"] == 4
+
+    with pytest.raises(UnknownCorpus):
+        asyncio.run(engine.abatch([("What is an idea?", ["berkeley"], None)]))
+
+def test_rag_engine_astream(llm_config, corpora, tmp_path):
+    engine = RAGEngine(
+        llm_config, corpora=corpora, persist_directory=str(tmp_path / "store"))
+    engine.warm_up()
+
+    async def collect():
+        return [event async for event in engine.astream("What is an idea?")]
+
+    events = asyncio.run(collect())
+    assert events[0][0] == "context"
+    assert len(events[0][1]) == 1
+    assert events[1][0] == "usage" and events[1][1]["tokens_saved"] > 0
+    assert "".join(data for event, data in events if event == "token") == "fake answer"
+    assert events[-1] == ("answer", "fake answer")
+
+def test_rag_engine_reload(llm_config, corpora, tmp_path):
+    engine = RAGEngine(
+        llm_config, corpora=corpora, persist_directory=str(tmp_path / "store"))
+    engine.warm_up()
+    graph = engine.graph
+
+    engine.reload()
+    assert engine.graph is not graph
+    assert llm_config.get_llm.call_count == 2
+
+def test_rag_engine_rejects_unknown_corpus(llm_config, corpora, tmp_path):
+    engine = RAGEngine(
+        llm_config, corpora=corpora, persist_directory=str(tmp_path / "store"))
+    engine.warm_up()
+
+    with pytest.raises(UnknownCorpus):
+        asyncio.run(engine.ainvoke("What is an idea?", corpora=["locke_essay"]))
+    assert engine.limiter.in_flight == 0
+
+def test_rag_engine_numpy_backend(llm_config, corpora, tmp_path):
+    llm_config.settings = Settings(ingest_on_startup=True, vector_backend="numpy")
+    engine = RAGEngine(
+        llm_config, corpora=corpora, persist_directory=str(tmp_path / "store"))
+    engine.warm_up()
+
+    assert isinstance(engine.vector_stores["test"], NumpyVectorStore)
+    response = asyncio.run(engine.ainvoke("What is an idea?"))
+    assert response["answer"] == "fake answer"
+    assert len(response["context"]) == 1
+
+def test_rag_engine_conversation_mode(llm_config, corpora, tmp_path):
+    llm_config.get_llm.return_value = FakeListChatModel(responses=[
+        "Ideas are copied from impressions.",
+        "What is the origin of our ideas?",
+        "From impressions, as said before.",
+    ])
+    engine = RAGEngine(
+        llm_config, corpora=corpora, persist_directory=str(tmp_path / "store"))
+    engine.warm_up()
+    window = engine.conversation_window(1, lambda limit: [])
+
+    first = asyncio.run(engine.ainvoke("What is the origin of our ideas?", window=window))
+    assert first["answer"] == "Ideas are copied from impressions."
+
+    with patch.object(engine.retriever, "asearch", wraps=engine.retriever.asearch) as search:
+        second = asyncio.run(engine.ainvoke("And where do they come from?", window=window))
+    # The follow-up is condensed to the first question, so its context is reused
+    assert second["standalone_question"] == "What is the origin of our ideas?"
+    assert second["history"] == [("What is the origin of our ideas?", "Ideas are copied from impressions.")]
+    assert second["answer"] == "From impressions, as said before."
+    assert second["context"] == first["context"]
+    search.assert_not_called()
+
+    assert engine.conversation_window(1, lambda limit: []) is window
+    stats = engine.conversations.stats()
+    assert (stats["retrievals"], stats["context_reuses"], stats["window_hits"]) == (1, 1, 1)
+    # Follow-ups depend on the conversation and are not cached as answers
+    assert not engine.cache.contains("And where do they come from?")
+
+class SwitchableEmbeddings(DeterministicFakeEmbedding):
+    down: bool = False
+    calls: list = []
+
+    def embed_query(self, text):
+        if self.down:
+            raise ConnectionError("embedding service is down")
+        return super().embed_query(text)
+
+    async def aembed_query(self, text):
+        self.calls.append([text])
+        return self.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        self.calls.append(texts)
+        if self.down:
+            raise ConnectionError("embedding service is down")
+        return self.embed_documents(texts)
+
+def test_rag_engine_hybrid_mode_survives_embedding_failures(llm_config, corpora, tmp_path):
+    embeddings = SwitchableEmbeddings(size=16, calls=[])
+    llm_config.get_embeddings.return_value = embeddings
+    llm_config.settings = Settings(ingest_on_startup=True, retrieval_mode="hybrid")
+    engine = RAGEngine(
+        llm_config, corpora=corpora, persist_directory=str(tmp_path / "store"))
+    engine.warm_up()
+
+    # Context assembly uses the vectors stored with the chunks
+    embeddings.calls.clear()
+    response = asyncio.run(engine.ainvoke("What is an idea?", corpora=["test"]))
+    assert response["context"]
+    assert embeddings.calls == [["What is an idea?"]]
+
+    embeddings.down = True
+    response = asyncio.run(engine.ainvoke("What is the origin of ideas?", corpora=["test"]))
+    assert response["answer"] == "fake answer" and response["context"]
+    assert engine.retriever.embedding_fallbacks == 1
+
+    # A batch goes on with lexical retrieval
+    responses = asyncio.run(engine.abatch([
+        ("What is the origin of our ideas?", None, None), ("Of ideas?", ["test"], None)]))
+    assert all(response["answer"] == "fake answer" and response["context"] for response in responses)
+    assert engine.retriever.embedding_fallbacks == 3
+
+def test_rag_engine_embeds_concurrent_questions_once(llm_config, corpora, tmp_path):
+    embeddings = SwitchableEmbeddings(size=16, calls=[])
+    llm_config.get_embeddings.return_value = embeddings
+    engine = RAGEngine(
+        llm_config, corpora=corpora, persist_directory=str(tmp_path / "store"))
+    engine.warm_up()
+    embeddings.calls.clear()
+    questions = [f"What is idea number {i}?" for i in range(16)]
+
+    async def main():
+        return await asyncio.gather(*(engine.ainvoke(question) for question in questions))
+
+    responses = asyncio.run(main())
+    assert all(response["answer"] == "fake answer" for response in responses)
+    # One call for the answer cache lookups, retrieval and context assembly
+    assert embeddings.calls == [questions]
+
+def test_rag_engine_records_stage_timings(llm_config, corpora, tmp_path):
+    engine = RAGEngine(
+        llm_config, corpora=corpora, persist_directory=str(tmp_path / "store"))
+    engine.warm_up()
+    stages = ("retrieve", "assemble", "ttft", "generate")
+    before = {stage: STAGE_LATENCY.count(stage=stage) for stage in stages}
+    completion = LLM_TOKENS.value(kind="completion")
+
+    response = asyncio.run(engine.ainvoke("What is an idea?", user=7))
+    for stage in stages:
+        assert STAGE_LATENCY.count(stage=stage) == before[stage] + 1
+    assert LLM_TOKENS.value(kind="completion") > completion
+    assert response["llm_tokens"] > 0
+    stats = engine.stats()["limiter"]
+    assert (stats["in_flight"], stats["waiting"], stats["rejected"]) == (0, 0, 0)
+    assert engine.limiter.users[7].active == 0
+
+def test_bench_environment_uses_local_stand_ins(corpora, tmp_path):
+    settings = Settings(
+        environment="bench", ingest_on_startup=True, embedding_cache_enabled=False,
+        bench_llm_latency=0.0, bench_llm_tokens_per_second=1e6, bench_embedding_latency=0.0)
+    engine = RAGEngine(
+        LLMConfig(settings), corpora=corpora, persist_directory=str(tmp_path / "store"))
+    engine.warm_up()
+
+    first = asyncio.run(engine.ainvoke("What is an idea?", corpora=["test"]))
+    second = asyncio.run(engine.ainvoke("What is an idea?", corpora=["test"]))
+    assert first["answer"] == second["answer"]
+    assert len(first["answer"].split()) == settings.bench_answer_tokens
+    assert first["context"]
@@ -1,7 +1,12 @@
 # tests/test_main.py
+import json
+from datetime import datetime, timezone
 from unittest.mock import patch
 from fastapi import status
-from app.db import User, Message, Conversation
+from sqlmodel import select
+from src.concurrency import CapacityExceeded, QuotaExceeded
+from src.db import User, Message, Conversation
+from src.routing import LLMUnavailable
 import pytest
 
 def test_list_conversations_empty(authenticated_client):
@@ -40,14 +45,7 @@ def test_get_conversation_messages(authenticated_client, session, test_user):
     assert len(messages) == 1
     assert messages[0]["message"] == "Test message"
 
-@patch("main.state_graph")
-def test_ask_question(mock_state_graph, authenticated_client, session, test_user):
-    mock_state_graph.invoke.return_value = {
-        "question": "test question",
-        "context": ["test context"],
-        "answer": "test answer"
-    }
-    
+def test_ask_question(rag_engine, authenticated_client, session, test_user):
     response = authenticated_client.post(
         "/ask/",
         json={"question": "test question"}
@@ -56,9 +54,224 @@ def test_ask_question(mock_state_graph, authenticated_client, session, test_user
     assert response.status_code == status.HTTP_200_OK
     data = response.json()
     assert data["answer"] == "test answer"
+    assert rag_engine.questions == ["test question"]
     
     # Verify messages were stored
     messages = session.query(Message).all()
     assert len(messages) == 2  # Question and answer
     assert messages[0].message == "test question"
-    assert messages[1].message == "test answer"
\ No newline at end of file
+    assert messages[1].message == "test answer"
+
+def test_ask_question_with_context_references(rag_engine, authenticated_client):
+    response = authenticated_client.post(
+        "/ask/", json={"question": "test question", "context_format": "references", "snippet_length": 4})
+    assert response.status_code == status.HTTP_200_OK
+    data = response.json()
+    assert data["context"] == []
+    assert data["references"] == [{
+        "id": "c0ffee-0", "ids": ["c0ffee-0"], "corpus": "hume", "source": "text/hume.txt",
+        "start_index": 42, "length": 12, "snippet": "test"}]
+
+    chunk = authenticated_client.get(f"/chunks/{data['references'][0]['id']}")
+    assert chunk.status_code == status.HTTP_200_OK
+    assert chunk.json()["page_content"] == "test context"
+    assert "immutable" in chunk.headers["Cache-Control"]
+    cached = authenticated_client.get("/chunks/c0ffee-0", headers={"If-None-Match": chunk.headers["ETag"]})
+    assert cached.status_code == status.HTTP_304_NOT_MODIFIED
+    assert authenticated_client.get("/chunks/unknown").status_code == status.HTTP_404_NOT_FOUND
+
+def test_ask_question_in_conversation_mode(rag_engine, authenticated_client):
+    for question in ["first question", "follow-up question"]:
+        response = authenticated_client.post(
+            "/ask/", json={"question": question, "conversation": True})
+        assert response.status_code == status.HTTP_200_OK
+    # The window is loaded with the latest messages of the conversation, oldest first
+    assert rag_engine.windows == [[], ["first question", "test answer"]]
+    # The engine keeps the window up to date itself
+    assert rag_engine.remembered == []
+
+def test_plain_questions_reach_the_conversation_window(rag_engine, authenticated_client):
+    authenticated_client.post("/ask/", json={"question": "plain question"})
+    authenticated_client.post("/ask/batch", json=[{"question": "batched question"}])
+    assert rag_engine.remembered == [("plain question", "test answer"), ("batched question", "test answer")]
+
+def test_ask_question_over_capacity(rag_engine, authenticated_client, session):
+    async def overloaded(question, corpora=None, filter=None, window=None, user=None):
+        raise CapacityExceeded(retry_after=2.0)
+    rag_engine.ainvoke = overloaded
+
+    response = authenticated_client.post(
+        "/ask/",
+        json={"question": "test question"}
+    )
+
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.headers["retry-after"] == "2"
+    assert session.exec(select(Message)).all() == []
+
+def test_ask_question_over_quota(rag_engine, authenticated_client, session, test_user):
+    users = []
+
+    async def over_quota(question, corpora=None, filter=None, window=None, user=None):
+        users.append(user)
+        raise QuotaExceeded(retry_after=30.0)
+    rag_engine.ainvoke = over_quota
+
+    response = authenticated_client.post("/ask/", json={"question": "test question"})
+
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert response.headers["retry-after"] == "30"
+    assert users == [test_user.id]
+    assert session.exec(select(Message)).all() == []
+
+def test_ask_question_without_language_model(rag_engine, authenticated_client, session):
+    async def unavailable(question, corpora=None, filter=None, window=None, user=None):
+        raise LLMUnavailable(retry_after=12.0)
+    rag_engine.ainvoke = unavailable
+
+    response = authenticated_client.post(
+        "/ask/",
+        json={"question": "test question"}
+    )
+
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.headers["retry-after"] == "12"
+    assert session.exec(select(Message)).all() == []
+
+def test_ask_questions_batch(rag_engine, authenticated_client, session):
+    questions = [{"question": f"test question {i}"} for i in range(3)]
+    response = authenticated_client.post("/ask/batch", json=questions)
+
+    assert response.status_code == status.HTTP_200_OK
+    data = response.json()
+    assert [answer["index"] for answer in data] == [0, 1, 2]
+    assert [answer["question"] for answer in data] == [q["question"] for q in questions]
+    assert all(answer["answer"] == "test answer" for answer in data)
+
+    messages = session.exec(select(Message).order_by(Message.id)).all()
+    assert [m.message for m in messages[::2]] == [q["question"] for q in questions]
+    assert len({m.conversation_id for m in messages}) == 1
+
+def test_ask_questions_batch_stream(rag_engine, authenticated_client, session):
+    questions = [{"question": f"test question {i}"} for i in range(3)]
+    response = authenticated_client.post("/ask/batch?stream=true", json=questions)
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["index"] for line in lines] == [2, 1, 0]
+    assert len(session.exec(select(Message)).all()) == 6
+
+def test_ask_questions_batch_reports_failed_answers(rag_engine, authenticated_client, session):
+    async def partly_unavailable(items, return_exceptions=False, max_concurrency=None, user=None):
+        yield 0, rag_engine.invoke(items[0][0])
+        yield 1, LLMUnavailable()
+    rag_engine.abatch_as_completed = partly_unavailable
+
+    response = authenticated_client.post(
+        "/ask/batch", json=[{"question": "test question 0"}, {"question": "test question 1"}])
+
+    assert response.status_code == status.HTTP_200_OK
+    first, second = response.json()
+    assert first["answer"] == "test answer" and first["error"] is None
+    assert second["answer"] is None and "language model" in second["error"]
+    assert len(session.exec(select(Message)).all()) == 2
+
+def test_ask_questions_batch_validates_size(rag_engine, authenticated_client):
+    assert authenticated_client.post("/ask/batch", json=[]).status_code == 400
+    response = authenticated_client.post(
+        "/ask/batch", json=[{"question": "test question", "conversation": True}])
+    assert response.status_code == 400
+
+def test_ask_question_stream(rag_engine, authenticated_client, session):
+    response = authenticated_client.post(
+        "/ask/stream",
+        json={"question": "test question"}
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [
+        (block.split("\n")[0].removeprefix("event: "),
+         json.loads(block.split("\n")[1].removeprefix("data: ")))
+        for block in response.text.strip().split("\n\n")
+    ]
+    assert events[0][0] == "context"
+    assert events[0][1][0]["page_content"] == "test context"
+    assert [data["token"] for event, data in events if event == "token"] == ["test", "answer"]
+    assert events[-1] == ("done", {
+        "question": "test question",
+        "answer": "test answer",
+        "conversation_id": events[-1][1]["conversation_id"]
+    })
+
+    messages = session.exec(select(Message).order_by(Message.id)).all()
+    assert [m.message for m in messages] == ["test question", "test answer"]
+
+def test_history_keyset_pagination(authenticated_client, session, test_user):
+    conversation = Conversation(user_id=test_user.id)
+    session.add(conversation)
+    session.commit()
+    # Messages saved together share a timestamp; the id breaks the tie
+    timestamp = datetime.now(timezone.utc)
+    session.add_all([
+        Message(user_id=test_user.id, conversation_id=conversation.id,
+                message=f"message {i}", timestamp=timestamp)
+        for i in range(5)
+    ])
+    session.commit()
+
+    url = f"/conversation/{conversation.id}/messages/"
+    pages, after = [], None
+    while True:
+        params = {"limit": 2} | ({"after": after} if after else {})
+        response = authenticated_client.get(url, params=params)
+        assert response.status_code == status.HTTP_200_OK
+        pages.append([m["message"] for m in response.json()])
+        after = response.headers.get("X-Next-After")
+        if after is None:
+            break
+    assert pages == [["message 0", "message 1"], ["message 2", "message 3"], ["message 4"]]
+
+    assert authenticated_client.get(url, params={"after": 999}).status_code == status.HTTP_400_BAD_REQUEST
+    assert authenticated_client.get(url, params={"limit": 0}).status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+def test_list_conversations_pages(authenticated_client, session, test_user):
+    session.add_all([Conversation(user_id=test_user.id) for _ in range(3)])
+    session.commit()
+
+    response = authenticated_client.get("/user/me/conversations/", params={"limit": 2})
+    first_page = response.json()
+    assert len(first_page) == 2
+    assert response.headers["X-Next-After"] == str(first_page[-1]["id"])
+
+    response = authenticated_client.get(
+        "/user/me/conversations/", params={"after": response.headers["X-Next-After"]})
+    assert len(response.json()) == 1
+    assert "X-Next-After" not in response.headers
+
+def test_pages_reject_cursors_of_other_users(authenticated_client, session, test_user):
+    other = User(username="otheruser", password="hash")
+    session.add(other)
+    session.commit()
+    theirs = Conversation(user_id=other.id)
+    ours = Conversation(user_id=test_user.id)
+    session.add_all([theirs, ours])
+    session.commit()
+    message = Message(user_id=other.id, conversation_id=theirs.id, message="their message")
+    session.add(message)
+    session.commit()
+
+    response = authenticated_client.get("/user/me/conversations/", params={"after": theirs.id})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = authenticated_client.get(
+        f"/conversation/{ours.id}/messages/", params={"after": message.id})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert authenticated_client.get(f"/conversation/{theirs.id}/messages/").json() == []
+
+def test_next_page_header_is_exposed_to_browsers(authenticated_client, session, test_user):
+    session.add_all([Conversation(user_id=test_user.id) for _ in range(2)])
+    session.commit()
+    response = authenticated_client.get(
+        "/user/me/conversations/", params={"limit": 1}, headers={"Origin": "http://localhost:8501"})
+    assert "x-next-after" in response.headers["Access-Control-Expose-Headers"].lower()
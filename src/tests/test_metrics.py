@@ -0,0 +1,47 @@
+# tests/test_metrics.py
+from fastapi import status
+from src.metrics import REQUEST_LATENCY, Histogram, Registry, stats_lines
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    histogram = registry.histogram("test_seconds", "Test latency", ("stage",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value, stage="retrieve")
+    text = registry.render()
+
+    assert "# TYPE test_seconds histogram" in text
+    assert 'test_seconds_bucket{stage="retrieve",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{stage="retrieve",le="1"} 3' in text
+    assert 'test_seconds_bucket{stage="retrieve",le="+Inf"} 4' in text
+    assert 'test_seconds_count{stage="retrieve"} 4' in text
+    assert 'test_seconds_sum{stage="retrieve"} 6.05' in text
+
+def test_histogram_times_blocks():
+    histogram = Histogram("test_seconds", "Test latency", ("stage",))
+    with histogram.time(stage="auth"):
+        pass
+    assert histogram.count(stage="auth") == 1
+    assert histogram.count(stage="generate") == 0
+
+def test_stats_become_gauges():
+    lines = stats_lines("batcher", {
+        "batches": 3, "mean_batch_size": 2.5, "batch_size_histogram": {1: 1, 4: 2}, "mode": "dense"})
+    assert "lovechain_batcher_batches 3" in lines
+    assert "lovechain_batcher_mean_batch_size 2.5" in lines
+    assert 'lovechain_batcher_batch_size_histogram{key="4"} 2' in lines
+    assert not any("mode" in line for line in lines)
+
+def test_metrics_endpoint(rag_engine, authenticated_client):
+    before = REQUEST_LATENCY.count(method="POST", route="/ask/", status="200")
+    authenticated_client.post("/ask/", json={"question": "test question"})
+    assert REQUEST_LATENCY.count(method="POST", route="/ask/", status="200") == before + 1
+
+    response = authenticated_client.get("/metrics")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'lovechain_http_request_duration_seconds_count{method="POST",route="/ask/",status="200"}' in response.text
+    assert 'lovechain_stage_duration_seconds_count{stage="conversation"}' in response.text
+    assert 'lovechain_http_response_size_bytes_count{method="POST",route="/ask/"}' in response.text
+    assert "lovechain_message_writer_written 2" in response.text
+    assert "lovechain_limiter_in_flight 0" in response.text
+    assert "lovechain_auth_token_cache_hit_rate" in response.text
@@ -0,0 +1,57 @@
+# tests/test_persistence.py
+import asyncio
+import pytest
+from sqlmodel import Session, SQLModel, create_engine, select
+from sqlmodel.pool import StaticPool
+from src.db import Conversation, Message, User
+from src.persistence import MessageWriter
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(User(id=1, username="testuser", password="-"))
+        session.add(Conversation(id=1, user_id=1))
+        session.commit()
+    return engine
+
+def count_messages(engine) -> int:
+    with Session(engine) as session:
+        return len(session.exec(select(Message)).all())
+
+def test_buffered_saves_are_batched_and_flushed_on_close(engine):
+    writer = MessageWriter(lambda: Session(engine), flush_interval=0.2)
+
+    async def main():
+        await asyncio.gather(*(writer.save(1, 1, f"question {i}", "answer") for i in range(20)))
+
+    asyncio.run(main())
+    writer.close()
+    assert count_messages(engine) == 40
+    assert writer.stats()["batches"] == 1
+    assert writer.stats()["queued"] == 0
+
+def test_committed_save_waits_for_the_commit(engine):
+    writer = MessageWriter(lambda: Session(engine), durability="committed")
+
+    async def main():
+        await writer.save(1, 1, "question", "answer")
+        return count_messages(engine)
+
+    assert asyncio.run(main()) == 2
+    writer.close()
+
+def test_committed_save_reports_failed_commits(engine):
+    def broken_session():
+        raise ConnectionError("database is down")
+
+    writer = MessageWriter(broken_session, durability="committed")
+    with pytest.raises(ConnectionError):
+        asyncio.run(writer.save(1, 1, "question", "answer"))
+    writer.close()
+    assert writer.stats()["failed"] == 2
+
+def test_unknown_durability():
+    with pytest.raises(ValueError):
+        MessageWriter(lambda: None, durability="eventually")
@@ -0,0 +1,41 @@
+# tests/test_profiling.py
+import time
+from unittest.mock import patch
+from fastapi import status
+from src import auth
+from src.profiling import SamplingProfiler
+
+def busy(seconds: float) -> None:
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+def test_sampling_profiler_collapses_stacks():
+    with SamplingProfiler(interval=0.001) as profiler:
+        busy(0.05)
+    assert profiler.samples > 0
+    line = profiler.collapsed().splitlines()[0]
+    stack, count = line.rsplit(" ", 1)
+    assert "busy (" in stack.split(";")[-1]
+    assert int(count) > 0
+
+def login(client) -> dict:
+    response = client.post("/auth/token", data={"username": "testuser", "password": "testpassword"})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+def test_admins_get_a_profile(client, test_user):
+    headers = {**login(client), "X-Profile": "1"}
+    with patch.object(auth.settings, "admin_users", ["testuser"]):
+        response = client.get("/auth/users/me/", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/plain")
+    assert response.headers["x-profiled-status"] == "200"
+    counts = [int(line.rsplit(" ", 1)[1]) for line in response.text.splitlines()]
+    assert sum(counts) == int(response.headers["x-profile-samples"])
+
+def test_profile_header_is_ignored_for_other_users(client, test_user):
+    headers = {**login(client), "X-Profile": "1"}
+    response = client.get("/auth/users/me/", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["username"] == "testuser"
+    assert "x-profiled-status" not in response.headers
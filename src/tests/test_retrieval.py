@@ -0,0 +1,133 @@
+# tests/test_retrieval.py
+import asyncio
+import pytest
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from src.corpus import UnknownCorpus, load_registry
+from src.lexical import BM25Index
+from src.retrieval import CorpusRetriever, reciprocal_rank_fusion, to_where
+
+@pytest.fixture
+def retriever(tmp_path):
+    embeddings = DeterministicFakeEmbedding(size=16)
+    stores = {}
+    for name in ["hume", "locke"]:
+        stores[name] = Chroma(
+            collection_name=f"corpus_{name}",
+            embedding_function=embeddings,
+            persist_directory=str(tmp_path / "store"),
+        )
+        stores[name].add_documents([
+            Document(page_content=f"{name} chunk {i}", metadata={"corpus": name, "book": f"BOOK {i % 2}"})
+            for i in range(4)
+        ])
+    return CorpusRetriever(embeddings, stores, k=3)
+
+def test_search_merges_collections_by_score(retriever):
+    # Deterministic fake embeddings only match identical text
+    docs = retriever.search("locke chunk 2")
+    assert docs[0].page_content == "locke chunk 2"
+    assert {doc.metadata["corpus"] for doc in asyncio.run(retriever.asearch("hume chunk 1", k=8))} == {"hume", "locke"}
+
+def test_search_routes_to_selected_corpora(retriever):
+    docs = asyncio.run(retriever.asearch("locke chunk 2", corpora=["hume"]))
+    assert len(docs) == 3
+    assert {doc.metadata["corpus"] for doc in docs} == {"hume"}
+
+    with pytest.raises(UnknownCorpus):
+        retriever.search("locke chunk 2", corpora=["berkeley"])
+
+def test_search_with_filter(retriever):
+    docs = retriever.search("hume chunk 1", filter={"corpus": "hume", "book": "BOOK 0"})
+    assert sorted(doc.page_content for doc in docs) == ["hume chunk 0", "hume chunk 2"]
+
+def test_to_where():
+    assert to_where(None) is None
+    assert to_where({"book": "BOOK I"}) == {"book": "BOOK I"}
+    assert to_where({"book": "BOOK I", "part": "PART II"}) == \
+        {"$and": [{"book": "BOOK I"}, {"part": "PART II"}]}
+
+def test_default_registry():
+    registry = load_registry()
+    assert registry["hume_treatise"].collection_name == "corpus_hume_treatise"
+
+class FailingEmbeddings(DeterministicFakeEmbedding):
+    def embed_query(self, text):
+        raise ConnectionError("embedding service is down")
+
+    async def aembed_query(self, text):
+        raise ConnectionError("embedding service is down")
+
+    async def aembed_documents(self, texts):
+        raise ConnectionError("embedding service is down")
+
+def lexical_indexes(retriever):
+    indexes = {}
+    for name, store in retriever.stores.items():
+        data = store._collection.get(include=["documents", "metadatas"])
+        indexes[name] = BM25Index.build(data["ids"], data["documents"], data["metadatas"])
+    return indexes
+
+def test_lexical_mode_needs_no_embeddings(retriever):
+    lexical = CorpusRetriever(
+        FailingEmbeddings(size=16), retriever.stores, k=2,
+        lexical=lexical_indexes(retriever), mode="lexical")
+    docs = asyncio.run(lexical.asearch("locke chunk", corpora=["locke"]))
+    assert len(docs) == 2
+    assert all(doc.metadata["corpus"] == "locke" for doc in docs)
+
+def test_hybrid_falls_back_to_lexical(retriever):
+    hybrid = CorpusRetriever(
+        FailingEmbeddings(size=16), retriever.stores, k=3,
+        lexical=lexical_indexes(retriever), mode="hybrid")
+    assert len(hybrid.search("hume chunk")) == 3
+    assert len(asyncio.run(hybrid.asearch("hume chunk"))) == 3
+    assert hybrid.embedding_fallbacks == 2
+
+def test_hybrid_fuses_rankings(retriever):
+    hybrid = CorpusRetriever(
+        retriever.embeddings, retriever.stores, k=3,
+        lexical=lexical_indexes(retriever), mode="hybrid")
+    docs = asyncio.run(hybrid.asearch("locke chunk 2"))
+    # Top of both the dense and the lexical ranking
+    assert docs[0].page_content == "locke chunk 2"
+    assert hybrid.embedding_fallbacks == 0
+
+def test_search_many_matches_single_searches(retriever):
+    questions = ["hume chunk 1", "locke chunk 2", "hume chunk 3"]
+    corpora = [None, ["locke"], ["hume"]]
+    filters = [None, None, {"book": "BOOK 1"}]
+    batched = asyncio.run(retriever.asearch_many(questions, corpora, filters))
+    single = [
+        asyncio.run(retriever.asearch(question, names, filter))
+        for question, names, filter in zip(questions, corpora, filters)
+    ]
+    assert [[doc.page_content for doc in docs] for docs in batched] == \
+        [[doc.page_content for doc in docs] for docs in single]
+
+    hybrid = CorpusRetriever(
+        FailingEmbeddings(size=16), retriever.stores, k=3,
+        lexical=lexical_indexes(retriever), mode="hybrid")
+    vectors = retriever.embeddings.embed_documents(questions)
+    found = asyncio.run(hybrid.asearch_many_by_vector(questions, vectors, corpora, filters))
+    assert found[1][0].page_content == "locke chunk 2"
+    assert hybrid.embedding_fallbacks == 0
+
+    # Embedding all questions fails: they are all searched lexically
+    found = asyncio.run(hybrid.asearch_many(questions, corpora, filters))
+    assert [len(docs) for docs in found] == [3, 3, 2]
+    assert found[1][0].page_content == "locke chunk 2"
+    assert hybrid.embedding_fallbacks == 3
+
+def test_stored_vectors(retriever):
+    docs = retriever.search("locke chunk 2") + retriever.search("hume chunk 1")
+    vectors = retriever.stored_vectors(docs)
+    assert len(vectors) == len(docs)
+    assert list(vectors[0]) == pytest.approx(retriever.embeddings.embed_query("locke chunk 2"), abs=1e-6)
+    # Chunks without a stored vector
+    assert retriever.stored_vectors([Document(page_content="locke chunk 2")]) is None
+
+def test_reciprocal_rank_fusion():
+    a, b, c = (Document(id=i, page_content=i) for i in "abc")
+    assert [d.id for d in reciprocal_rank_fusion([[a, b, c], [b, c]], k=2)] == ["b", "c"]
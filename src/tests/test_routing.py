@@ -0,0 +1,147 @@
+# tests/test_routing.py
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import HumanMessage
+from src.bench import BenchChatModel
+from src.config import LLMConfig, Settings
+from src.routing import CircuitBreaker, LLMUnavailable, Provider, RoutedChatModel
+
+class FailingChatModel(BaseChatModel):
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "failing"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        raise ConnectionError("provider down")
+
+class Clock:
+    now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+def bench(latency: float) -> BenchChatModel:
+    return BenchChatModel(latency=latency, tokens_per_second=1e6, answer_tokens=5)
+
+def router(*models, **kwargs) -> RoutedChatModel:
+    return RoutedChatModel(
+        providers=[Provider(name=f"p{i}", model=model) for i, model in enumerate(models)], **kwargs)
+
+def test_breaker_opens_and_recovers():
+    clock = Clock()
+    breaker = CircuitBreaker(window=4, min_calls=2, error_rate=0.5, cooldown=10.0, clock=clock)
+    breaker.record(True)
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.retry_after() == 10.0
+
+    clock.now = 10.0
+    assert breaker.allow()
+    # Only one trial call at a time
+    assert not breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open"
+
+    clock.now = 20.0
+    assert breaker.allow()
+    breaker.record(True, latency=0.1)
+    assert breaker.state == "closed"
+    assert breaker.error_rate == 0.0
+
+def test_router_hedges_slow_provider():
+    llm = router(bench(1.0), bench(0.0), hedge_delay=0.05)
+    answer = asyncio.run(llm.ainvoke("What is an idea?"))
+    assert len(answer.content.split()) == 5
+    stats = llm.stats()
+    assert stats["hedged"] == 1
+    assert stats["wins"] == {"p0": 0, "p1": 1}
+    assert stats["error_rate"] == {"p0": 1.0, "p1": 0.0}
+
+def test_router_does_not_hedge_fast_provider():
+    llm = router(bench(0.0), bench(0.0), hedge_delay=0.5)
+    asyncio.run(llm.ainvoke("What is an idea?"))
+    assert llm.stats()["hedged"] == 0
+    assert llm.stats()["wins"] == {"p0": 1, "p1": 0}
+
+def test_router_falls_back_on_errors():
+    failing = FailingChatModel()
+    llm = router(failing, bench(0.0), hedge_delay=None)
+    assert asyncio.run(llm.ainvoke("What is an idea?")).content
+    assert llm.invoke("What is an idea?").content
+    assert failing.calls == 2
+    assert llm.stats()["fallbacks"] == 2
+
+def test_router_skips_open_circuits():
+    failing = FailingChatModel()
+    llm = RoutedChatModel(providers=[
+        Provider(name="down", model=failing, breaker=CircuitBreaker(min_calls=1)),
+        Provider(name="local", model=bench(0.0)),
+    ])
+    for _ in range(3):
+        asyncio.run(llm.ainvoke("What is an idea?"))
+    assert failing.calls == 1
+    assert llm.stats()["circuit_open"] == {"down": 1, "local": 0}
+
+def test_router_enforces_deadline():
+    llm = router(bench(1.0), hedge_delay=None, deadline=0.05)
+    with pytest.raises(LLMUnavailable):
+        asyncio.run(llm.ainvoke("What is an idea?"))
+    assert llm.stats()["unavailable"] == 1
+
+class StubOpenAI(BaseHTTPRequestHandler):
+    """
+    An OpenAI compatible chat completions endpoint streaming a fixed answer,
+    or failing with `status`.
+    """
+    status = 200
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        if self.status != 200:
+            self.send_response(self.status)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"error": {"message": "unavailable"}}).encode())
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for token in ("Impressions ", "and ", "ideas"):
+            chunk = {"id": "1", "object": "chat.completion.chunk", "created": 0, "model": "stub",
+                     "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def stub_servers():
+    servers = []
+    for status in (500, 200):
+        handler = type("Handler", (StubOpenAI,), {"status": status})
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    yield [f"http://127.0.0.1:{server.server_address[1]}/v1" for server in servers]
+    for server in servers:
+        server.shutdown()
+
+def test_router_against_stub_servers(stub_servers):
+    failing, working = stub_servers
+    settings = Settings(
+        openai_api_key="test", llm_providers=[f"openai:stub@{failing}", f"openai:stub@{working}"])
+    llm = LLMConfig(settings).get_llm()
+    answer = asyncio.run(llm.ainvoke([HumanMessage("What are perceptions?")]))
+    assert answer.content == "Impressions and ideas"
+    assert llm.stats()["fallbacks"] == 1
+    assert llm.stats()["wins"] == {"openai:stub": 0, "openai:stub#2": 1}
@@ -0,0 +1,47 @@
+# tests/test_startup.py
+import os
+import pytest
+from src.startup import StartupTimer, import_times, loaded_modules, parse_importtime, time_to_ready
+
+# Seconds on a single core; importing the app took 3.0-3.4 s and starting it
+# 3.5-3.9 s while every provider and the RAG stack were imported up front
+IMPORT_BUDGET = 3.5
+READY_BUDGET = 6.0
+# Only imported once a model of the provider or the engine is built
+DEFERRED_PACKAGES = ("langchain_openai", "langchain_ollama", "langchain_chroma", "chromadb", "langgraph")
+
+def test_parse_importtime():
+    output = (
+        "import time: self [us] | cumulative | imported package\n"
+        "import time:       200 |        200 |     fastapi.params\n"
+        "import time:      1000 |       1200 |   fastapi\n"
+        "import time:       500 |        500 | src.config\n"
+    )
+    assert parse_importtime(output) == {"fastapi": pytest.approx(0.0012), "src": pytest.approx(0.0005)}
+
+def test_startup_timer_keeps_first_mark():
+    timer = StartupTimer()
+    first = timer.mark("import")
+    assert timer.mark("import") == first
+    assert set(timer.stats()) == {"import_seconds"}
+
+def test_app_import_defers_providers_and_rag_stack():
+    modules = loaded_modules("src.main")
+    assert "src.main" in modules
+    assert not [name for name in modules if name.split(".")[0] in DEFERRED_PACKAGES]
+
+def test_app_import_within_budget():
+    assert sum(import_times("src.main").values()) < IMPORT_BUDGET
+
+def test_time_to_ready_within_budget(tmp_path):
+    env = {
+        **os.environ,
+        "ENVIRONMENT": "bench",
+        "AUTH_SECRET_KEY": "test-secret-key",
+        "DATABASE_URL": f"sqlite:///{tmp_path}/database.db",
+        "VECTOR_STORE_PATH": str(tmp_path / "vector_store"),
+        "EMBEDDING_CACHE_PATH": str(tmp_path / "embedding_cache.db"),
+        "ANSWER_CACHE_PATH": str(tmp_path / "answer_cache.db"),
+    }
+    phases = time_to_ready(env)
+    assert phases["import_seconds"] <= phases["ready_seconds"] < READY_BUDGET
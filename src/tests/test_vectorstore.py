@@ -0,0 +1,75 @@
+# tests/test_vectorstore.py
+import numpy as np
+import pytest
+from langchain_chroma import Chroma
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from src.vectorstore import NumpyVectorStore
+
+@pytest.fixture
+def embeddings():
+    return DeterministicFakeEmbedding(size=32)
+
+@pytest.fixture
+def texts():
+    return [f"chunk number {i}" for i in range(20)]
+
+@pytest.mark.parametrize("dtype", ["float32", "float16", "int8"])
+def test_search_finds_exact_match(tmp_path, embeddings, texts, dtype):
+    store = NumpyVectorStore.from_texts(
+        texts, embeddings,
+        metadatas=[{"even": i % 2 == 0} for i in range(20)],
+        path=str(tmp_path / "index"), dtype=dtype)
+
+    results = store.similarity_search_with_score("chunk number 7", k=3)
+    assert results[0][0].page_content == "chunk number 7"
+    assert results[0][1] == pytest.approx(0.0, abs=0.02)
+    assert [d for _, d in results] == sorted(d for _, d in results)
+
+    docs = store.similarity_search("chunk number 7", k=5, filter={"even": True})
+    assert len(docs) == 5
+    assert all(doc.metadata["even"] for doc in docs)
+
+def test_index_is_memory_mapped_and_reopened(tmp_path, embeddings, texts):
+    path = str(tmp_path / "index")
+    NumpyVectorStore.from_texts(texts, embeddings, path=path, dtype="float16")
+
+    store = NumpyVectorStore(path, embeddings)
+    assert isinstance(store._matrix, np.memmap)
+    assert store.dtype == "float16"
+    assert len(store) == 20
+
+    first, second = store.ids[:2]
+    assert [doc.page_content for doc in store.get_by_ids([second, "unknown"])] == ["chunk number 1"]
+    store.delete(ids=[first])
+    assert len(NumpyVectorStore(path, embeddings)) == 19
+    assert store.get_by_ids([first]) == []
+    assert store.get_by_ids([second])[0].id == second
+
+@pytest.mark.parametrize("dtype", ["float32", "int8"])
+def test_get_vectors(tmp_path, embeddings, texts, dtype):
+    store = NumpyVectorStore.from_texts(texts, embeddings, path=str(tmp_path / "index"), dtype=dtype)
+    vectors = store.get_vectors([store.ids[3], "unknown"])
+    assert list(vectors) == [store.ids[3]]
+    expected = np.asarray(embeddings.embed_query("chunk number 3"))
+    assert np.dot(vectors[store.ids[3]], expected / np.linalg.norm(expected)) == pytest.approx(1.0, abs=0.01)
+
+def test_batched_search_matches_single_search(tmp_path, embeddings, texts):
+    store = NumpyVectorStore.from_texts(texts, embeddings, path=str(tmp_path / "index"))
+    queries = [embeddings.embed_query(text) for text in texts[:4]]
+
+    batched = store.similarity_search_by_vectors_with_relevance_scores(queries, k=2)
+    for query, results in zip(queries, batched):
+        single = store.similarity_search_by_vector_with_relevance_scores(query, k=2)
+        assert [doc.id for doc, _ in results] == [doc.id for doc, _ in single]
+
+def test_export_from_chroma(tmp_path, embeddings, texts):
+    chroma = Chroma(embedding_function=embeddings, persist_directory=str(tmp_path / "chroma"))
+    chroma.add_texts(texts, metadatas=[{"i": i} for i in range(20)])
+
+    store = NumpyVectorStore.from_chroma(chroma, str(tmp_path / "index"), dtype="int8")
+    assert len(store) == 20
+    assert store.dtype == "int8"
+    chroma_top = chroma.similarity_search("chunk number 3", k=1)[0]
+    numpy_top = store.similarity_search("chunk number 3", k=1)[0]
+    assert numpy_top.page_content == chroma_top.page_content
+    assert numpy_top.metadata == {"i": 3}
@@ -0,0 +1,323 @@
+# vectorstore.py
+import json
+import os
+import uuid
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from typing_extensions import Any, Iterable, List, Tuple
+
+DTYPES = ("float32", "float16", "int8")
+EMBEDDINGS_FILE = "embeddings.npy"
+SCALES_FILE = "scales.npy"
+CHUNKS_FILE = "chunks.json"
+BLOCK_ROWS = 8192
+
+def numpy_index_path(persist_directory: str, collection_name: str) -> str:
+    return os.path.join(persist_directory, "numpy", collection_name)
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _matches(metadata: dict, where: dict | None) -> bool:
+    """
+    Evaluate the subset of Chroma `where` clauses produced by
+    `retrieval.to_where`: {field: value} and {"$and": [...]}.
+    """
+    if not where:
+        return True
+    if "$and" in where:
+        return all(_matches(metadata, clause) for clause in where["$and"])
+    return all(metadata.get(key) == value for key, value in where.items())
+
+class NumpyVectorStore(VectorStore):
+    """
+    In-process brute-force vector store backed by memory-mapped `.npy` files.
+
+    Embeddings are L2-normalized and saved as a float32 matrix, optionally
+    quantized to float16 or to int8 with one scale per row. Chunk texts,
+    ids and metadata are kept in a compact JSON side file. Top-k search is
+    a matrix-vector product followed by `argpartition`; several queries are
+    answered with a single matrix-matrix product.
+
+    The matrix is opened with `mmap_mode="r"`, so workers forked from one
+    server share its pages and opening the store costs only the mmap.
+    Distances are cosine distances (1 - cosine similarity); like Chroma's
+    default L2 distances, lower is closer.
+    """
+
+    def __init__(self, path: str, embedding_function: Embeddings, dtype: str = "float32"):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown index dtype: {dtype}")
+        self.path = path
+        self.embedding_function = embedding_function
+        self.dtype = dtype
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.metadatas: List[dict] = []
+        self._matrix: np.ndarray | None = None
+        self._scales: np.ndarray | None = None
+        self._positions: dict[str, int] | None = None
+        if os.path.exists(os.path.join(path, CHUNKS_FILE)):
+            self._load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _load(self) -> None:
+        with open(os.path.join(self.path, CHUNKS_FILE), encoding="utf-8") as f:
+            chunks = json.load(f)
+        self.dtype = chunks["dtype"]
+        self.ids = chunks["ids"]
+        self.texts = chunks["texts"]
+        self.metadatas = chunks["metadatas"]
+        self._positions = None
+        self._matrix = np.load(os.path.join(self.path, EMBEDDINGS_FILE), mmap_mode="r")
+        scales_path = os.path.join(self.path, SCALES_FILE)
+        self._scales = np.load(scales_path) if self.dtype == "int8" else None
+
+    def _quantize(self, vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray | None]:
+        if self.dtype == "float16":
+            return vectors.astype(np.float16), None
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+            return quantized, scales.astype(np.float32)
+        return vectors.astype(np.float32), None
+
+    def _dense(self) -> np.ndarray:
+        """
+        The stored vectors as normalized float32 (used when rewriting the index).
+        """
+        if self._matrix is None:
+            return np.empty((0, 0), dtype=np.float32)
+        matrix = np.asarray(self._matrix, dtype=np.float32)
+        if self._scales is not None:
+            matrix = matrix * self._scales[:, None]
+        return matrix
+
+    def _save(self, vectors: np.ndarray) -> None:
+        # Write to temporary files and rename, so readers never see a partial index
+        os.makedirs(self.path, exist_ok=True)
+        matrix, scales = self._quantize(vectors)
+        tmp = f".tmp-{uuid.uuid4().hex}"
+        np.save(os.path.join(self.path, EMBEDDINGS_FILE + tmp), matrix)
+        if scales is not None:
+            np.save(os.path.join(self.path, SCALES_FILE + tmp), scales)
+        with open(os.path.join(self.path, CHUNKS_FILE + tmp), "w", encoding="utf-8") as f:
+            json.dump({
+                "dtype": self.dtype,
+                "ids": self.ids,
+                "texts": self.texts,
+                "metadatas": self.metadatas,
+            }, f, separators=(",", ":"))
+        os.replace(os.path.join(self.path, EMBEDDINGS_FILE + tmp + ".npy"),
+                   os.path.join(self.path, EMBEDDINGS_FILE))
+        if scales is not None:
+            os.replace(os.path.join(self.path, SCALES_FILE + tmp + ".npy"),
+                       os.path.join(self.path, SCALES_FILE))
+        os.replace(os.path.join(self.path, CHUNKS_FILE + tmp),
+                   os.path.join(self.path, CHUNKS_FILE))
+        self._load()
+
+    def add_vectors(
+        self,
+        vectors: List[List[float]],
+        texts: List[str],
+        metadatas: List[dict] | None = None,
+        ids: List[str] | None = None,
+    ) -> List[str]:
+        """
+        Add precomputed embeddings to the index.
+        """
+        ids = list(ids) if ids else [uuid.uuid4().hex for _ in texts]
+        metadatas = list(metadatas) if metadatas else [{} for _ in texts]
+        new = _normalize(np.asarray(vectors, dtype=np.float32))
+        existing = self._dense()
+        combined = np.vstack([existing, new]) if len(existing) else new
+        self.ids = self.ids + ids
+        self.texts = self.texts + list(texts)
+        self.metadatas = self.metadatas + metadatas
+        self._save(combined)
+        return ids
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: List[dict] | None = None,
+        ids: List[str] | None = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        vectors = self.embedding_function.embed_documents(texts)
+        return self.add_vectors(vectors, texts, metadatas, ids)
+
+    def _positions_of(self, ids: List[str]) -> List[int]:
+        if self._positions is None:
+            self._positions = {id_: i for i, id_ in enumerate(self.ids)}
+        return [self._positions[id_] for id_ in ids if id_ in self._positions]
+
+    def get_by_ids(self, ids: List[str], /) -> List[Document]:
+        """
+        The chunks with the given ids, skipping unknown ones.
+        """
+        positions = self._positions_of(ids)
+        return [Document(id=self.ids[i], page_content=self.texts[i], metadata=self.metadatas[i]) for i in positions]
+
+    def get_vectors(self, ids: List[str]) -> dict[str, List[float]]:
+        """
+        The stored (normalized) vectors of the chunks with the given ids, by
+        id, skipping unknown ones.
+        """
+        positions = self._positions_of(ids)
+        if not positions:
+            return {}
+        rows = np.asarray(self._matrix[positions], dtype=np.float32)
+        if self._scales is not None:
+            rows = rows * self._scales[positions][:, None]
+        return {self.ids[i]: row.tolist() for i, row in zip(positions, rows)}
+
+    def delete(self, ids: List[str] | None = None, **kwargs: Any) -> bool:
+        if not ids:
+            return False
+        drop = set(ids)
+        keep = [i for i, id_ in enumerate(self.ids) if id_ not in drop]
+        vectors = self._dense()[keep]
+        self.ids = [self.ids[i] for i in keep]
+        self.texts = [self.texts[i] for i in keep]
+        self.metadatas = [self.metadatas[i] for i in keep]
+        self._save(vectors)
+        return True
+
+    def _scores(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Cosine similarities of every stored row with every query, shape (rows, queries).
+        Quantized matrices are converted block by block to bound memory use.
+        """
+        scores = np.empty((len(self.ids), queries.shape[0]), dtype=np.float32)
+        for start in range(0, len(self.ids), BLOCK_ROWS):
+            block = self._matrix[start:start + BLOCK_ROWS]
+            if block.dtype != np.float32:
+                block = block.astype(np.float32)
+            scores[start:start + BLOCK_ROWS] = block @ queries.T
+        if self._scales is not None:
+            scores *= self._scales[:, None]
+        return scores
+
+    def _top_k(self, scores: np.ndarray, k: int, mask: np.ndarray | None) -> List[Tuple[int, float]]:
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top]
+
+    def _mask(self, filter: dict | None) -> np.ndarray | None:
+        if not filter:
+            return None
+        return np.fromiter(
+            (_matches(metadata, filter) for metadata in self.metadatas),
+            dtype=bool, count=len(self.metadatas))
+
+    def _results(self, top: List[Tuple[int, float]]) -> List[Tuple[Document, float]]:
+        return [
+            (Document(id=self.ids[i], page_content=self.texts[i], metadata=self.metadatas[i]),
+             1.0 - score)
+            for i, score in top
+        ]
+
+    def similarity_search_by_vectors_with_relevance_scores(
+        self,
+        embeddings: List[List[float]],
+        k: int = 4,
+        filter: dict | None = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """
+        Batched search: one (document, distance) list per query vector.
+        """
+        if not self.ids or not len(embeddings):
+            return [[] for _ in embeddings]
+        queries = _normalize(np.asarray(embeddings, dtype=np.float32))
+        scores = self._scores(queries)
+        mask = self._mask(filter)
+        return [self._results(self._top_k(scores[:, j], k, mask)) for j in range(len(queries))]
+
+    def similarity_search_by_vector_with_relevance_scores(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: dict | None = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vectors_with_relevance_scores([embedding], k, filter)[0]
+
+    def similarity_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: dict | None = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_relevance_scores(embedding, k, filter)]
+
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        filter: dict | None = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_relevance_scores(embedding, k, filter)
+
+    def similarity_search(
+        self,
+        query: str,
+        k: int = 4,
+        filter: dict | None = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self):
+        return lambda distance: 1.0 - distance
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: List[dict] | None = None,
+        ids: List[str] | None = None,
+        path: str = "numpy_index",
+        dtype: str = "float32",
+        **kwargs: Any,
+    ) -> "NumpyVectorStore":
+        store = cls(path, embedding, dtype)
+        store.add_texts(texts, metadatas, ids)
+        return store
+
+    @classmethod
+    def from_chroma(cls, chroma, path: str, dtype: str = "float32") -> "NumpyVectorStore":
+        """
+        Export the embeddings, texts and metadata of a Chroma collection.
+        """
+        data = chroma._collection.get(include=["embeddings", "documents", "metadatas"])
+        store = cls(path, chroma.embeddings, dtype)
+        store.dtype = dtype
+        store.ids, store.texts, store.metadatas = [], [], []
+        store._matrix = store._scales = None
+        if data["ids"]:
+            store.add_vectors(data["embeddings"], data["documents"], data["metadatas"], data["ids"])
+        return store